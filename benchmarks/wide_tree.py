@@ -0,0 +1,74 @@
+r"""
+Time lookups and writes in a directory with many entries.
+
+    $ python benchmarks/wide_tree.py [entries]
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+from pygit2 import init_repository, Oid, Signature
+from gitfile.git import Git, DEFAULT_MODE_BLOB, DEFAULT_MODE_TREE
+
+AUTHOR = {'author_name': 'foo', 'author_email': 'foo@example.com'}
+
+
+def create_wide_branch(git, count):
+    hex = git.create_content('blah')
+    tb = git.repo.TreeBuilder()
+    for i in range(count):
+        tb.insert('file%05d' % i, Oid(hex=hex), DEFAULT_MODE_BLOB)
+    wide = tb.write()
+    tb = git.repo.TreeBuilder()
+    tb.insert('wide', wide, DEFAULT_MODE_TREE)
+    committer = Signature('foo', 'foo@example.com')
+    git.repo.create_commit('refs/heads/master', committer, committer,
+                           'wide', tb.write(), [])
+    return ['file%05d' % i for i in range(count)]
+
+
+def bench_find_entry(git, names):
+    wide = git.repo[git.find_entry('/wide', branch='master').oid]
+    lookups = names[-100:]
+
+    started = time.time()
+    for name in lookups:
+        for entry in wide:
+            if entry.name == name:
+                break
+    linear = time.time() - started
+
+    started = time.time()
+    for name in lookups:
+        git.find_entry('/wide/' + name, branch='master')
+    indexed = time.time() - started
+
+    print('lookup in %d entries: linear %.4fs, find_entry %.4fs' %
+          (len(names), linear, indexed))
+
+
+def bench_writes(git):
+    hex = git.create_content('blah (new)')
+    started = time.time()
+    git.create_entry('master', '/wide/new.txt', hex, **AUTHOR)
+    git.update_entry('master', '/wide/file00042', hex, **AUTHOR)
+    git.delete_entry('master', '/wide/file00043', **AUTHOR)
+    print('3 writes into the entries: %.4fs' % (time.time() - started))
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    path = tempfile.mkdtemp()
+    try:
+        init_repository(path, True)
+        git = Git(path)
+        names = create_wide_branch(git, count)
+        bench_find_entry(git, names)
+        bench_writes(git)
+    finally:
+        shutil.rmtree(path, True)
+
+
+if __name__ == '__main__':
+    main()
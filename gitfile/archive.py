@@ -0,0 +1,463 @@
+import hashlib
+import os
+import stat
+import struct
+import tarfile
+import tempfile
+import threading
+import zlib
+from gitfile.encoder import compress_chunks
+from gitfile.utils import entry_type
+
+ARCHIVE_FORMATS = {
+    'tar': 'application/x-tar',
+    'tar.gz': 'application/gzip',
+    'zip': 'application/zip',
+}
+
+DEFAULT_ARCHIVE_CACHE_BYTES = 1024 * 1024 * 1024
+DEFAULT_ARCHIVE_CACHE_DIR = os.path.join(tempfile.gettempdir(),
+                                         'gitfile-archives-%d' % os.getuid())
+
+# size of the reads of a cached archive
+CACHE_CHUNK_SIZE = 64 * 1024
+
+# archives only depend on the tree, so their entries get a fixed time
+ARCHIVE_MTIME = 0
+
+BLOCK_SIZE = 512
+
+# values from which the zip format needs its ZIP64 extensions
+ZIP64_LIMIT = 0xffffffff
+ZIP_FILECOUNT_LIMIT = 0xffff
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def _archive_entries(git, tree_hex):
+    r"""
+    Yield the path, the file mode and the entry of everything under the
+    tree, skipping submodules.
+    """
+    for path, entry in git.walk_tree(tree_hex):
+        type = entry_type(entry.filemode)
+        if type == 'commit':
+            continue
+        if type == 'tree':
+            mode = 0o755
+        elif entry.filemode == 0o120000:
+            mode = 0o777
+        else:
+            mode = entry.filemode & 0o777
+        yield path, mode, entry
+
+
+def iter_tar(git, tree_hex):
+    r"""
+    Yield a tar archive of the tree piece by piece, reading one blob at
+    a time. The GNU format keeps the names as the bytes git has, with no
+    assumption on their encoding.
+    """
+    for path, mode, entry in _archive_entries(git, tree_hex):
+        info = tarfile.TarInfo(path)
+        info.mode = mode
+        info.mtime = ARCHIVE_MTIME
+        type = entry_type(entry.filemode)
+        if type == 'tree':
+            info.type = tarfile.DIRTYPE
+            yield info.tobuf(tarfile.GNU_FORMAT)
+        elif entry.filemode == 0o120000:
+            info.type = tarfile.SYMTYPE
+            info.linkname = git.get_content(entry.hex)
+            yield info.tobuf(tarfile.GNU_FORMAT)
+        else:
+            info.size = git.read_header(entry.hex)[1]
+            yield info.tobuf(tarfile.GNU_FORMAT)
+            for chunk in git.iter_content(entry.hex):
+                yield chunk
+            if info.size % BLOCK_SIZE:
+                yield '\0' * (BLOCK_SIZE - info.size % BLOCK_SIZE)
+    yield '\0' * (BLOCK_SIZE * 2)
+
+
+def _zip32(value, limit=None):
+    r"""
+    Return the value for a 32-bit (or 16-bit with the file count limit)
+    field of the zip format, the maximum if it is found in a ZIP64
+    record instead.
+    """
+    if limit is None:
+        limit = ZIP64_LIMIT
+    if value >= limit:
+        return 0xffff if limit == ZIP_FILECOUNT_LIMIT else 0xffffffff
+    return value
+
+
+def _zip64_extra(*values):
+    return struct.pack('<HH', 0x0001, len(values) * 8) + \
+        struct.pack('<%dQ' % len(values), *values)
+
+
+def _zip_flags(path):
+    r"""
+    Return the general purpose flags of a zip entry: the sizes come in
+    a data descriptor, and a UTF-8 name is marked as such (bit 11).
+    """
+    try:
+        path.decode('ascii')
+    except UnicodeDecodeError:
+        try:
+            path.decode('utf-8')
+            return 0x0808
+        except UnicodeDecodeError:
+            pass
+    return 0x08
+
+
+def iter_zip(git, tree_hex):
+    r"""
+    Yield a zip archive of the tree piece by piece. The sizes and the
+    checksum of each file are written in a data descriptor after its
+    content, so that nothing is read twice. ZIP64 records are written
+    for the files, the offsets and the number of entries which do not
+    fit in the zip format.
+    """
+    offset = 0
+    directory = []
+    for path, mode, entry in _archive_entries(git, tree_hex):
+        type = entry_type(entry.filemode)
+        size_hint = 0
+        if type == 'tree':
+            path += '/'
+            attributes = (0o040000 | mode) << 16 | 0x10
+            method = 0
+        elif entry.filemode == 0o120000:
+            attributes = (0o120000 | mode) << 16
+            method = 0
+        else:
+            attributes = (0o100000 | mode) << 16
+            method = zlib.DEFLATED
+            size_hint = git.read_header(entry.hex)[1]
+
+        # the sizes are only known after the content, so a file which
+        # could need 64-bit sizes (deflate may grow it a little) gets
+        # them in its local header and data descriptor
+        zip64 = size_hint + (size_hint >> 10) + 64 >= ZIP64_LIMIT
+        flags = _zip_flags(path)
+        if zip64:
+            header = struct.pack('<IHHHHHIIIHH', 0x04034b50, 45, flags,
+                                 method, 0, 0x21, 0, 0xffffffff, 0xffffffff,
+                                 len(path), 20) + path + _zip64_extra(0, 0)
+        else:
+            header = struct.pack('<IHHHHHIIIHH', 0x04034b50, 20, flags,
+                                 method, 0, 0x21, 0, 0, 0, len(path), 0) + \
+                path
+        yield header
+        local_offset = offset
+        offset += len(header)
+
+        crc = 0
+        size = compressed = 0
+        if type != 'tree':
+            z = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS) \
+                if method else None
+            for chunk in git.iter_content(entry.hex):
+                crc = zlib.crc32(chunk, crc)
+                size += len(chunk)
+                if z:
+                    chunk = z.compress(chunk)
+                compressed += len(chunk)
+                yield chunk
+            if z:
+                chunk = z.flush()
+                compressed += len(chunk)
+                yield chunk
+        crc &= 0xffffffff
+
+        if zip64:
+            descriptor = struct.pack('<IIQQ', 0x08074b50, crc, compressed,
+                                     size)
+        else:
+            descriptor = struct.pack('<IIII', 0x08074b50, crc, compressed,
+                                     size)
+        yield descriptor
+        offset += compressed + len(descriptor)
+
+        # the central directory only carries the 64-bit values which do
+        # not fit, in this order
+        extra = [x for x in (size, compressed, local_offset)
+                 if x >= ZIP64_LIMIT]
+        extra = _zip64_extra(*extra) if extra else ''
+        version = 45 if extra else 20
+        directory.append(struct.pack(
+            '<IHHHHHHIIIHHHHHII', 0x02014b50, 0x0300 | version, version,
+            flags, method, 0, 0x21, crc, _zip32(compressed), _zip32(size),
+            len(path), len(extra), 0, 0, 0, attributes,
+            _zip32(local_offset)) + path + extra)
+
+    size = sum(len(x) for x in directory)
+    for record in directory:
+        yield record
+    count = len(directory)
+    if count >= ZIP_FILECOUNT_LIMIT or size >= ZIP64_LIMIT or \
+            offset >= ZIP64_LIMIT:
+        yield struct.pack('<IQHHIIQQQQ', 0x06064b50, 44, 0x032d, 45, 0, 0,
+                          count, count, size, offset)
+        yield struct.pack('<IIQI', 0x07064b50, 0, offset + size, 1)
+    yield struct.pack('<IHHHHIIH', 0x06054b50, 0, 0,
+                      _zip32(count, ZIP_FILECOUNT_LIMIT),
+                      _zip32(count, ZIP_FILECOUNT_LIMIT),
+                      _zip32(size), _zip32(offset), 0)
+
+
+def iter_archive(git, tree_hex, format):
+    r"""
+    Yield the archive of the tree in the given format.
+    """
+    if format == 'zip':
+        return iter_zip(git, tree_hex)
+    if format == 'tar.gz':
+        return compress_chunks(iter_tar(git, tree_hex), 'gzip')
+    return iter_tar(git, tree_hex)
+
+
+def _private_dir(path):
+    r"""
+    Create the directory for the current user only, or check that the
+    existing one is a directory only the current user can use.
+    """
+    try:
+        os.makedirs(path, 0o700)
+    except OSError:
+        pass
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or \
+            st.st_mode & 0o077:
+        raise IOError('%s is not a private directory' % path)
+
+
+class _ArchiveBuild(object):
+    r"""
+    An archive being written to the temporary file at the given path.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.size = 0
+        self.done = False
+        self.error = None
+        self.cond = threading.Condition()
+
+    def written(self, size):
+        with self.cond:
+            self.size += size
+            self.cond.notify_all()
+
+    def finish(self, error=None):
+        with self.cond:
+            self.done = True
+            self.error = error
+            self.cond.notify_all()
+
+
+class ArchiveCache(object):
+    r"""
+    Keep the archives of trees on disk, keyed by the tree id and the
+    format, and drop the least recently used ones once they take more
+    than max_bytes.
+    """
+
+    def __init__(self, path, max_bytes=DEFAULT_ARCHIVE_CACHE_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        # bytes taken by the cache, counted once from the directory and
+        # then kept up to date by the stores
+        self.size = None
+        self._builds = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def for_repo(cls, repo, cache_dir=None, **options):
+        r"""
+        Return the cache shared by all Git objects for the given pygit2
+        repository, kept in a directory of its own under cache_dir (the
+        gitfile-archives-<uid> directory of the system temporary
+        directory by default). The default directory is made private to
+        the user, and IOError is raised if it is not, so that no other
+        user of the host can plant archives in it.
+        """
+        repo_path = os.path.realpath(repo.path)
+        path = os.path.join(cache_dir or DEFAULT_ARCHIVE_CACHE_DIR,
+                            hashlib.sha1(repo_path).hexdigest())
+        with _caches_lock:
+            cache = _caches.get(path)
+            if cache is None:
+                if not cache_dir:
+                    _private_dir(DEFAULT_ARCHIVE_CACHE_DIR)
+                cache = _caches[path] = cls(path, **options)
+            return cache
+
+    def file_path(self, tree_hex, format):
+        return os.path.join(self.path, '%s.%s' % (tree_hex, format))
+
+    def open(self, tree_hex, format):
+        r"""
+        Return the cached archive opened for reading, or None.
+        """
+        f = self._open(tree_hex, format)
+        if f is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return f
+
+    def store(self, tree_hex, format, make_chunks):
+        r"""
+        Yield the archive made by the given function as it is written to
+        the cache. It is written by a thread of its own, at its own pace
+        rather than the client's, and requests for an archive being made
+        read it as it is written instead of making it again.
+        """
+        build, f = self._join_build(tree_hex, format, make_chunks)
+        with f:
+            if build is None:
+                # completed in the meantime
+                while True:
+                    chunk = f.read(CACHE_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    yield chunk
+                return
+
+            pos = 0
+            while True:
+                with build.cond:
+                    while build.size == pos and not build.done:
+                        build.cond.wait()
+                    size, done, error = build.size, build.done, build.error
+                if error is not None:
+                    raise error
+                while pos < size:
+                    chunk = f.read(min(CACHE_CHUNK_SIZE, size - pos))
+                    pos += len(chunk)
+                    yield chunk
+                if done:
+                    return
+
+    def evict(self):
+        r"""
+        Remove the least recently used archives until the cache fits in
+        max_bytes, and recount the size of the cache.
+        """
+        files = []
+        try:
+            names = os.listdir(self.path)
+        except OSError:
+            names = []
+        for name in names:
+            if name.startswith('tmp_'):
+                continue
+            path = os.path.join(self.path, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            files.append((st.st_mtime, st.st_size, path))
+        total = sum(x[1] for x in files)
+        for mtime, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            total -= size
+        self.size = total
+
+    def _open(self, tree_hex, format):
+        path = self.file_path(tree_hex, format)
+        try:
+            f = open(path, 'rb')
+        except IOError:
+            return None
+        try:
+            # the access time is not reliable, so the mtime marks the use
+            os.utime(path, None)
+        except OSError:
+            pass
+        return f
+
+    def _join_build(self, tree_hex, format, make_chunks):
+        r"""
+        Return the build of the archive, started if there is none, and
+        its temporary file opened for reading, or None and the archive
+        if it is in the cache.
+        """
+        key = (tree_hex, format)
+        with self._lock:
+            build = self._builds.get(key)
+            if build is None:
+                f = self._open(tree_hex, format)
+                if f is not None:
+                    return None, f
+                if not os.path.isdir(self.path):
+                    try:
+                        os.makedirs(self.path, 0o700)
+                    except OSError:
+                        pass
+                fd, tmp_path = tempfile.mkstemp(dir=self.path, prefix='tmp_')
+                build = self._builds[key] = _ArchiveBuild(tmp_path)
+                thread = threading.Thread(
+                    target=self._build,
+                    args=(tree_hex, format, build, fd, make_chunks))
+                thread.daemon = True
+                thread.start()
+            # the temporary file is only renamed under the lock
+            return build, open(build.path, 'rb')
+
+    def _build(self, tree_hex, format, build, fd, make_chunks):
+        error = None
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pending = 0
+                for chunk in make_chunks():
+                    f.write(chunk)
+                    pending += len(chunk)
+                    if pending >= CACHE_CHUNK_SIZE:
+                        f.flush()
+                        build.written(pending)
+                        pending = 0
+                f.flush()
+                build.written(pending)
+        except Exception, e:
+            error = e
+
+        with self._lock:
+            del self._builds[(tree_hex, format)]
+            try:
+                if error is None:
+                    os.rename(build.path, self.file_path(tree_hex, format))
+            except OSError, e:
+                error = e
+            if error is not None and os.path.exists(build.path):
+                os.unlink(build.path)
+        try:
+            if error is None:
+                self._account(build.size)
+        finally:
+            build.finish(error)
+
+    def _account(self, size):
+        # the directory is only listed when the cache may be too large
+        with self._lock:
+            if self.size is not None:
+                self.size += size
+            listed = self.size is None or self.size > self.max_bytes
+        if listed:
+            self.evict()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
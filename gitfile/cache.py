@@ -0,0 +1,187 @@
+from collections import OrderedDict
+import os
+import threading
+
+
+class LRUCache(object):
+    r"""
+    A thread-safe LRU cache bounded by the total size of its values.
+
+    Each value is weighed with the given sizeof function (1 per value
+    by default, so max_size is then simply the number of values) and
+    the least recently used values are evicted once the total exceeds
+    max_size. The given on_evict function, if any, is called with the
+    key and the value of each evicted value.
+    """
+
+    def __init__(self, max_size, sizeof=None, on_evict=None):
+        self.max_size = max_size
+        self.sizeof = sizeof or (lambda key, value: 1)
+        self.on_evict = on_evict
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def get(self, key, default=None):
+        r"""
+        Return the value for the given key and mark it as recently used.
+        """
+        with self._lock:
+            try:
+                value, size = self._items.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._items[key] = (value, size)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        r"""
+        Store the value for the given key and evict old values if the
+        cache grows over its limit. Values larger than the whole cache
+        are not stored.
+        """
+        size = self.sizeof(key, value)
+        evicted = []
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            if size <= self.max_size:
+                self._items[key] = (value, size)
+                self.size += size
+            while self.size > self.max_size:
+                evicted_key, (evicted_value, evicted_size) = \
+                    self._items.popitem(last=False)
+                self.size -= evicted_size
+                self.evictions += 1
+                evicted.append((evicted_key, evicted_value))
+        if self.on_evict:
+            # outside of the lock as it may take a while
+            for evicted_key, evicted_value in evicted:
+                self.on_evict(evicted_key, evicted_value)
+
+    def pop(self, key, default=None):
+        r"""
+        Remove the value for the given key and return it.
+        """
+        with self._lock:
+            try:
+                value, size = self._items.pop(key)
+            except KeyError:
+                return default
+            self.size -= size
+            return value
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.size = 0
+
+    def stats(self):
+        r"""
+        Return the counters of the cache as a dict.
+        """
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': float(self.hits) / lookups if lookups else 0.0,
+            'items': len(self._items),
+            'size': self.size,
+            'max_size': self.max_size,
+        }
+
+
+DEFAULT_COMMIT_CACHE_SIZE = 10000
+DEFAULT_ENTRY_CACHE_BYTES = 8 * 1024 * 1024
+DEFAULT_LISTING_CACHE_BYTES = 64 * 1024 * 1024
+DEFAULT_TREE_CACHE_BYTES = 64 * 1024 * 1024
+
+# rough memory footprint of a cached tree entry besides its name
+ENTRY_OVERHEAD = 128
+
+_tree_caches = {}
+_tree_caches_lock = threading.Lock()
+
+
+def _entry_sizeof(key, entry):
+    return ENTRY_OVERHEAD + len(key[1]) + len(getattr(entry, 'name', ''))
+
+
+def _tree_sizeof(key, tree):
+    return ENTRY_OVERHEAD * (len(tree) + 1)
+
+
+def _listing_sizeof(key, entries):
+    return ENTRY_OVERHEAD + sum(ENTRY_OVERHEAD + len(x.name)
+                                for x in entries)
+
+
+class TreeCache(object):
+    r"""
+    Cache the results of resolving immutable objects of a repository:
+    the root tree of a commit, the entry for a path under a tree, the
+    entries of a tree and the parsed trees. All of them are keyed by
+    object ids so they never have to be invalidated.
+    """
+
+    def __init__(self, commit_size=DEFAULT_COMMIT_CACHE_SIZE,
+                 entry_bytes=DEFAULT_ENTRY_CACHE_BYTES,
+                 listing_bytes=DEFAULT_LISTING_CACHE_BYTES,
+                 tree_bytes=DEFAULT_TREE_CACHE_BYTES):
+        self.commits = LRUCache(commit_size)
+        self.entries = LRUCache(entry_bytes, sizeof=_entry_sizeof)
+        self.listings = LRUCache(listing_bytes, sizeof=_listing_sizeof)
+        self.trees = LRUCache(tree_bytes, sizeof=_tree_sizeof)
+
+    @classmethod
+    def for_repo(cls, path):
+        r"""
+        Return the cache shared by all Git objects for the given
+        repository path.
+        """
+        path = os.path.realpath(path)
+        with _tree_caches_lock:
+            cache = _tree_caches.get(path)
+            if cache is None:
+                cache = _tree_caches[path] = cls()
+            return cache
+
+    @classmethod
+    def release(cls, path):
+        r"""
+        Drop and clear the cache shared for the given repository path, so
+        that a repository evicted from the pool takes no memory. Objects
+        still holding the cache keep using it on their own.
+        """
+        path = os.path.realpath(path)
+        with _tree_caches_lock:
+            cache = _tree_caches.pop(path, None)
+        if cache is not None:
+            cache.clear()
+
+    def clear(self):
+        self.commits.clear()
+        self.entries.clear()
+        self.listings.clear()
+        self.trees.clear()
+
+    def stats(self):
+        return {
+            'commits': self.commits.stats(),
+            'entries': self.entries.stats(),
+            'listings': self.listings.stats(),
+            'trees': self.trees.stats(),
+        }
@@ -0,0 +1,163 @@
+import json
+import types
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+BUFFER_SIZE = 64 * 1024
+
+# responses smaller than this are not worth compressing
+DEFAULT_COMPRESS_MIN_SIZE = 1024
+
+COMPACT_SEPARATORS = (',', ':')
+
+
+class LazyObject(object):
+    r"""
+    A JSON object whose members are produced by an iterable of (name,
+    value) pairs and encoded in that order.
+    """
+
+    def __init__(self, pairs):
+        self.pairs = pairs
+
+    def __iter__(self):
+        return iter(self.pairs)
+
+
+def is_lazy(obj):
+    r"""
+    Return whether the object holds values which are only produced when
+    it is encoded.
+    """
+    if isinstance(obj, (LazyObject, types.GeneratorType)):
+        return True
+    if isinstance(obj, dict):
+        return any(is_lazy(x) for x in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return any(is_lazy(x) for x in obj)
+    return False
+
+
+def iter_json(obj, indent=None, level=0):
+    r"""
+    Encode the object to JSON piece by piece. Dicts are encoded with
+    sorted keys, and generators and LazyObjects as they are iterated,
+    so that they never have to be held in memory. The output is compact
+    unless an indent is given.
+    """
+    if isinstance(obj, dict):
+        members = sorted(obj.items())
+    elif isinstance(obj, LazyObject):
+        members = iter(obj)
+    elif isinstance(obj, (list, tuple, types.GeneratorType)):
+        members = None
+    else:
+        yield json.dumps(obj)
+        return
+
+    if indent is None:
+        separator, newline, closing = ',', '', ''
+    else:
+        newline = '\n' + ' ' * (indent * (level + 1))
+        separator = ',' + newline
+        closing = '\n' + ' ' * (indent * level)
+
+    if members is None:
+        start, end = '[', ']'
+        values = ((None, x) for x in obj)
+    else:
+        start, end = '{', '}'
+        values = members
+
+    empty = True
+    for name, value in values:
+        if empty:
+            yield start + newline
+            empty = False
+        else:
+            yield separator
+        if members is not None:
+            yield json.dumps(name) + (':' if indent is None else ': ')
+        for chunk in iter_json(value, indent, level + 1):
+            yield chunk
+
+    if empty:
+        yield start + end
+    else:
+        yield closing + end
+
+
+def iter_ndjson(result):
+    r"""
+    Encode a listing as newline-delimited JSON: a line with the fields
+    of the result other than its entries, if any, followed by a line per
+    entry. Entries given as an object are encoded as {name: value}.
+    """
+    header = dict((k, v) for k, v in result.items() if k != 'entries')
+    if header:
+        yield json.dumps(header, sort_keys=True,
+                         separators=COMPACT_SEPARATORS) + '\n'
+
+    entries = result.get('entries', [])
+    if isinstance(entries, dict):
+        entries = ({k: v} for k, v in sorted(entries.items()))
+    elif isinstance(entries, LazyObject):
+        entries = ({k: v} for k, v in entries)
+    for entry in entries:
+        yield json.dumps(entry, sort_keys=True,
+                         separators=COMPACT_SEPARATORS) + '\n'
+
+
+def buffer_chunks(chunks, size=BUFFER_SIZE):
+    r"""
+    Join the given small chunks into chunks of about the given size.
+    """
+    buf = []
+    buffered = 0
+    for chunk in chunks:
+        buf.append(chunk)
+        buffered += len(chunk)
+        if buffered >= size:
+            yield ''.join(buf)
+            buf = []
+            buffered = 0
+    if buf:
+        yield ''.join(buf)
+
+
+def content_encodings():
+    r"""
+    Return the content codings responses can be compressed with, the
+    preferred one first. Brotli is only used if it can be imported.
+    """
+    if brotli is not None:
+        return ['br', 'gzip']
+    return ['gzip']
+
+
+def compress_chunks(chunks, encoding='gzip'):
+    r"""
+    Compress the given chunks into a stream of the given content coding
+    piece by piece.
+    """
+    if encoding == 'br':
+        compressor = brotli.Compressor()
+        compress, finish = compressor.process, compressor.finish
+    else:
+        z = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        compress, finish = z.compress, z.flush
+    for chunk in chunks:
+        data = compress(chunk)
+        if data:
+            yield data
+    data = finish()
+    if data:
+        yield data
+
+
+def compress(data, encoding='gzip'):
+    return ''.join(compress_chunks([data], encoding))
@@ -6,3 +6,11 @@ class GitFileException(Exception):
 
 class InvalidParamException(GitFileException):
     pass
+
+
+class ContentTooLargeException(GitFileException):
+    pass
+
+
+class ConflictException(GitFileException):
+    pass
@@ -1,10 +1,53 @@
-from pygit2 import Repository, Signature, Oid
-import re
-from gitfile.exceptions import InvalidParamException
+from pygit2 import Repository, Signature, Oid, GitError, Tree, \
+    GIT_DIFF_SKIP_BINARY_CHECK
+import heapq
+import itertools
+import os
+import random
+import tempfile
+import threading
+import time
+from gitfile.exceptions import InvalidParamException, \
+    ContentTooLargeException, ConflictException
 from gitfile.utils import *
+from gitfile.cache import TreeCache
+from gitfile.odb import ObjectDatabase, PackWriter, CHUNK_SIZE, \
+    slice_chunks
+from gitfile.refs import RefIndex
 
 DEFAULT_MODE_BLOB = 0o0100644
 DEFAULT_MODE_TREE = 0o0040000
+MODES = (DEFAULT_MODE_BLOB, 0o0100755, 0o0120000, DEFAULT_MODE_TREE,
+         0o0160000)
+
+DIFF_STATUS = {
+    'A': 'added',
+    'D': 'deleted',
+    'M': 'modified',
+    'T': 'typechange',
+}
+
+# longest line accepted for the size of a streamed blob
+MAX_SIZE_LINE = 32
+
+# seconds to wait before retrying a write on a moved branch
+RETRY_BACKOFF = 0.01
+MAX_RETRY_BACKOFF = 0.5
+
+# separates the queue of a history cursor from the commits returned
+HISTORY_CURSOR_SEPARATOR = '-'
+
+# most retries of a write a client may ask for
+MAX_WRITE_RETRIES = 10
+
+# locks serializing the moves of a branch, by repository and branch
+_ref_locks = {}
+_ref_locks_lock = threading.Lock()
+
+
+def _ref_lock(path, name):
+    with _ref_locks_lock:
+        return _ref_locks.setdefault((path, name), threading.Lock())
 
 
 class Git(object):
@@ -18,6 +61,21 @@ class Git(object):
         this git repository.
         """
         self.repo = Repository(gitdir)
+        self.cache = TreeCache.for_repo(self.repo.path)
+        self.odb = ObjectDatabase.for_repo(self.repo)
+        self.ref_index = RefIndex.for_repo(self.repo)
+
+    def close(self):
+        r"""
+        Release the packs and the caches of the repository. They are
+        reopened if the object is used again.
+        """
+        ObjectDatabase.release(self.repo)
+        TreeCache.release(self.repo.path)
+        # parsed trees hold the pygit2 repository, and with it the packs
+        # libgit2 keeps open, even if the cache was released by another
+        # object
+        self.cache.trees.clear()
 
     def branches(self):
         r"""
@@ -31,15 +89,38 @@ class Git(object):
         """
         return self._refs('tags')
 
+    def iter_refs(self, type, prefix='', after=None):
+        r"""
+        Yield the name (without refs/<type>/) and the target of the
+        branches or tags whose names start with the given prefix, in
+        name order and only after the given name if any.
+        """
+        base = 'refs/%s/' % type
+        for name, target in self.ref_index.iter_refs(
+                base + prefix, None if after is None else base + after):
+            yield name[len(base):], target
+
     def _refs(self, type):
-        refs = {}
-        pattern = re.compile(r'refs/%s/(.*)$' % type)
-        for ref in self.repo.listall_references():
-            m = pattern.match(ref)
-            if m:
-                reference = self.repo.lookup_reference(ref)
-                refs[m.group(1)] = reference.target.hex
-        return refs
+        return dict(self.iter_refs(type))
+
+    def has_branch(self, name):
+        r"""
+        Return whether the branch exists, looking only that ref up.
+        """
+        return self._ref_exists('refs/heads/%s' % name)
+
+    def has_tag(self, name):
+        r"""
+        Return whether the tag exists, looking only that ref up.
+        """
+        return self._ref_exists('refs/tags/%s' % name)
+
+    def _ref_exists(self, name):
+        try:
+            self.repo.lookup_reference(name)
+        except Exception, e:
+            return False
+        return True
 
     def create_branch(self, name, target):
         r"""
@@ -84,6 +165,77 @@ class Git(object):
         blob = self.repo[oid]
         return blob.hex
 
+    def create_content_from_stream(self, stream, limit=None,
+                                   chunk_size=CHUNK_SIZE):
+        r"""
+        Create a new blob object from the content read from the given
+        file-like object and return the sha1 hex. The content is spooled
+        to a temporary file so that it is never held in memory as a
+        whole.
+        """
+        if stream is None:
+            raise InvalidParamException('content is required')
+
+        with tempfile.NamedTemporaryFile(dir=self.repo.path,
+                                         prefix='tmp_blob_') as f:
+            size = 0
+            while True:
+                chunk = stream.read(chunk_size)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if limit is not None and size > limit:
+                    raise ContentTooLargeException(
+                        'content exceeds %d bytes' % limit)
+                f.write(chunk)
+            f.flush()
+            oid = self.repo.create_blob_fromdisk(f.name)
+
+        return oid.hex
+
+    def create_contents_from_stream(self, stream, limit=None,
+                                    chunk_size=CHUNK_SIZE):
+        r"""
+        Create blob objects from the contents read from the given
+        file-like object, each preceded by a line with its size in
+        bytes, and return the list of their sha1 hex. The blobs are
+        written into a single new pack.
+        """
+        if stream is None:
+            raise InvalidParamException('content is required')
+
+        writer = PackWriter(os.path.join(self.odb.path, 'pack'),
+                            exists=lambda hex: hex in self.repo)
+        hexes = []
+        try:
+            while True:
+                line = stream.readline(MAX_SIZE_LINE)
+                if not line:
+                    break
+                try:
+                    size = int(line)
+                except ValueError:
+                    raise InvalidParamException(
+                        'size is expected: %r' % line[:20])
+                if size < 0:
+                    raise InvalidParamException('size is negative')
+                if limit is not None and size > limit:
+                    raise ContentTooLargeException(
+                        'content exceeds %d bytes' % limit)
+                try:
+                    hexes.append(writer.add(GIT_OBJ_BLOB, size,
+                                            stream.read, chunk_size))
+                except EOFError, e:
+                    raise InvalidParamException(
+                        'content is truncated: %s' % e)
+        except Exception:
+            writer.abort()
+            raise
+        if writer.finish():
+            # each upload adds a pack, which every lookup goes through
+            self.odb.merge_small_packs()
+        return hexes
+
     def get_content(self, hex):
         r"""
         Return the raw content of the blob object for the given sha1.
@@ -100,39 +252,453 @@ class Git(object):
 
         return obj.read_raw()
 
+    def read_header(self, hex):
+        r"""
+        Return the type and the size of the object for the given sha1
+        without reading its content, or None if there is no object.
+        """
+        if not is_valid_hex(hex):
+            raise InvalidParamException('hex is required')
+        header = self.odb.read_header(hex)
+        if header is None:
+            try:
+                obj = self.repo[Oid(hex=hex)]
+            except KeyError, e:
+                return None
+            header = (obj.type, len(obj.read_raw()))
+        return header
+
+    def iter_content(self, hex, start=0, end=None, chunk_size=CHUNK_SIZE):
+        r"""
+        Return an iterator over the raw content of the blob object for
+        the given sha1 between the start and the end offsets.
+        """
+        chunks = self.odb.iter_content(hex, chunk_size)
+        if chunks is None:
+            # deltified or not in the local object database
+            content = self.get_content(hex) or ''
+            chunks = (content[i:i + chunk_size]
+                      for i in xrange(start, len(content), chunk_size))
+            return slice_chunks(chunks, 0, None if end is None
+                                else end - start)
+        return slice_chunks(chunks, start, end)
+
+    def deflated_content(self, hex, chunk_size=CHUNK_SIZE):
+        r"""
+        Return the size of the zlib stream the blob for the given sha1 is
+        stored as and an iterator over the stream, or None if it can only
+        be read inflated.
+        """
+        if not is_valid_hex(hex):
+            raise InvalidParamException('hex is required')
+        return self.odb.deflated_content(hex, chunk_size)
+
+    def storage_order(self, hexes):
+        r"""
+        Return the given sha1s without duplicates and sorted in the order
+        their objects are stored: the packed ones by pack and offset,
+        followed by the loose ones.
+        """
+        def key(hex):
+            location = self.odb.location(hex)
+            if location is None:
+                return (1, hex)
+            return (0,) + location
+
+        return sorted(set(hexes), key=key)
+
     def find_entry(self, path, branch=None, tag=None, commit=None):
         r"""
         Return the entry for the given path and on the given
         branch/tag.
         """
+        tree_hex = self.tree_hex(branch=branch, tag=tag, commit=commit)
+
+        path = '/'.join(x for x in path.split('/') if x != '')
+        if path == '':
+            return self.tree(tree_hex)
+        return self.tree_entry(tree_hex, path)
+
+    def tree(self, tree_hex):
+        r"""
+        Return the tree object for the given sha1. libgit2 does not keep
+        large trees in its object cache and parsing them again dominates
+        a lookup, so they are kept parsed in the tree cache.
+        """
+        tree = self.cache.trees.get(tree_hex)
+        if tree is None:
+            tree = self.repo[Oid(hex=tree_hex)]
+            self.cache.trees.set(tree_hex, tree)
+        return tree
+
+    def tree_entry(self, tree_hex, path):
+        r"""
+        Return the entry for the given normalized path (with no leading
+        or trailing slash) under the tree for the given sha1, or None.
+        """
+        # trees are immutable, so is the entry found under a tree
+        key = (tree_hex, path)
+        entry = self.cache.entries.get(key)
+        if entry is None:
+            # each level is looked up by libgit2 with a binary search in
+            # the parsed tree, and cached on its own
+            parent, _, name = path.rpartition('/')
+            tree = None
+            if not parent:
+                tree = self.tree(tree_hex)
+            else:
+                parent_entry = self.tree_entry(tree_hex, parent)
+                if parent_entry is not None and \
+                        entry_type(parent_entry.filemode) == 'tree':
+                    tree = self.tree(parent_entry.hex)
+            entry = False
+            if tree is not None:
+                try:
+                    entry = tree[name]
+                except KeyError:
+                    pass
+            self.cache.entries.set(key, entry)
+
+        return entry or None
+
+    def tree_entries(self, tree_hex):
+        r"""
+        Return the list of the entries in the tree for the given sha1.
+        """
+        entries = self.cache.listings.get(tree_hex)
+        if entries is None:
+            entries = list(self.tree(tree_hex))
+            self.cache.listings.set(tree_hex, entries)
+        return entries
+
+    def iter_tree_entries(self, tree_hex, prefix='', after=None):
+        r"""
+        Yield the entries of the tree for the given sha1 whose names
+        start with the given prefix, in tree order and only after the
+        given entry_key if any. The first entry is found with a binary
+        search so that a page of a large tree is read without going
+        through the entries before it.
+        """
+        tree = self.tree(tree_hex)
+
+        def lower_bound(key, inclusive):
+            lo, hi = 0, len(tree)
+            while lo < hi:
+                mid = (lo + hi) // 2
+                mid_key = entry_key(tree[mid])
+                if mid_key < key or (not inclusive and mid_key == key):
+                    lo = mid + 1
+                else:
+                    hi = mid
+            return lo
+
+        i = lower_bound(prefix, True)
+        if after is not None:
+            i = max(i, lower_bound(after, False))
+        while i < len(tree):
+            entry = tree[i]
+            if not entry.name.startswith(prefix):
+                break
+            yield entry
+            i += 1
+
+    def walk_tree(self, tree_hex, depth=None, prefix='', after=None):
+        r"""
+        Yield the path and the entry of everything under the tree for
+        the given sha1, each tree followed by its own entries, down to
+        the given depth (1 lists the tree itself only). The prefix only
+        applies to the top-level names. With after, the walk resumes
+        after the given path_key, skipping the trees before it without
+        reading them.
+        """
+        resume = None
+        if after is not None and '/' in after:
+            name, rest = after.split('/', 1)
+            after = name + '/'
+            entry = self.tree_entry(tree_hex, name)
+            if entry is not None and entry_type(entry.filemode) == 'tree':
+                resume = (name, entry, rest)
+
+        if resume and (depth is None or depth > 1):
+            name, entry, rest = resume
+            for path, sub_entry in self.walk_tree(
+                    entry.hex, depth and depth - 1, after=rest):
+                yield name + '/' + path, sub_entry
+
+        for entry in self.iter_tree_entries(tree_hex, prefix, after):
+            yield entry.name, entry
+            if entry_type(entry.filemode) == 'tree' and \
+                    (depth is None or depth > 1):
+                for path, sub_entry in self.walk_tree(entry.hex,
+                                                      depth and depth - 1):
+                    yield entry.name + '/' + path, sub_entry
+
+    def history(self, commit, path=None, after=None):
+        r"""
+        Yield the commits reachable from the given commit id, newest
+        first, which changed the given path compared to each of their
+        parents (a root commit changes the paths it has). With after, a
+        cursor from iter_history, the walk resumes where it stopped.
+        """
+        for c, cursor in self.iter_history(commit, path=path, after=after):
+            yield c
+
+    def iter_history(self, commit, path=None, after=None):
+        r"""
+        Return an iterator over the commits of history() paired with the
+        cursor which resumes the walk after each of them, or None after
+        the last one.
+
+        Commits are taken from a queue ordered by commit time, as git log
+        does without --topo-order, so that the first ones come without
+        reading the whole history. The cursor is the queue, plus the
+        walked commits which the queue could lead back to when commit
+        times are equal.
+        """
+        if not is_valid_hex(commit):
+            raise InvalidParamException('hex is required')
+        if path:
+            path = '/'.join(x for x in path.split('/') if x != '')
+
+        if after is None:
+            pending, walked = [commit], []
+        else:
+            pending, _, walked = after.partition(HISTORY_CURSOR_SEPARATOR)
+            pending = pending.split(',') if pending else []
+            walked = walked.split(',') if walked else []
+            if not all(is_valid_hex(x) for x in pending + walked):
+                raise InvalidParamException('cursor is invalid')
+        try:
+            commits = [self.repo[Oid(hex=x)] for x in pending + walked]
+        except KeyError:
+            raise InvalidParamException('No such commit in the cursor')
+        return self._walk_history(commits[:len(pending)],
+                                  commits[len(pending):], path)
+
+    def _walk_history(self, pending, walked, path):
+        order = itertools.count()
+        queue = [(-x.commit_time, next(order), x) for x in pending]
+        heapq.heapify(queue)
+        seen = set(x.hex for x in pending + walked)
+        walked = dict((x.hex, x.commit_time) for x in walked)
+        while queue:
+            _, _, c = heapq.heappop(queue)
+            if queue:
+                # a commit still in the queue may lead back to this one
+                walked[c.hex] = c.commit_time
+            for parent_id in c.parent_ids:
+                if parent_id.hex not in seen:
+                    seen.add(parent_id.hex)
+                    parent = self.repo[parent_id]
+                    heapq.heappush(queue, (-parent.commit_time, next(order),
+                                           parent))
+
+            if path:
+                tree_hex = c.tree_id.hex
+                parents = [self.tree_hex(commit=x.hex) for x in c.parent_ids]
+                if not parents:
+                    if self.tree_entry(tree_hex, path) is None:
+                        continue
+                elif not all(self._path_changed(tree_hex, x, path)
+                             for x in parents):
+                    continue
+            yield c, self._history_cursor(queue, walked)
+
+    def _history_cursor(self, queue, walked):
+        if not queue:
+            return None
+        # as commit times only go back along parents, a walked commit is
+        # reached again only from a queued commit with the same time, and
+        # those newer than the queue never will be
+        newest = -queue[0][0]
+        for hex in [x for x, time in walked.items() if time > newest]:
+            del walked[hex]
+        times = set(-x[0] for x in queue)
+        cursor = ','.join(x[2].hex for x in sorted(queue))
+        again = sorted(x for x, time in walked.items() if time in times)
+        if again:
+            cursor += HISTORY_CURSOR_SEPARATOR + ','.join(again)
+        return cursor
+
+    def _path_changed(self, tree_hex, other_hex, path):
+        r"""
+        Return whether the entry for the path differs between the two
+        trees, comparing the subtree ids from the top so that an
+        unchanged directory ends the comparison early.
+        """
+        if tree_hex == other_hex:
+            return False
+        parts = path.split('/')
+        for i in range(1, len(parts) + 1):
+            sub_path = '/'.join(parts[:i])
+            entry = self.tree_entry(tree_hex, sub_path)
+            other = self.tree_entry(other_hex, sub_path)
+            if entry is None or other is None:
+                return entry is not other
+            if entry.oid == other.oid:
+                return False
+        return True
+
+    def diff(self, old_commit, new_commit, path=None, after=None):
+        r"""
+        Yield the changes to the files under the given path between two
+        commits in path order, as dicts with the path, the status
+        ('added', 'deleted', 'modified' or 'typechange') and the old and
+        new sha1 and mode. With after, only the changes to the paths
+        after it are yielded.
+        """
+        path = '/'.join(x for x in (path or '').split('/') if x != '')
+        changes = self._diff(self._diff_side(old_commit, path),
+                             self._diff_side(new_commit, path), path)
+        for change in changes:
+            if after is None or change['path'] > after:
+                yield change
+
+    def _diff(self, old, new, path):
+        if old is None and new is None:
+            return
+        if old is not None and new is not None and old.oid == new.oid:
+            # identical subtrees or files: nothing to compare
+            return
+
+        # an empty tree is false, so the sides are compared with None
+        old_tree = old if isinstance(old, Tree) else None
+        new_tree = new if isinstance(new, Tree) else None
+        old_file = None if old_tree is not None else old
+        new_file = None if new_tree is not None else new
+        if old_file is not None or new_file is not None:
+            if old_file is None:
+                status = 'added'
+            elif new_file is None:
+                status = 'deleted'
+            else:
+                status = 'modified'
+            yield diff_to_dict(
+                path, status,
+                old_file and (old_file.hex, old_file.filemode),
+                new_file and (new_file.hex, new_file.filemode))
+
+        if old_tree is not None and new_tree is not None:
+            # libgit2 skips the subtrees whose ids are equal
+            diff = old_tree.diff_to_tree(new_tree,
+                                         GIT_DIFF_SKIP_BINARY_CHECK)
+        elif old_tree is not None:
+            diff = old_tree.diff_to_tree(flags=GIT_DIFF_SKIP_BINARY_CHECK)
+        elif new_tree is not None:
+            diff = new_tree.diff_to_tree(flags=GIT_DIFF_SKIP_BINARY_CHECK,
+                                         swap=True)
+        else:
+            return
+
+        prefix = path + '/' if path else ''
+        for delta in diff.deltas:
+            status = DIFF_STATUS.get(delta.status_char(), 'modified')
+            yield diff_to_dict(
+                prefix + (delta.new_file.path or delta.old_file.path),
+                status,
+                None if status == 'added' else
+                (delta.old_file.id.hex, delta.old_file.mode),
+                None if status == 'deleted' else
+                (delta.new_file.id.hex, delta.new_file.mode))
+
+    def _diff_side(self, commit, path):
+        r"""
+        Return the tree or the tree entry at the path on the given
+        commit, or None.
+        """
+        tree_hex = self.tree_hex(commit=commit)
+        if not path:
+            return self.repo[Oid(hex=tree_hex)]
+        entry = self.tree_entry(tree_hex, path)
+        if entry is not None and entry_type(entry.filemode) == 'tree':
+            return self.repo[entry.oid]
+        return entry
+
+    def resolve_commit(self, name):
+        r"""
+        Return the id of the commit a branch, a tag or a commit id
+        refers to, in that order of precedence.
+        """
+        for ref in ('refs/heads/%s' % name, 'refs/tags/%s' % name):
+            try:
+                target = self.repo.lookup_reference(ref).target
+            except Exception, e:
+                continue
+            break
+        else:
+            if not is_valid_hex(name):
+                raise InvalidParamException('No such commit: %s' % name)
+            target = Oid(hex=name)
+
+        try:
+            obj = self.repo[target]
+        except KeyError, e:
+            raise InvalidParamException('No such commit: %s' % name)
+        if obj.type == GIT_OBJ_TAG:
+            obj = obj.peel(GIT_OBJ_COMMIT)
+        if obj.type != GIT_OBJ_COMMIT:
+            raise InvalidParamException('Not a commit: %s' % name)
+        return obj.hex
+
+    def tree_hex(self, branch=None, tag=None, commit=None):
+        r"""
+        Return the sha1 of the root tree on the given branch/tag/commit.
+        """
         if branch:
-            entry = tree = self.branch_tree(branch)
+            target = self._ref_target('refs/heads/%s' % branch)
         elif tag:
-            entry = tree = self.tag_tree(tag)
+            target = self._ref_target('refs/tags/%s' % tag)
         elif commit:
-            entry = tree = self.commit_tree(commit)
+            if not is_valid_hex(commit):
+                raise InvalidParamException('hex is required')
+            target = commit
         else:
             raise InvalidParamException('branch or tag is required')
 
-        for filename in path.split('/'):
-            if filename == '':
-                continue
-            entry = None
-            for tree_entry in tree:
-                if tree_entry.name == filename:
-                    entry = tree_entry
-                    break
-            if entry is None:
-                return None
-            tree = self.repo[entry.oid]
+        tree_hex = self.cache.commits.get(target)
+        if tree_hex is None:
+            tree_hex = self.repo[Oid(hex=target)].tree.hex
+            self.cache.commits.set(target, tree_hex)
+        return tree_hex
 
-        return entry
+    def branch_target(self, name):
+        r"""
+        Return the commit id the branch points to.
+        """
+        return self._ref_target('refs/heads/%s' % name)
+
+    def tag_target(self, name):
+        r"""
+        Return the commit id the tag points to.
+        """
+        return self._ref_target('refs/tags/%s' % name)
+
+    def _ref_target(self, name):
+        try:
+            ref = self.repo.lookup_reference(name)
+        except Exception, e:
+            raise InvalidParamException(str(e))
+        return ref.target.hex
 
     def create_entry(self, branch, path, sha1, mode=None,
-                     author_name='', author_email='', comment=''):
+                     author_name='', author_email='', comment='',
+                     parent=None, retries=0, stats=None):
         r"""
         Create a new file at the given path and return the commit id.
+        If parent is given, the commit is only made on top of that
+        commit, otherwise ConflictException is raised. With retries,
+        the change is made again on top of the new head, up to that
+        many times, if the branch has moved without touching the path.
+        The number of retries is stored in the stats dict if given.
         """
+        return self._retry_on_conflict(
+            lambda head: self._create_entry(branch, path, sha1, mode,
+                                            author_name, author_email,
+                                            comment, head),
+            branch, [path], parent, retries, stats)
+
+    def _create_entry(self, branch, path, sha1, mode,
+                      author_name, author_email, comment, parent):
         if not is_valid_hex(sha1):
             raise InvalidParamException("sha1 is invalid")
 
@@ -142,92 +708,51 @@ class Git(object):
             raise InvalidParamException(
                 "No blob found for the given id: " + sha1)
 
-        branch_tree = self.branch_tree(branch)
+        head = self._branch_head(branch, parent)
+        branch_tree = self.commit_tree(head)
         committer = Signature(author_name, author_email)
 
         dirname, filename = parse_path(path)
         dirs = make_dir_paths(dirname)
 
-        new_tree_oid = None
-        new_tree_hex = None
-        for dir_path in dirs:
-            dir_tree = []
-            if dir_path == '/':
-                dir_tree = branch_tree
-            else:
-                entry = self.find_entry(dir_path, branch=branch)
-                if entry:
-                    dir_tree = self.repo[entry.oid]
-
-            new_entry = None
-            old_entry = None
-            for e in dir_tree:
-                if e.name == filename:
-                    old_entry = e
-                    break
-
-            if new_tree_oid:
-                new_entry = {
-                    'name': filename,
-                    'filemode': getattr(old_entry, 'filemode',
-                                        DEFAULT_MODE_TREE),
-                    'oid': new_tree_oid,
-                }
+        if mode is None:
+            if obj.type == GIT_OBJ_BLOB:
+                mode = DEFAULT_MODE_BLOB
+            elif obj.type == GIT_OBJ_TREE:
+                mode = DEFAULT_MODE_TREE
+
+        oid = Oid(hex=sha1)
+        dir_trees = self._dir_trees(branch_tree, dirs)
+        for dir_path, dir_tree in zip(dirs, dir_trees):
+            # start from the existing entries and only insert the one
+            # which changes
+            if dir_tree is None:
+                tb = self.repo.TreeBuilder()
             else:
-                if mode is None:
-                    if obj.type == GIT_OBJ_BLOB:
-                        mode = DEFAULT_MODE_BLOB
-                    elif obj.type == GIT_OBJ_TREE:
-                        mode = DEFAULT_MODE_TREE
-
-                new_entry = {
-                    'name': filename,
-                    'filemode': mode,
-                    'oid': Oid(hex=sha1),
-                }
-
-            tb = self.repo.TreeBuilder()
-
-            if old_entry:
-                for e in dir_tree:
-                    if e.name == old_entry.name:
-                        tb.insert(new_entry['name'],
-                                  new_entry['oid'],
-                                  new_entry['filemode'])
-                    else:
-                        tb.insert(e.name, e.oid, e.filemode)
-            else:
-                entries = [new_entry]
-                for e in dir_tree:
-                    entries.append({
-                        'name': e.name,
-                        'oid': e.oid,
-                        'filemode': e.filemode,
-                    })
-                for e in sorted(entries, key=lambda x: x['name']):
-                    tb.insert(e['name'], e['oid'], e['filemode'])
-
-            new_tree_oid = tb.write()
-            new_tree_hex = self.repo[new_tree_oid].hex
+                tb = self.repo.TreeBuilder(dir_tree)
+            tb.insert(filename, oid, mode)
+            oid = tb.write()
+            mode = DEFAULT_MODE_TREE
             # the last element is always an empty string
             filename = dir_path.split('/')[-2]
 
-        parent = self.repo.lookup_reference('refs/heads/%s' % branch)
-        commit = self.repo.create_commit(
-            'refs/heads/%s' % (branch),
-            committer,
-            committer,
-            comment,
-            new_tree_oid,
-            [parent.target],
-        )
-        return self.repo[commit].hex
+        return self._commit(branch, oid, committer, comment, head)
 
     def update_entry(self, branch, path, sha1, mode=None,
-                     author_name='', author_email='', comment=''):
+                     author_name='', author_email='', comment='',
+                     parent=None, retries=0, stats=None):
         r"""
         Update the file at the given path and return the commit id.
+        parent, retries and stats are the same as for create_entry.
         """
+        return self._retry_on_conflict(
+            lambda head: self._update_entry(branch, path, sha1, mode,
+                                            author_name, author_email,
+                                            comment, head),
+            branch, [path], parent, retries, stats)
+
+    def _update_entry(self, branch, path, sha1, mode,
+                      author_name, author_email, comment, parent):
         if not is_valid_hex(sha1):
             raise InvalidParamException("sha1 is invalid")
 
@@ -236,129 +761,320 @@ class Git(object):
         except KeyError, e:
             raise InvalidParamException("sha1 is invalid")
 
-        branch_tree = self.branch_tree(branch)
+        head = self._branch_head(branch, parent)
+        branch_tree = self.commit_tree(head)
         committer = Signature(author_name, author_email)
 
         dirname, filename = parse_path(path)
         dirs = make_dir_paths(dirname)
 
-        new_tree_oid = None
-        new_tree_hex = None
-        for dir_path in dirs:
-            dir_tree = branch_tree if dir_path == '/' \
-                else self.repo[self.find_entry(dir_path, branch=branch).oid]
-
-            new_entry = None
-            old_entry = None
-            for e in dir_tree:
-                if e.name == filename:
-                    old_entry = e
-                    break
+        oid = None
+        dir_trees = self._dir_trees(branch_tree, dirs)
+        for dir_path, dir_tree in zip(dirs, dir_trees):
+            if dir_tree is None:
+                raise InvalidParamException(
+                    'no entry for the given path')
 
+            tb = self.repo.TreeBuilder(dir_tree)
+            old_entry = tb.get(filename)
             if not old_entry:
                 raise InvalidParamException(
                     'no entry for the given path')
 
-            if new_tree_oid:
-                new_entry = {
-                    'name': filename,
-                    'filemode': old_entry.filemode,
-                    'oid': new_tree_oid,
-                }
+            if oid is None:
+                tb.insert(filename, Oid(hex=sha1),
+                          mode if mode else old_entry.filemode)
             else:
-                new_entry = {
-                    'name': filename,
-                    'filemode': mode if mode else old_entry.filemode,
-                    'oid': Oid(hex=sha1) if sha1 else old_entry.oid,
-                }
-
-            tb = self.repo.TreeBuilder()
-
-            for e in dir_tree:
-                if e.name == new_entry['name']:
-                    tb.insert(new_entry['name'],
-                              new_entry['oid'],
-                              new_entry['filemode'])
-                else:
-                    tb.insert(e.name, e.oid, e.filemode)
-
-            new_tree_oid = tb.write()
-            new_tree_hex = self.repo[new_tree_oid].hex
+                tb.insert(filename, oid, old_entry.filemode)
+            oid = tb.write()
             # the last element is an empty string
             filename = dir_path.split('/')[-2]
 
-        parent = self.repo.lookup_reference('refs/heads/%s' % branch)
-        commit = self.repo.create_commit(
-            'refs/heads/%s' % (branch),
-            committer,
-            committer,
-            comment,
-            new_tree_oid,
-            [parent.target],
-        )
-        return self.repo[commit].hex
+        return self._commit(branch, oid, committer, comment, head)
 
     def delete_entry(self, branch, path,
-                     author_name='', author_email='', comment=''):
+                     author_name='', author_email='', comment='',
+                     parent=None, retries=0, stats=None):
         r"""
         Delete the file for the given path and return the commit id.
+        parent, retries and stats are the same as for create_entry.
         """
-        branch_tree = self.branch_tree(branch)
+        return self._retry_on_conflict(
+            lambda head: self._delete_entry(branch, path,
+                                            author_name, author_email,
+                                            comment, head),
+            branch, [path], parent, retries, stats)
+
+    def _delete_entry(self, branch, path,
+                      author_name, author_email, comment, parent):
+        head = self._branch_head(branch, parent)
+        branch_tree = self.commit_tree(head)
         committer = Signature(author_name, author_email)
 
         dirname, filename = parse_path(path)
         dirs = make_dir_paths(dirname)
 
-        new_tree_oid = None
-        new_tree_hex = None
-        for dir_path in dirs:
-            dir_tree = branch_tree if dir_path == '/' \
-                else self.repo[self.find_entry(dir_path, branch=branch).oid]
-
-            new_entry = None
-            old_entry = None
-            for e in dir_tree:
-                if e.name == filename:
-                    old_entry = e
-                    break
+        oid = None
+        dir_trees = self._dir_trees(branch_tree, dirs)
+        for dir_path, dir_tree in zip(dirs, dir_trees):
+            if dir_tree is None:
+                raise InvalidParamException(
+                    'no entry for the given path')
 
+            tb = self.repo.TreeBuilder(dir_tree)
+            old_entry = tb.get(filename)
             if not old_entry:
                 raise InvalidParamException(
                     'no entry for the given path')
 
-            if new_tree_oid:
-                new_entry = {
-                    'name': filename,
-                    'filemode': old_entry.filemode,
-                    'oid': new_tree_oid,
-                }
-
-            tb = self.repo.TreeBuilder()
-
-            for e in dir_tree:
-                if e.name == filename:
-                    if new_entry:
-                        tb.insert(new_entry['name'],
-                                  new_entry['oid'],
-                                  new_entry['filemode'])
-                else:
-                    tb.insert(e.name, e.oid, e.filemode)
-
-            new_tree_oid = tb.write()
-            new_tree_hex = self.repo[new_tree_oid].hex
+            if oid is None:
+                tb.remove(filename)
+            else:
+                tb.insert(filename, oid, old_entry.filemode)
+            oid = tb.write()
             # the last element is an empty string
             filename = dir_path.split('/')[-2]
 
-        parent = self.repo.lookup_reference('refs/heads/%s' % branch)
+        return self._commit(branch, oid, committer, comment, head)
+
+    def apply_changes(self, branch, changes,
+                      author_name='', author_email='', comment='',
+                      parent=None, retries=0, stats=None):
+        r"""
+        Apply the list of changes to the branch in a single commit and
+        return the commit id. Each change is a dict with 'action'
+        ('create', 'update' or 'delete') and 'path', plus 'sha1' and
+        optionally 'mode' for create and update. parent, retries and
+        stats are the same as for create_entry.
+        """
+        if not changes:
+            raise InvalidParamException('changes are required')
+        if not isinstance(changes, list):
+            raise InvalidParamException('changes must be a list')
+
+        changed = {}
+        for change in changes:
+            if not isinstance(change, dict):
+                raise InvalidParamException('each change must be an object')
+            action = change.get('action')
+            if action not in ('create', 'update', 'delete'):
+                raise InvalidParamException(
+                    'unknown action: %s' % action)
+            path = change.get('path')
+            if not isinstance(path, basestring):
+                raise InvalidParamException('path is required')
+            if action != 'delete':
+                sha1 = change.get('sha1')
+                if not isinstance(sha1, basestring) or \
+                        not is_valid_hex(sha1):
+                    raise InvalidParamException("sha1 is invalid")
+                self._check_mode(change.get('mode'))
+                if self.odb.read_header(sha1) is None and \
+                        Oid(hex=sha1) not in self.repo:
+                    raise InvalidParamException(
+                        "No blob found for the given id: " + sha1)
+
+            names = [x for x in path.split('/') if x]
+            if not names:
+                raise InvalidParamException('path is required')
+            node = changed
+            for name in names[:-1]:
+                node = node.setdefault(name, {})
+                if not isinstance(node, dict):
+                    raise InvalidParamException(
+                        'conflicting changes for %s' % name)
+            leaf = node.setdefault(names[-1], [])
+            if not isinstance(leaf, list):
+                raise InvalidParamException(
+                    'conflicting changes for %s' % names[-1])
+            leaf.append(change)
+
+        def write(head):
+            self._branch_head(branch, head)
+            new_tree_oid = self._apply_to_tree(self.commit_tree(head),
+                                               changed)
+            committer = Signature(author_name, author_email)
+            return self._commit(branch, new_tree_oid, committer, comment,
+                                head)
+
+        return self._retry_on_conflict(
+            write, branch, [x['path'] for x in changes], parent,
+            retries, stats)
+
+    def _check_mode(self, mode):
+        r"""
+        Raise InvalidParamException unless the mode of a change is None or
+        one of the file modes git knows, as an integer or an octal string.
+        """
+        if mode is None:
+            return
+        if isinstance(mode, basestring):
+            try:
+                mode = int(mode, 8)
+            except ValueError:
+                pass
+        if isinstance(mode, (int, long)) and not isinstance(mode, bool) \
+                and mode in MODES:
+            return
+        raise InvalidParamException('mode is invalid')
+
+    def _retry_on_conflict(self, write, branch, paths, parent, retries,
+                           stats):
+        r"""
+        Call write with the commit to build on and, when the branch has
+        moved on in a way that leaves the paths untouched, call it again
+        on top of the new head up to the given number of times with a
+        randomized exponential backoff.
+        """
+        head = parent or self.branch_target(branch)
+        attempt = 0
+        while True:
+            try:
+                commit = write(head)
+                break
+            except ConflictException:
+                if attempt >= retries:
+                    raise
+                new_head = self.branch_target(branch)
+                for path in paths:
+                    if self._entry_id(path, head) != \
+                            self._entry_id(path, new_head):
+                        raise ConflictException(
+                            '%s has been modified since %s' % (path, head))
+                attempt += 1
+                time.sleep(random.uniform(0, min(
+                    RETRY_BACKOFF * 2 ** attempt, MAX_RETRY_BACKOFF)))
+                head = new_head
+
+        if stats is not None:
+            stats['retries'] = attempt
+        return commit
+
+    def _entry_id(self, path, commit):
+        entry = self.find_entry(path, commit=commit)
+        return entry and (entry.hex, entry.filemode)
+
+    def _branch_head(self, branch, parent=None):
+        r"""
+        Return the commit id the branch points to, making sure it is the
+        expected parent if one is given.
+        """
+        head = self.branch_target(branch)
+        if parent is not None and parent != head:
+            raise ConflictException(
+                "'%s' branch is at %s, not at %s" % (branch, head, parent))
+        return head
+
+    def _dir_trees(self, root, dirs):
+        r"""
+        Resolve the trees for the given directory paths (as returned by
+        make_dir_paths, deepest first) with a single walk down from the
+        root tree. The list returned is in the same order and holds None
+        for the directories which do not exist.
+        """
+        trees = [root]
+        tree = root
+        for dir_path in reversed(dirs[:-1]):
+            if tree is not None:
+                try:
+                    entry = tree[dir_path.split('/')[-2]]
+                except KeyError:
+                    entry = None
+                if entry is None or entry_type(entry.filemode) != 'tree':
+                    tree = None
+                else:
+                    tree = self.repo[entry.oid]
+            trees.insert(0, tree)
+        return trees
+
+    def _commit(self, branch, tree_oid, committer, comment, parent):
+        r"""
+        Commit the tree on top of the parent and move the branch to the
+        new commit unless the branch has moved since. Return the commit
+        id.
+        """
+        name = 'refs/heads/%s' % branch
+        ref = self.repo.lookup_reference(name)
+        if ref.target.hex != parent:
+            raise ConflictException(
+                "'%s' branch has moved to %s" % (branch, ref.target.hex))
+
         commit = self.repo.create_commit(
-            'refs/heads/%s' % (branch),
+            None,
             committer,
             committer,
             comment,
-            new_tree_oid,
-            [parent.target],
+            tree_oid,
+            [Oid(hex=parent)],
         )
-        return self.repo[commit].hex
+        # the target is checked again under the lock for the writers of
+        # this process, and libgit2 only updates the reference if it
+        # still points to the target read by lookup_reference for the
+        # other processes
+        with _ref_lock(os.path.realpath(self.repo.path), name):
+            ref = self.repo.lookup_reference(name)
+            if ref.target.hex != parent:
+                raise ConflictException(
+                    "'%s' branch has moved to %s" % (branch,
+                                                     ref.target.hex))
+            try:
+                ref.set_target(commit)
+            except GitError, e:
+                raise ConflictException(str(e))
+        return commit.hex
+
+    def _apply_to_tree(self, tree, changed):
+        r"""
+        Write a new tree with the given changes applied to the tree
+        (None for a new directory) and return its oid. Subtrees without
+        changes are shared with the original tree.
+        """
+        tb = self.repo.TreeBuilder(tree) if tree is not None \
+            else self.repo.TreeBuilder()
+
+        for name, change in changed.iteritems():
+            old_entry = tb.get(name)
+            if isinstance(change, dict):
+                subtree = None
+                if old_entry is not None:
+                    if old_entry.filemode != DEFAULT_MODE_TREE:
+                        raise InvalidParamException(
+                            '%s is not a directory' % name)
+                    subtree = self.repo[old_entry.oid]
+                tb.insert(name, self._apply_to_tree(subtree, change),
+                          DEFAULT_MODE_TREE)
+                continue
+
+            entry = old_entry and (old_entry.oid, old_entry.filemode)
+            for c in change:
+                if c['action'] != 'create' and entry is None:
+                    raise InvalidParamException(
+                        'no entry for the given path: %s' % c['path'])
+                if c['action'] == 'delete':
+                    entry = None
+                    continue
+                mode = c.get('mode')
+                if isinstance(mode, basestring):
+                    mode = int(mode, 8)
+                if mode is None and c['action'] == 'update':
+                    mode = entry[1]
+                if mode is None:
+                    mode = self._default_mode(c['sha1'])
+                entry = (Oid(hex=c['sha1']), mode)
+
+            if entry is None:
+                if old_entry is not None:
+                    tb.remove(name)
+            else:
+                tb.insert(name, entry[0], entry[1])
+
+        return tb.write()
+
+    def _default_mode(self, sha1):
+        header = self.read_header(sha1)
+        if header and header[0] == GIT_OBJ_TREE:
+            return DEFAULT_MODE_TREE
+        return DEFAULT_MODE_BLOB
 
     def create_tag(self, name, target):
         r"""
@@ -396,29 +1112,16 @@ class Git(object):
         r"""
         Return the root node of the branch.
         """
-        try:
-            ref = self.repo.lookup_reference('refs/heads/%s' % name)
-        except Exception, e:
-            raise InvalidParamException(str(e))
-        commit = self.repo[ref.target]
-        return commit.tree
+        return self.repo[Oid(hex=self.tree_hex(branch=name))]
 
     def tag_tree(self, name):
         r"""
         Return the root node of the tag.
         """
-        try:
-            ref = self.repo.lookup_reference('refs/tags/%s' % name)
-        except Exception, e:
-            raise InvalidParamException(str(e))
-        tag = self.repo[ref.target]
-        return tag.tree
+        return self.repo[Oid(hex=self.tree_hex(tag=name))]
 
     def commit_tree(self, hex_):
         r"""
         Return the root node of the commit.
         """
-        if not is_valid_hex(hex_):
-            raise InvalidParamException('hex is required')
-        commit = self.repo[Oid(hex=hex_)]
-        return commit.tree
+        return self.repo[Oid(hex=self.tree_hex(commit=hex_))]
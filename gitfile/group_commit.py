@@ -0,0 +1,187 @@
+import os
+import threading
+import time
+from gitfile.exceptions import GitFileException
+
+DEFAULT_MAX_BATCH = 100
+DEFAULT_MAX_LATENCY = 0.01
+DEFAULT_RETRIES = 3
+
+_queues = {}
+_queues_lock = threading.Lock()
+
+
+class PendingWrite(object):
+    r"""
+    A change waiting in a GroupCommitQueue and, once committed, its
+    result.
+    """
+
+    def __init__(self, change, author_name, author_email, comment,
+                 max_retries):
+        self.change = change
+        self.author_name = author_name
+        self.author_email = author_email
+        self.comment = comment
+        self.max_retries = max_retries
+        self.done = False
+        self.commit = None
+        self.retries = 0
+        self.error = None
+
+    def author(self):
+        return self.author_name, self.author_email
+
+    def result(self):
+        if self.error is not None:
+            raise self.error
+        return self.commit
+
+
+class GroupCommitQueue(object):
+    r"""
+    Serialize the writes to a branch and coalesce the single-file
+    changes of the same author submitted within max_latency seconds of
+    each other, up to max_batch of them, into one tree rebuild and one
+    commit.
+
+    There is no background thread: the first waiting caller becomes the
+    leader, collects a batch, commits it and hands over to the next
+    caller whose change is still pending.
+    """
+
+    def __init__(self, git, branch, max_batch=DEFAULT_MAX_BATCH,
+                 max_latency=DEFAULT_MAX_LATENCY):
+        self.git = git
+        self.branch = branch
+        self.max_batch = max_batch
+        self.max_latency = max_latency
+        self.batches = 0
+        self.writes = 0
+        self._pending = []
+        self._leader = False
+        self._cond = threading.Condition()
+        self._key = None
+
+    @classmethod
+    def for_branch(cls, git, branch, **options):
+        r"""
+        Return the queue shared in the process for the given branch of
+        the repository. The queue is dropped once it is idle.
+        """
+        # a repository replaced at the same path gets new queues
+        st = os.stat(git.repo.path)
+        key = (os.path.realpath(git.repo.path), st.st_dev, st.st_ino, branch)
+        with _queues_lock:
+            queue = _queues.get(key)
+            if queue is None:
+                queue = _queues[key] = cls(git, branch, **options)
+                queue._key = key
+            return queue
+
+    def submit(self, change, author_name='', author_email='', comment='',
+               retries=DEFAULT_RETRIES, stats=None):
+        r"""
+        Queue the change (a dict as accepted by Git.apply_changes), wait
+        until it has been committed and return the commit id. The batch
+        is retried on a moved branch as many times as the most retries
+        allowed by its writes. The number of retries is stored in the
+        stats dict if given.
+        """
+        write = PendingWrite(change, author_name, author_email, comment,
+                             retries)
+        with self._cond:
+            self._pending.append(write)
+            self._cond.notify_all()
+
+        while True:
+            with self._cond:
+                while not write.done and self._leader:
+                    self._cond.wait()
+                if write.done:
+                    break
+                self._leader = True
+            try:
+                self._commit_batch()
+            finally:
+                with self._cond:
+                    self._leader = False
+                    self._cond.notify_all()
+
+        self._release()
+        if stats is not None:
+            stats['retries'] = write.retries
+        return write.result()
+
+    def stats(self):
+        return {
+            'batches': self.batches,
+            'writes': self.writes,
+            'pending': len(self._pending),
+        }
+
+    def _release(self):
+        r"""
+        Drop the queue from the shared ones if nothing is pending. A
+        caller still holding it only gets its writes committed alone.
+        """
+        with _queues_lock:
+            with self._cond:
+                idle = not self._pending and not self._leader
+            if idle and _queues.get(self._key) is self:
+                del _queues[self._key]
+
+    def _commit_batch(self):
+        deadline = time.time() + self.max_latency
+        with self._cond:
+            while len(self._pending) < self.max_batch:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            # a commit has a single author, so writes by the others wait
+            # for the next batch
+            author = self._pending[0].author()
+            batch = [x for x in self._pending
+                     if x.author() == author][:self.max_batch]
+            taken = set(id(x) for x in batch)
+            self._pending = [x for x in self._pending if id(x) not in taken]
+
+        try:
+            self._apply(batch)
+        except GitFileException:
+            # commit the changes one by one so that only the invalid
+            # ones fail
+            for write in batch:
+                try:
+                    self._apply([write])
+                except Exception, e:
+                    write.error = e
+        except Exception, e:
+            for write in batch:
+                write.error = e
+
+        with self._cond:
+            for write in batch:
+                write.done = True
+            self.batches += 1
+            self.writes += len(batch)
+
+    def _apply(self, batch):
+        first = batch[0]
+        comments = []
+        for write in batch:
+            if write.comment and write.comment not in comments:
+                comments.append(write.comment)
+        stats = {}
+        commit = self.git.apply_changes(
+            self.branch,
+            [write.change for write in batch],
+            author_name=first.author_name,
+            author_email=first.author_email,
+            comment='\n'.join(comments),
+            retries=max(write.max_retries for write in batch),
+            stats=stats)
+        for write in batch:
+            write.commit = commit
+            write.retries = stats['retries']
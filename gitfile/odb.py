@@ -0,0 +1,806 @@
+import os
+import bisect
+import glob
+import hashlib
+import mmap
+import struct
+import tempfile
+import threading
+import zlib
+from pygit2 import GIT_OBJ_BLOB, GIT_OBJ_TREE, GIT_OBJ_COMMIT, GIT_OBJ_TAG
+
+OBJ_OFS_DELTA = 6
+OBJ_REF_DELTA = 7
+
+OBJ_TYPES = {
+    'commit': GIT_OBJ_COMMIT,
+    'tree': GIT_OBJ_TREE,
+    'blob': GIT_OBJ_BLOB,
+    'tag': GIT_OBJ_TAG,
+}
+
+OBJ_TYPE_NAMES = dict((v, k) for k, v in OBJ_TYPES.items())
+
+IDX_MAGIC = '\377tOc'
+HEADER_CHUNK_SIZE = 64
+CHUNK_SIZE = 64 * 1024
+
+# packs with whole objects only and smaller than SMALL_PACK_BYTES, such
+# as the ones PackWriter writes, are merged into one once there are
+# MAX_SMALL_PACKS of them
+MAX_SMALL_PACKS = 16
+SMALL_PACK_BYTES = 32 * 1024 * 1024
+
+_odbs = {}
+_odbs_lock = threading.Lock()
+
+
+def _file_identity(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_ino, st.st_size, st.st_mtime)
+
+
+def _read_varint(data, pos):
+    r"""
+    Read a size encoded in the delta header format and return it with
+    the position just after it.
+    """
+    value = shift = 0
+    while True:
+        c = ord(data[pos])
+        pos += 1
+        value |= (c & 0x7f) << shift
+        shift += 7
+        if not c & 0x80:
+            return value, pos
+
+
+def inflate_chunks(read, chunk_size=CHUNK_SIZE):
+    r"""
+    Inflate the zlib stream returned piece by piece by the given read
+    function and yield chunks of at most chunk_size bytes.
+    """
+    d = zlib.decompressobj()
+    while True:
+        data = read()
+        if not data:
+            break
+        while data:
+            chunk = d.decompress(data, chunk_size)
+            if not chunk and d.unconsumed_tail == data:
+                # the stream has ended (python 2 keeps what follows it
+                # in unconsumed_tail when max_length is given)
+                return
+            if chunk:
+                yield chunk
+            data = d.unconsumed_tail
+        if d.unused_data:
+            break
+    chunk = d.flush()
+    if chunk:
+        yield chunk
+
+
+class _Released(object):
+    r"""
+    Iterate the given chunks read from the acquired pack and release the
+    pack once they have been read, or when the iterable is closed or
+    dropped without being read.
+    """
+
+    def __init__(self, pack, chunks):
+        self.pack = pack
+        self.chunks = chunks
+
+    def __iter__(self):
+        try:
+            for chunk in self.chunks:
+                yield chunk
+        finally:
+            self.close()
+
+    def close(self):
+        pack, self.pack = self.pack, None
+        if pack is not None:
+            pack.release()
+
+    def __del__(self):
+        self.close()
+
+
+def slice_chunks(chunks, start=0, end=None):
+    r"""
+    Yield the part of the given chunks between the start and the end
+    offsets (the end is exclusive).
+    """
+    pos = 0
+    for chunk in chunks:
+        next_pos = pos + len(chunk)
+        if next_pos > start:
+            if end is not None and next_pos >= end:
+                yield chunk[max(start - pos, 0):end - pos]
+                return
+            yield chunk[max(start - pos, 0):]
+        pos = next_pos
+
+
+class PackIndex(object):
+    r"""
+    Look object ids up in a pack index (.idx) file of version 1 or 2.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.pack_path = path[:-4] + '.pack'
+        with open(path, 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.data[0:4] == IDX_MAGIC:
+            self.version = struct.unpack('>I', self.data[4:8])[0]
+            fanout = 8
+        else:
+            self.version = 1
+            fanout = 0
+        self.fanout = struct.unpack('>256I',
+                                    self.data[fanout:fanout + 1024])
+        self.count = self.fanout[255]
+        self.names = fanout + 1024
+        if self.version == 2:
+            self.offsets = self.names + self.count * 24
+            self.large_offsets = self.offsets + self.count * 4
+
+    def __len__(self):
+        return self.count
+
+    def name(self, i):
+        if self.version == 2:
+            pos = self.names + i * 20
+        else:
+            pos = self.names + i * 24 + 4
+        return self.data[pos:pos + 20]
+
+    def offset(self, i):
+        if self.version == 1:
+            pos = self.names + i * 24
+            return struct.unpack('>I', self.data[pos:pos + 4])[0]
+        pos = self.offsets + i * 4
+        offset = struct.unpack('>I', self.data[pos:pos + 4])[0]
+        if offset & 0x80000000:
+            pos = self.large_offsets + (offset & 0x7fffffff) * 8
+            offset = struct.unpack('>Q', self.data[pos:pos + 8])[0]
+        return offset
+
+    def find(self, sha):
+        r"""
+        Return the pack offset of the object for the given binary sha1
+        or None.
+        """
+        first = ord(sha[0])
+        lo = self.fanout[first - 1] if first else 0
+        hi = self.fanout[first]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            name = self.name(mid)
+            if name < sha:
+                lo = mid + 1
+            elif name > sha:
+                hi = mid
+            else:
+                return self.offset(mid)
+        return None
+
+    def close(self):
+        self.data.close()
+
+
+class Pack(object):
+    r"""
+    Read object headers from a pack file without inflating the objects.
+
+    A pack is acquired by its readers, so that closing it while it is
+    read only unmaps it once the last of them has released it.
+    """
+
+    def __init__(self, idx_path):
+        self.index = PackIndex(idx_path)
+        with open(self.index.pack_path, 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.identity = _file_identity(idx_path)
+        self._offsets = None
+        self._has_deltas = None
+        self._users = 0
+        self._closing = False
+        self._closed = False
+        self._lock = threading.Lock()
+
+    def entry_header(self, offset):
+        r"""
+        Return the type, the size and the data offset of the entry at
+        the given offset, along with the base of a delta entry.
+        """
+        data = self.data
+        c = ord(data[offset])
+        pos = offset + 1
+        type = (c >> 4) & 7
+        size = c & 15
+        shift = 4
+        while c & 0x80:
+            c = ord(data[pos])
+            pos += 1
+            size |= (c & 0x7f) << shift
+            shift += 7
+
+        base = None
+        if type == OBJ_OFS_DELTA:
+            c = ord(data[pos])
+            pos += 1
+            distance = c & 0x7f
+            while c & 0x80:
+                c = ord(data[pos])
+                pos += 1
+                distance = ((distance + 1) << 7) | (c & 0x7f)
+            base = offset - distance
+        elif type == OBJ_REF_DELTA:
+            base = data[pos:pos + 20]
+            pos += 20
+
+        return type, size, pos, base
+
+    def delta_size(self, pos):
+        r"""
+        Return the size of the object a delta at the given data offset
+        expands to, only inflating the delta header.
+        """
+        d = zlib.decompressobj()
+        header = ''
+        while len(header) < 20:
+            chunk = self.data[pos:pos + HEADER_CHUNK_SIZE]
+            pos += HEADER_CHUNK_SIZE
+            if not chunk:
+                break
+            header += d.decompress(chunk, 20 - len(header))
+            if d.unconsumed_tail or d.unused_data:
+                break
+        _, i = _read_varint(header, 0)
+        size, _ = _read_varint(header, i)
+        return size
+
+    def iter_data(self, pos, chunk_size=CHUNK_SIZE):
+        r"""
+        Yield the inflated data of the entry at the given data offset.
+        """
+        state = {'pos': pos}
+
+        def read():
+            data = self.data[state['pos']:state['pos'] + chunk_size]
+            state['pos'] += chunk_size
+            return data
+
+        return inflate_chunks(read, chunk_size)
+
+    def entry_end(self, offset):
+        r"""
+        Return the offset where the entry at the given offset ends, from
+        the offsets of all the entries, sorted the first time.
+        """
+        offsets = self._offsets
+        if offsets is None:
+            offsets = self._offsets = sorted(
+                self.index.offset(i) for i in xrange(len(self.index)))
+        i = bisect.bisect_right(offsets, offset)
+        if i < len(offsets):
+            return offsets[i]
+        # the pack ends with its checksum
+        return len(self.data) - 20
+
+    def has_deltas(self):
+        r"""
+        Return whether any entry of the pack is stored as a delta, from
+        the entry headers only.
+        """
+        if self._has_deltas is None:
+            self._has_deltas = any(
+                self.entry_header(self.index.offset(i))[3] is not None
+                for i in xrange(len(self.index)))
+        return self._has_deltas
+
+    def iter_raw(self, pos, end, chunk_size=CHUNK_SIZE):
+        r"""
+        Yield the data between the given offsets as it is stored.
+        """
+        while pos < end:
+            yield self.data[pos:min(pos + chunk_size, end)]
+            pos += chunk_size
+
+    def acquire(self):
+        r"""
+        Mark the pack as being read and return True, or False if it has
+        been closed.
+        """
+        with self._lock:
+            if self._closing:
+                return False
+            self._users += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self._users -= 1
+            if self._closing and not self._users:
+                self._unmap()
+
+    def close(self):
+        r"""
+        Close the pack now, or once its readers have released it.
+        """
+        with self._lock:
+            self._closing = True
+            if not self._users:
+                self._unmap()
+
+    def _unmap(self):
+        if not self._closed:
+            self._closed = True
+            self.index.close()
+            self.data.close()
+
+
+class PackWriter(object):
+    r"""
+    Write objects streamed one by one into a new pack file along with
+    its version 2 index, so that many objects can be stored at once
+    without creating a loose file for each of them.
+
+    The pack is written to a temporary file and only moved into place,
+    the index last, by finish().
+    """
+
+    def __init__(self, pack_dir, exists=None):
+        self.pack_dir = pack_dir
+        self.exists = exists or (lambda hex: False)
+        self.entries = {}
+        self.path = None
+        if not os.path.isdir(pack_dir):
+            os.makedirs(pack_dir)
+        fd, self._tmp_path = tempfile.mkstemp(dir=pack_dir,
+                                              prefix='tmp_pack_')
+        self._file = os.fdopen(fd, 'w+b')
+        # the number of objects is filled in by finish()
+        self._file.write('PACK' + struct.pack('>II', 2, 0))
+
+    def add(self, type, size, read, chunk_size=CHUNK_SIZE):
+        r"""
+        Write an object of the given type and size whose content is
+        returned piece by piece by read(n), and return its sha1. An
+        object already in the pack or for which exists() is true is
+        not kept.
+        """
+        f = self._file
+        offset = f.tell()
+        sha = hashlib.sha1('%s %d\0' % (OBJ_TYPE_NAMES[type], size))
+
+        c = (type << 4) | (size & 15)
+        rest = size >> 4
+        header = ''
+        while rest:
+            header += chr(c | 0x80)
+            c = rest & 0x7f
+            rest >>= 7
+        header += chr(c)
+        f.write(header)
+        crc = zlib.crc32(header)
+
+        z = zlib.compressobj()
+        remaining = size
+        while remaining:
+            chunk = read(min(chunk_size, remaining))
+            if not chunk:
+                raise EOFError('%d bytes missing' % remaining)
+            remaining -= len(chunk)
+            sha.update(chunk)
+            data = z.compress(chunk)
+            crc = zlib.crc32(data, crc)
+            f.write(data)
+        data = z.flush()
+        crc = zlib.crc32(data, crc)
+        f.write(data)
+
+        hex = sha.hexdigest()
+        if hex in self.entries or self.exists(hex):
+            f.seek(offset)
+            f.truncate()
+        else:
+            self.entries[hex] = (offset, crc & 0xffffffff)
+        return hex
+
+    def add_entry(self, hex, chunks):
+        r"""
+        Copy an entry of another pack, given as the chunks of its header
+        and compressed data, for the object for the given sha1. The entry
+        must not be a delta. It is not kept if the pack already has it.
+        """
+        if hex in self.entries:
+            return
+        f = self._file
+        offset = f.tell()
+        crc = 0
+        for chunk in chunks:
+            crc = zlib.crc32(chunk, crc)
+            f.write(chunk)
+        self.entries[hex] = (offset, crc & 0xffffffff)
+
+    def finish(self):
+        r"""
+        Complete the pack and its index and move them into the pack
+        directory. Return the path of the pack, or None if there was
+        nothing to write.
+        """
+        f = self._file
+        if not self.entries:
+            self.abort()
+            return None
+
+        f.seek(8)
+        f.write(struct.pack('>I', len(self.entries)))
+        f.seek(0)
+        sha = hashlib.sha1()
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            sha.update(chunk)
+        checksum = sha.digest()
+        f.seek(0, os.SEEK_END)
+        f.write(checksum)
+        f.close()
+
+        name = os.path.join(self.pack_dir,
+                            'pack-' + checksum.encode('hex'))
+        idx_tmp_path = self._tmp_path + '.idx'
+        self._write_index(idx_tmp_path, checksum)
+        os.chmod(self._tmp_path, 0o444)
+        os.chmod(idx_tmp_path, 0o444)
+        os.rename(self._tmp_path, name + '.pack')
+        os.rename(idx_tmp_path, name + '.idx')
+        self.path = name + '.pack'
+        return self.path
+
+    def abort(self):
+        self._file.close()
+        try:
+            os.unlink(self._tmp_path)
+        except OSError:
+            pass
+
+    def _write_index(self, path, pack_checksum):
+        names = sorted(self.entries)
+        fanout = [0] * 256
+        for hex in names:
+            fanout[int(hex[0:2], 16)] += 1
+        for i in range(1, 256):
+            fanout[i] += fanout[i - 1]
+
+        offsets = []
+        large_offsets = []
+        for hex in names:
+            offset = self.entries[hex][0]
+            if offset < 0x80000000:
+                offsets.append(offset)
+            else:
+                offsets.append(0x80000000 | len(large_offsets))
+                large_offsets.append(offset)
+
+        data = ''.join([
+            IDX_MAGIC,
+            struct.pack('>I', 2),
+            struct.pack('>256I', *fanout),
+            ''.join(hex.decode('hex') for hex in names),
+            ''.join(struct.pack('>I', self.entries[hex][1])
+                    for hex in names),
+            ''.join(struct.pack('>I', x) for x in offsets),
+            ''.join(struct.pack('>Q', x) for x in large_offsets),
+            pack_checksum,
+        ])
+        with open(path, 'wb') as f:
+            f.write(data)
+            f.write(hashlib.sha1(data).digest())
+
+
+class ObjectDatabase(object):
+    r"""
+    Read object headers (type and size) directly from the loose objects
+    and the packs of a repository, so that the size of an object can be
+    known without inflating its content.
+    """
+
+    def __init__(self, path):
+        self.path = os.path.join(path, 'objects')
+        self._packs = []
+        self._packs_identity = None
+        self._lock = threading.Lock()
+        self._merge_lock = threading.Lock()
+
+    @classmethod
+    def for_repo(cls, repo):
+        r"""
+        Return the object database shared by all Git objects for the
+        given pygit2 repository.
+        """
+        path = os.path.realpath(repo.path)
+        with _odbs_lock:
+            odb = _odbs.get(path)
+            if odb is None:
+                odb = _odbs[path] = cls(path)
+            return odb
+
+    @classmethod
+    def release(cls, repo):
+        r"""
+        Drop the object database shared for the given pygit2 repository
+        and close its packs. Objects still holding it reopen the packs
+        when they use it again.
+        """
+        path = os.path.realpath(repo.path)
+        with _odbs_lock:
+            odb = _odbs.pop(path, None)
+        if odb is not None:
+            odb.close()
+
+    def close(self):
+        with self._lock:
+            packs = self._packs
+            self._packs = []
+            self._packs_identity = None
+        for pack in packs:
+            pack.close()
+
+    def loose_path(self, hex):
+        return os.path.join(self.path, hex[0:2], hex[2:])
+
+    def read_header(self, hex):
+        r"""
+        Return the type and the size of the object for the given sha1,
+        or None if the object is not found.
+        """
+        found = self._find(hex.decode('hex'))
+        if found is not None:
+            pack, offset = found
+            try:
+                return self._packed_header(pack, offset)
+            finally:
+                pack.release()
+
+        header = self._loose_header(hex)
+        if header is None and self._refresh_packs():
+            return self.read_header(hex)
+        return header
+
+    def location(self, hex):
+        r"""
+        Return the index of the pack holding the object for the given
+        sha1 and its offset in the pack, or None if it is not packed.
+        """
+        packs = self.packs()
+        found = self._find(hex.decode('hex'), packs)
+        if found is None:
+            return None
+        pack, offset = found
+        pack.release()
+        return packs.index(pack), offset
+
+    def iter_content(self, hex, chunk_size=CHUNK_SIZE):
+        r"""
+        Return an iterator over the content of the object for the given
+        sha1 which inflates it chunk by chunk, or None if the object is
+        not found or is stored as a delta.
+        """
+        found = self._find(hex.decode('hex'))
+        if found is not None:
+            pack, offset = found
+            type, size, pos, base = pack.entry_header(offset)
+            if base is not None:
+                pack.release()
+                return None
+            return _Released(pack, pack.iter_data(pos, chunk_size))
+
+        # the file is only opened once the content is read, so that
+        # nothing is left open if it never is
+        if not os.path.exists(self.loose_path(hex)):
+            if self._refresh_packs():
+                return self.iter_content(hex, chunk_size)
+            return None
+        return self._iter_loose(hex, chunk_size)
+
+    def deflated_content(self, hex, chunk_size=CHUNK_SIZE):
+        r"""
+        Return the size of the zlib stream of the packed object for the
+        given sha1 and an iterator over the stream as it is stored, or
+        None if the object is not packed or is stored as a delta. Loose
+        objects have their header inside the stream, so they are never
+        returned.
+        """
+        found = self._find(hex.decode('hex'))
+        if found is None:
+            return None
+        pack, offset = found
+        type, size, pos, base = pack.entry_header(offset)
+        if base is not None:
+            pack.release()
+            return None
+        end = pack.entry_end(offset)
+        chunks = pack.iter_raw(pos, end, chunk_size)
+        return end - pos, _Released(pack, chunks)
+
+    def merge_small_packs(self, max_packs=MAX_SMALL_PACKS,
+                          max_bytes=SMALL_PACK_BYTES):
+        r"""
+        Merge the small packs holding whole objects only into a new pack
+        once there are max_packs of them, copying their entries without
+        inflating them, and remove them. Packs with a .keep file are left
+        alone. Return the path of the new pack, or None.
+        """
+        self._refresh_packs()
+        if not self._merge_lock.acquire(False):
+            # another thread is merging them
+            return None
+        acquired = [x for x in self.packs() if x.acquire()]
+        try:
+            packs = [x for x in acquired
+                     if len(x.data) <= max_bytes and
+                     not os.path.exists(x.index.pack_path[:-5] + '.keep') and
+                     not x.has_deltas()]
+            if len(packs) < max_packs:
+                return None
+            writer = PackWriter(os.path.join(self.path, 'pack'))
+            try:
+                for pack in packs:
+                    for i in xrange(len(pack.index)):
+                        offset = pack.index.offset(i)
+                        writer.add_entry(
+                            pack.index.name(i).encode('hex'),
+                            pack.iter_raw(offset, pack.entry_end(offset)))
+            except Exception:
+                writer.abort()
+                raise
+            path = writer.finish()
+            for pack in packs:
+                if pack.index.pack_path == path:
+                    continue
+                # the index goes first so that no reader finds an index
+                # without its pack
+                for old_path in [pack.index.path, pack.index.pack_path]:
+                    try:
+                        os.unlink(old_path)
+                    except OSError:
+                        pass
+            self._refresh_packs()
+            return path
+        finally:
+            for pack in acquired:
+                pack.release()
+            self._merge_lock.release()
+
+    def packs(self):
+        r"""
+        Return the list of the packs in the repository.
+        """
+        if self._packs_identity is None:
+            self._refresh_packs()
+        return self._packs
+
+    def _refresh_packs(self):
+        r"""
+        Reload the list of the packs if the pack directory has changed
+        and return whether it has.
+        """
+        pack_dir = os.path.join(self.path, 'pack')
+        try:
+            st = os.stat(pack_dir)
+            identity = (st.st_ino, st.st_mtime)
+        except OSError:
+            identity = ()
+
+        with self._lock:
+            if identity == self._packs_identity:
+                return False
+            # the packs which are still there are kept open
+            old_packs = dict((x.index.path, x) for x in self._packs)
+            packs = []
+            for idx_path in sorted(glob.glob(os.path.join(pack_dir,
+                                                          '*.idx'))):
+                pack = old_packs.get(idx_path)
+                if pack is not None and \
+                        pack.identity == _file_identity(idx_path):
+                    del old_packs[idx_path]
+                    packs.append(pack)
+                    continue
+                try:
+                    packs.append(Pack(idx_path))
+                except (IOError, OSError, ValueError):
+                    # the pack is being written
+                    continue
+            self._packs = packs
+            self._packs_identity = identity
+        for pack in old_packs.values():
+            pack.close()
+        return True
+
+    def _find(self, sha, packs=None):
+        r"""
+        Return the pack holding the object for the given binary sha1,
+        acquired for the caller to release, and the offset of the object,
+        or None.
+        """
+        for pack in packs if packs is not None else self.packs():
+            if not pack.acquire():
+                # closed since the list was taken
+                continue
+            offset = pack.index.find(sha)
+            if offset is not None:
+                return pack, offset
+            pack.release()
+        return None
+
+    def _packed_header(self, pack, offset):
+        type, size, pos, base = pack.entry_header(offset)
+        if type == OBJ_OFS_DELTA:
+            size = pack.delta_size(pos)
+            while type == OBJ_OFS_DELTA:
+                type, _, _, base = pack.entry_header(base)
+            if type == OBJ_REF_DELTA:
+                header = self.read_header(base.encode('hex'))
+                type = header and header[0]
+        elif type == OBJ_REF_DELTA:
+            size = pack.delta_size(pos)
+            header = self.read_header(base.encode('hex'))
+            type = header and header[0]
+        if not type:
+            return None
+        return type, size
+
+    def _iter_loose(self, hex, chunk_size):
+        try:
+            f = open(self.loose_path(hex), 'rb')
+        except IOError:
+            # packed and pruned since it was found
+            self._refresh_packs()
+            chunks = self.iter_content(hex, chunk_size)
+            if chunks is None:
+                raise
+            for chunk in chunks:
+                yield chunk
+            return
+
+        with f:
+            header = ''
+            for chunk in inflate_chunks(lambda: f.read(chunk_size),
+                                        chunk_size):
+                if header is not None:
+                    # skip the "<type> <size>\0" header
+                    header += chunk
+                    if '\0' not in header:
+                        continue
+                    chunk = header.split('\0', 1)[1]
+                    header = None
+                if chunk:
+                    yield chunk
+
+    def _loose_header(self, hex):
+        try:
+            f = open(self.loose_path(hex), 'rb')
+        except IOError:
+            return None
+
+        with f:
+            d = zlib.decompressobj()
+            header = ''
+            while '\0' not in header:
+                chunk = f.read(HEADER_CHUNK_SIZE)
+                if not chunk:
+                    return None
+                header += d.decompress(d.unconsumed_tail + chunk,
+                                       HEADER_CHUNK_SIZE)
+        type, size = header.split('\0', 1)[0].split(' ')
+        return OBJ_TYPES[type], int(size)
@@ -0,0 +1,74 @@
+import os
+from gitfile.cache import LRUCache
+from gitfile.git import Git
+
+DEFAULT_POOL_SIZE = 32
+
+
+class GitPool(object):
+    r"""
+    Keep a bounded number of open Git objects keyed by repository name
+    so that a repository is not reopened for each request.
+    """
+
+    def __init__(self, base_path, max_size=DEFAULT_POOL_SIZE):
+        self.base_path = base_path
+        self.invalidations = 0
+        self._cache = LRUCache(max_size, on_evict=self._close)
+
+    def get(self, repo):
+        r"""
+        Return the Git object for the given repository name or None if
+        there is no such repository.
+        """
+        cached = self._cache.get(repo)
+        if cached:
+            gitdir, identity, git = cached
+            if self._identity(gitdir) == identity:
+                return git
+            # the directory is gone or has been replaced
+            self._close(repo, self._cache.pop(repo))
+            self.invalidations += 1
+
+        gitdir = self.find_git_dir(repo)
+        if not gitdir:
+            return None
+        identity = self._identity(gitdir)
+        git = Git(gitdir)
+        self._cache.set(repo, (gitdir, identity, git))
+        return git
+
+    def invalidate(self, repo):
+        r"""
+        Drop the Git object for the given repository name.
+        """
+        cached = self._cache.pop(repo)
+        if cached is not None:
+            self._close(repo, cached)
+            self.invalidations += 1
+
+    def find_git_dir(self, repo):
+        path = os.path.join(self.base_path, repo)
+        for dir in [path, path + '.git']:
+            if os.path.isdir(dir):
+                return dir
+        return
+
+    def stats(self):
+        r"""
+        Return the hit/miss/eviction counters of the pool.
+        """
+        stats = self._cache.stats()
+        stats['invalidations'] = self.invalidations
+        return stats
+
+    def _close(self, repo, cached):
+        if cached is not None:
+            cached[2].close()
+
+    def _identity(self, gitdir):
+        try:
+            st = os.stat(gitdir)
+        except OSError:
+            return None
+        return (st.st_dev, st.st_ino)
@@ -0,0 +1,161 @@
+from bisect import bisect_left, bisect_right
+import os
+import threading
+import time
+
+# levels of symbolic refs followed before giving up
+MAX_SYMREF_DEPTH = 5
+
+# seconds within which a change may leave the mtimes as they were, as
+# file systems keep them with a coarse granularity
+RACY_WINDOW = 1.0
+
+_ref_indexes = {}
+_ref_indexes_lock = threading.Lock()
+
+
+class RefIndex(object):
+    r"""
+    Keep a sorted snapshot of the refs of a repository, read directly
+    from packed-refs and the loose ref files, so that the refs under a
+    prefix can be listed without looking every ref up.
+
+    The snapshot is reloaded when packed-refs or one of the directories
+    under refs/ changes: git replaces ref files by renaming them, which
+    updates the mtime of their directory. A snapshot loaded less than
+    RACY_WINDOW seconds after the newest of those mtimes is not trusted
+    (like a racily clean index in git), since a change in the same tick
+    would not show.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.reloads = 0
+        self._names = []
+        self._targets = {}
+        self._dirs = []
+        self._identity = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def for_repo(cls, repo):
+        r"""
+        Return the index shared by all Git objects for the given pygit2
+        repository.
+        """
+        path = os.path.realpath(repo.path)
+        with _ref_indexes_lock:
+            index = _ref_indexes.get(path)
+            if index is None:
+                index = _ref_indexes[path] = cls(path)
+            return index
+
+    def iter_refs(self, prefix='refs/', after=None):
+        r"""
+        Yield the name and the target sha1 of the refs whose names start
+        with the given prefix, in name order. With after, only the refs
+        whose names come after it are yielded.
+        """
+        names, targets = self.snapshot()
+        i = bisect_left(names, prefix)
+        if after is not None:
+            i = max(i, bisect_right(names, after))
+        while i < len(names) and names[i].startswith(prefix):
+            yield names[i], targets[names[i]]
+            i += 1
+
+    def snapshot(self):
+        r"""
+        Return the sorted ref names and a dict of their targets, reloading
+        them first if the refs have changed on disk.
+        """
+        identity = self._identity_of(self._dirs)
+        with self._lock:
+            if identity != self._identity:
+                self._load()
+            return self._names, self._targets
+
+    def _identity_of(self, dirs):
+        identity = [self._stat(os.path.join(self.path, 'packed-refs'))]
+        for dir_path in dirs:
+            identity.append(self._stat(dir_path))
+        return identity
+
+    def _stat(self, path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return (st.st_ino, st.st_mtime, st.st_size)
+
+    def _load(self):
+        # everything is stat'ed before it is read so that a change made
+        # while loading is seen by the next lookup
+        loaded_at = time.time()
+        identity = [self._stat(os.path.join(self.path, 'packed-refs'))]
+        targets = self._read_packed_refs()
+        symrefs = {}
+        dirs = []
+
+        pending = [os.path.join(self.path, 'refs')]
+        while pending:
+            dir_path = pending.pop()
+            identity.append(self._stat(dir_path))
+            dirs.append(dir_path)
+            try:
+                names = os.listdir(dir_path)
+            except OSError:
+                continue
+            for name in names:
+                path = os.path.join(dir_path, name)
+                if os.path.isdir(path):
+                    pending.append(path)
+                elif not name.endswith('.lock'):
+                    self._read_loose_ref(path, targets, symrefs)
+
+        for name, target in symrefs.items():
+            for _ in range(MAX_SYMREF_DEPTH):
+                if target not in symrefs:
+                    break
+                target = symrefs[target]
+            if target in targets:
+                targets[name] = targets[target]
+
+        self._names = sorted(targets)
+        self._targets = targets
+        self._dirs = dirs
+        self._identity = identity
+        mtimes = [x[1] for x in identity if x is not None]
+        if mtimes and loaded_at - max(mtimes) < RACY_WINDOW:
+            self._identity = None
+        self.reloads += 1
+
+    def _read_packed_refs(self):
+        targets = {}
+        try:
+            f = open(os.path.join(self.path, 'packed-refs'), 'rb')
+        except IOError:
+            return targets
+        with f:
+            for line in f:
+                # skip the header and the peeled targets of tags
+                if line.startswith('#') or line.startswith('^'):
+                    continue
+                parts = line.rstrip('\n').split(' ', 1)
+                if len(parts) == 2:
+                    targets[parts[1]] = parts[0]
+        return targets
+
+    def _read_loose_ref(self, path, targets, symrefs):
+        try:
+            with open(path, 'rb') as f:
+                content = f.read().strip()
+        except IOError:
+            # the ref has just been deleted
+            return
+        name = os.path.relpath(path, self.path).replace(os.sep, '/')
+        if content.startswith('ref: '):
+            symrefs[name] = content[5:]
+        elif content:
+            # a loose ref takes precedence over its packed version
+            targets[name] = content
@@ -1,29 +1,59 @@
 from gitfile.git import *
 from gitfile.utils import *
 from gitfile.exceptions import *
+from gitfile.archive import ArchiveCache, ARCHIVE_FORMATS, \
+    DEFAULT_ARCHIVE_CACHE_BYTES, iter_archive
+from gitfile.encoder import LazyObject, COMPACT_SEPARATORS
+from gitfile.odb import OBJ_TYPE_NAMES
+from gitfile.group_commit import GroupCommitQueue, DEFAULT_MAX_BATCH, \
+    DEFAULT_MAX_LATENCY
+from werkzeug.wrappers import Response
+from werkzeug.http import parse_range_header
+from werkzeug.wsgi import wrap_file
 import werkzeug.exceptions as ex
+import itertools
 import json
+import os
+
+
+def batch_header(sha1, status, **fields):
+    r"""
+    Return the JSON line put before an object in a batch response.
+    """
+    fields.update(sha1=sha1, status=status)
+    return json.dumps(fields, sort_keys=True,
+                      separators=COMPACT_SEPARATORS) + '\n'
 
 
 class RESTHandler(object):
     @classmethod
-    def get_noun_handler(self, git, request, noun):
+    def get_noun_handler(self, git, request, noun, options=None):
         try:
             noun_class = globals()[noun.capitalize()]
         except KeyError:
             raise ex.NotFound('Unsupported noun: %s' %
                               noun.capitalize())
-        return noun_class(git, request)
+        return noun_class(git, request, options)
 
 
 class NounHandler(object):
-    def __init__(self, git, request):
+    def __init__(self, git, request, options=None):
         self.git = git
         self.request = request
+        self.options = options or {}
+        self.etag = None
+        self.weak_etag = False
+        self.immutable = False
+        self.vary = set()
+        # the status of a successful response if not the default for the
+        # method (e.g. a POST which creates nothing)
+        self.status = None
 
     def handle(self, path):
         branch_or_tag_or_sha1 = path.pop(0) if len(path) else None
-        method_name = 'handle_' + self.request.method.lower()
+        # HEAD is answered like GET, the body is left out by werkzeug
+        method_name = 'handle_' + {'head': 'get'}.get(
+            self.request.method.lower(), self.request.method.lower())
         if len(path):
             method_name = method_name + '_file'
 
@@ -34,47 +64,504 @@ class NounHandler(object):
 
         return method(branch_or_tag_or_sha1, path)
 
+    def check_etag(self, etag, immutable=False):
+        r"""
+        Set the ETag of the resource and return a 304 response if the
+        client already has it, or None.
+        """
+        self.etag = etag
+        self.immutable = immutable
+        if self.request.if_none_match.contains_weak(etag):
+            # answered with the ETag the client has
+            self.weak_etag = not self.request.if_none_match.contains(etag)
+            response = Response(status=304)
+            self.add_cache_headers(response)
+            return response
+        return None
+
+    def json_object(self):
+        r"""
+        Return the JSON object in the request body. A body which is not an
+        object is rejected with 400.
+        """
+        param = json.loads(self.request.data)
+        if not isinstance(param, dict):
+            raise ex.BadRequest('request body must be a JSON object')
+        return param
+
+    def resource_etag(self, sha1, paths):
+        r"""
+        Return the ETag of the resource for the given path on the given
+        commit. The format chosen from the Accept header is part of it.
+        """
+        etag = sha1
+        if paths:
+            etag += ':' + '/'.join(paths)
+        if self.request.query_string:
+            etag += '?' + self.request.query_string
+        if 'format' not in self.request.args:
+            self.vary.add('Accept')
+            if self.wants_ndjson():
+                etag += ';ndjson'
+        return etag
+
+    def wants_ndjson(self):
+        r"""
+        Return whether a listing is to be returned as NDJSON, from the
+        'format' parameter or the Accept header.
+        """
+        if 'format' in self.request.args:
+            return self.request.args['format'] == 'ndjson'
+        return self.request.accept_mimetypes.best_match(
+            ['application/json', 'application/x-ndjson']) == \
+            'application/x-ndjson'
+
+    def add_cache_headers(self, response):
+        r"""
+        Add the Vary, ETag and Cache-Control headers to the response. The
+        ETag of a compressed body is weak, as its bytes differ from the
+        ones of the other content codings.
+        """
+        for header in sorted(self.vary):
+            response.vary.add(header)
+        if self.etag is None:
+            return
+        response.set_etag(self.etag, weak=self.weak_etag or
+                          'Content-Encoding' in response.headers)
+        if self.immutable:
+            response.headers['Cache-Control'] = \
+                'public, max-age=31536000, immutable'
+        else:
+            response.headers['Cache-Control'] = 'no-cache'
+
+    def commit_change(self, method, param, branch, *args, **kwargs):
+        r"""
+        Call the Git write method on top of the parent commit expected
+        by the If-Match header or the 'parent' parameter, turning a
+        conflict into 412 or 409 respectively. Unless a parent is
+        expected, the change is retried on a moved branch as many times
+        as the 'retries' parameter (or the write_retries option) allows,
+        up to the write_retries_max option. Return the result with the
+        commit id and the number of retries.
+        """
+        parent = self.if_match_commit(branch)
+        precondition = parent is not None
+        retries = 0
+        if not precondition:
+            parent = param.get('parent')
+            if not parent:
+                retries = self.requested_retries(param)
+        stats = {}
+        try:
+            commit_hex = method(branch, *args, parent=parent,
+                                retries=retries, stats=stats, **kwargs)
+        except ConflictException, e:
+            if precondition:
+                raise ex.PreconditionFailed(str(e))
+            raise ex.Conflict(str(e))
+        except InvalidParamException, e:
+            raise ex.BadRequest(str(e))
+        return {'sha1': commit_hex, 'retries': stats['retries']}
+
+    def requested_retries(self, param):
+        r"""
+        Return the number of retries asked by the 'retries' parameter or
+        the write_retries option, capped by the write_retries_max option.
+        """
+        retries = param.get('retries', self.options.get('write_retries', 0))
+        if isinstance(retries, bool) or \
+                not isinstance(retries, (int, long, basestring)):
+            raise ex.BadRequest('retries must be a non-negative integer')
+        try:
+            retries = int(retries)
+        except ValueError:
+            raise ex.BadRequest('retries must be a non-negative integer')
+        if retries < 0:
+            raise ex.BadRequest('retries must be a non-negative integer')
+        return min(retries, self.options.get('write_retries_max',
+                                             MAX_WRITE_RETRIES))
+
+    def queue_change(self, branch, change, param):
+        r"""
+        Commit the change through the group commit queue of the branch
+        if the group_commit option is on and the request does not expect
+        a parent commit. Return the result or None.
+        """
+        if not self.options.get('group_commit') or \
+                param.get('parent') or self.if_match_commit(branch):
+            return None
+
+        queue = GroupCommitQueue.for_branch(
+            self.git, branch,
+            max_batch=self.options.get('group_commit_max_batch',
+                                       DEFAULT_MAX_BATCH),
+            max_latency=self.options.get('group_commit_max_latency',
+                                         DEFAULT_MAX_LATENCY))
+        stats = {}
+        try:
+            commit_hex = queue.submit(change,
+                                      author_name=param.get('author_name'),
+                                      author_email=param.get('author_email'),
+                                      comment=param.get('comment', ''),
+                                      retries=self.requested_retries(param),
+                                      stats=stats)
+        except ConflictException, e:
+            raise ex.Conflict(str(e))
+        except InvalidParamException, e:
+            raise ex.BadRequest(str(e))
+        return {'sha1': commit_hex, 'retries': stats['retries']}
+
+    def if_match_commit(self, branch):
+        r"""
+        Return the commit id in the ETags of the If-Match header. When
+        several commits are listed, the one the branch is on is returned
+        if any, so that the request succeeds if any of them matches.
+        """
+        etags = self.request.if_match.as_set(include_weak=True)
+        if not etags:
+            return None
+        commits = set(x.split(';')[0].split('?')[0].split(':')[0]
+                      for x in etags)
+        if len(commits) > 1:
+            try:
+                head = self.git.resolve_commit(branch)
+            except InvalidParamException:
+                head = None
+            if head in commits:
+                return head
+        return sorted(commits)[0]
+
+    def blob_response(self, sha1):
+        r"""
+        Return a response streaming the content of the blob, or the
+        part of it requested by a Range header.
+        """
+        header = self.git.read_header(sha1)
+        if header is None or header[0] != GIT_OBJ_BLOB:
+            raise ex.NotFound('No blob found for the given id: ' + sha1)
+        size = header[1]
+
+        headers = {'Accept-Ranges': 'bytes'}
+        status = 200
+        start, end = 0, size
+
+        byte_range = self.requested_range(sha1)
+        if byte_range:
+            if len(byte_range.ranges) == 1 and \
+                    byte_range.range_for_length(size) is None:
+                headers['Content-Range'] = 'bytes */%d' % size
+                return Response('', status=416, headers=headers)
+            if len(byte_range.ranges) == 1:
+                start, end = byte_range.range_for_length(size)
+                headers['Content-Range'] = 'bytes %d-%d/%d' % (
+                    start, end - 1, size)
+                status = 206
+
+        if self.options.get('deflate_blobs'):
+            headers['Vary'] = 'Accept-Encoding'
+            if status == 200:
+                deflated = self.deflated_content(sha1, size)
+                if deflated:
+                    headers['Content-Encoding'] = 'deflate'
+                    headers['Content-Length'] = str(deflated[0])
+                    return Response(deflated[1],
+                                    headers=headers,
+                                    mimetype='application/octet-stream',
+                                    direct_passthrough=True)
+
+        headers['Content-Length'] = str(end - start)
+        return Response(self.git.iter_content(sha1, start, end),
+                        status=status,
+                        headers=headers,
+                        mimetype='application/octet-stream',
+                        direct_passthrough=True)
+
+    def deflated_content(self, sha1, size):
+        r"""
+        Return the size and the chunks of the zlib stream the blob is
+        stored as if the client accepts the deflate coding and the blob
+        is big enough to be compressed, or None.
+        """
+        min_size = self.options.get('compress_min_size')
+        if min_size is None or size < min_size or \
+                not self.request.accept_encodings['deflate']:
+            return None
+        return self.git.deflated_content(sha1)
+
+    def wants_raw(self):
+        return self.request.args.get('raw') in ('1', 'true')
+
+    def raw_response(self, sha1, paths, immutable=False):
+        r"""
+        Return a response streaming the content of the file at the given
+        path on the given commit, with the blob id as its ETag.
+        """
+        entry = self.git.find_entry('/'.join(paths), commit=sha1)
+        if entry is None:
+            raise ex.NotFound('File does not exist: ' + '/'.join(paths))
+        if entry_type(entry.filemode) != 'blob':
+            raise ex.BadRequest('Not a file: ' + '/'.join(paths))
+        return self.check_etag(entry.hex, immutable=immutable) or \
+            self.blob_response(entry.hex)
+
+    def page(self, items, key):
+        r"""
+        Take the page of the items requested by the 'limit' parameter
+        from the given iterator. Return the items and the cursor to pass
+        to get the next page, or None for the last page. Without a limit,
+        the iterator is returned as is so that it can be streamed.
+        """
+        limit = self.request.args.get('limit')
+        if limit is None:
+            return items, None
+        limit = int(limit)
+        if limit < 1:
+            raise ValueError('limit must be positive')
+        items = list(itertools.islice(items, limit + 1))
+        if len(items) <= limit:
+            return items, None
+        return items[:limit], key(items[limit - 1])
+
+    def list_refs(self, type):
+        r"""
+        Return the branches or the tags filtered and paginated by the
+        'prefix', 'cursor' and 'limit' parameters.
+        """
+        refs, cursor = self.page(
+            self.git.iter_refs(type,
+                               prefix=self.request.args.get('prefix', ''),
+                               after=self.request.args.get('cursor')),
+            key=lambda x: x[0])
+        result = {'entries': LazyObject(refs)}
+        if cursor is not None:
+            result['next_cursor'] = cursor
+        return result
+
+    def list_tree(self, result, tree_hex):
+        r"""
+        Add the entries of the tree to the result, filtered and paginated
+        by the 'prefix', 'cursor' and 'limit' parameters. Return the
+        result.
+        """
+        args = self.request.args
+        if args.get('format') in ARCHIVE_FORMATS:
+            return self.archive_response(tree_hex, result['name'],
+                                         args['format'])
+        if args.get('recursive') in ('1', 'true'):
+            return self.list_tree_recursive(result, tree_hex)
+
+        if 'prefix' in args or 'cursor' in args or 'limit' in args:
+            entries = self.git.iter_tree_entries(
+                tree_hex, prefix=args.get('prefix', ''),
+                after=args.get('cursor'))
+        else:
+            entries = iter(self.git.tree_entries(tree_hex))
+        entries, cursor = self.page(entries, key=entry_key)
+        result['entries'] = (entry_to_dict(x, self.git.repo)
+                             for x in entries)
+        if cursor is not None:
+            result['next_cursor'] = cursor
+        return result
+
+    def archive_response(self, tree_hex, name, format):
+        r"""
+        Return a response streaming the archive of the tree in the given
+        format, from the archive cache of the repository if it is there.
+        """
+        max_bytes = self.options.get('archive_cache_bytes',
+                                     DEFAULT_ARCHIVE_CACHE_BYTES)
+        headers = {
+            'Content-Disposition': 'attachment; filename="%s.%s"' % (
+                name.replace('/', '-').replace('"', ''), format),
+        }
+        cache = None
+        if max_bytes:
+            try:
+                cache = ArchiveCache.for_repo(
+                    self.git.repo, max_bytes=max_bytes,
+                    cache_dir=self.options.get('archive_cache_dir'))
+            except (IOError, OSError):
+                # the default cache directory is not safe to use
+                pass
+        if cache is None:
+            body = iter_archive(self.git, tree_hex, format)
+        else:
+            f = cache.open(tree_hex, format)
+            if f is None:
+                body = cache.store(
+                    tree_hex, format,
+                    lambda: iter_archive(self.git, tree_hex, format))
+            else:
+                headers['Content-Length'] = str(os.fstat(f.fileno()).st_size)
+                body = wrap_file(self.request.environ, f)
+        return Response(body, mimetype=ARCHIVE_FORMATS[format],
+                        headers=headers, direct_passthrough=True)
+
+    def list_tree_recursive(self, result, tree_hex):
+        r"""
+        Add everything under the tree to the result with its path, down
+        to the level given by the 'depth' parameter.
+        """
+        args = self.request.args
+        depth = args.get('depth')
+        if depth is not None:
+            depth = int(depth)
+            if depth < 1:
+                raise ValueError('depth must be positive')
+
+        def path_key(item):
+            path, entry = item
+            return path + entry_key(entry)[len(entry.name):]
+
+        entries, cursor = self.page(
+            self.git.walk_tree(tree_hex, depth=depth,
+                               prefix=args.get('prefix', ''),
+                               after=args.get('cursor')),
+            key=path_key)
+        result['entries'] = (dict(entry_to_dict(entry, self.git.repo),
+                                  path=path)
+                             for path, entry in entries)
+        if cursor is not None:
+            result['next_cursor'] = cursor
+        return result
+
+    def requested_range(self, etag):
+        r"""
+        Return the parsed Range header unless an If-Range header asks
+        for a different version of the resource.
+        """
+        if_range = self.request.headers.get('If-Range')
+        if if_range and if_range.strip() != '"%s"' % etag:
+            return None
+        byte_range = parse_range_header(self.request.headers.get('Range'))
+        if byte_range is None or byte_range.units != 'bytes':
+            return None
+        return byte_range
+
 
 class Blobs(NounHandler):
     def handle_get(self, sha1, *args):
-        content = self.git.get_content(sha1)
-        if content is None:
-            raise ex.NotFound('No blob found for the given id: ' + sha1)
-        return content
+        return self.check_etag(sha1, immutable=True) or \
+            self.blob_response(sha1)
+
+    def handle_post(self, name, paths):
+        if name == 'batch':
+            return self.handle_post_batch()
+        if name == 'exists':
+            return self.handle_post_exists()
+        if name == 'upload':
+            return self.handle_post_upload()
+        if name is not None:
+            raise ex.NotFound('Unsupported operation')
 
-    def handle_post(self, *args):
-        sha1 = self.git.create_content(self.request.data)
+        limit = self.options.get('max_blob_size')
+        if limit is not None and \
+                (self.request.content_length or 0) > limit:
+            raise ex.RequestEntityTooLarge(
+                'Blob exceeds the limit of %d bytes' % limit)
+        try:
+            sha1 = self.git.create_content_from_stream(self.request.stream,
+                                                       limit=limit)
+        except ContentTooLargeException, e:
+            raise ex.RequestEntityTooLarge(str(e))
         return {'sha1': sha1}
 
+    def handle_post_batch(self):
+        r"""
+        Stream the blobs for the list of sha1s in the request, in the
+        order they are stored. Each blob is preceded by a JSON line with
+        its sha1, a status and its size, and the status is 404 without
+        content for an id which is not a blob.
+        """
+        param = self.json_object()
+        sha1s = param.get('sha1s')
+        if not isinstance(sha1s, list):
+            raise ex.BadRequest('sha1s is required')
+        invalid = [x for x in sha1s if not is_valid_hex(x)]
+        valid = self.git.storage_order(x for x in sha1s if is_valid_hex(x))
+
+        def generate():
+            for sha1 in invalid:
+                yield batch_header(sha1, 400)
+            for sha1 in valid:
+                header = self.git.read_header(sha1)
+                if header is None or header[0] != GIT_OBJ_BLOB:
+                    yield batch_header(sha1, 404)
+                    continue
+                yield batch_header(sha1, 200, size=header[1])
+                for chunk in self.git.iter_content(sha1):
+                    yield chunk
+
+        return Response(generate(), mimetype='application/octet-stream',
+                        direct_passthrough=True)
+
+    def handle_post_upload(self):
+        r"""
+        Create the blobs streamed in the request body, each preceded by a
+        line with its size, in a single pack and return their sha1s.
+        """
+        try:
+            sha1s = self.git.create_contents_from_stream(
+                self.request.stream, limit=self.options.get('max_blob_size'))
+        except ContentTooLargeException, e:
+            raise ex.RequestEntityTooLarge(str(e))
+        except InvalidParamException, e:
+            raise ex.BadRequest(str(e))
+        return {'sha1s': sha1s}
+
+    def handle_post_exists(self):
+        r"""
+        Return the type and the size of the objects which exist among the
+        list of sha1s in the request, read from the object headers, and
+        the list of those which do not.
+        """
+        param = self.json_object()
+        sha1s = param.get('sha1s')
+        if not isinstance(sha1s, list):
+            raise ex.BadRequest('sha1s is required')
+
+        entries = {}
+        missing = []
+        for sha1 in self.git.storage_order(x for x in sha1s
+                                           if is_valid_hex(x)):
+            header = self.git.read_header(sha1)
+            if header is None:
+                missing.append(sha1)
+            else:
+                entries[sha1] = {'type': OBJ_TYPE_NAMES[header[0]],
+                                 'size': header[1]}
+        missing.extend(x for x in sha1s if not is_valid_hex(x))
+        self.status = 200
+        return {'entries': entries, 'missing': missing}
+
 
 class Branches(NounHandler):
     def handle_get_branches(self):
-        branches = self.git.branches()
-        return {'entries': branches}
+        return self.list_refs('heads')
 
     def handle_get(self, branch, paths):
         if branch is None:
             return self.handle_get_branches()
 
-        branches = self.git.branches()
         try:
-            sha1 = branches[branch]
-        except KeyError:
+            sha1 = self.git.branch_target(branch)
+        except InvalidParamException:
             raise ex.NotFound('No branch found for the given name: ' + branch)
 
-        branch_tree = self.git.branch_tree(branch)
-        return {
+        not_modified = self.check_etag(self.resource_etag(sha1, paths))
+        if not_modified:
+            return not_modified
+
+        return self.list_tree({
             'name': branch,
             'type': 'branch',
             'sha1': sha1,
-            'entries': [entry_to_dict(x, self.git.repo) for x in branch_tree],
-        }
+        }, self.git.tree_hex(commit=sha1))
 
     def handle_post(self, branch, paths):
         param = json.loads(self.request.data)
 
-        branches = self.git.branches()
-        if branch in branches:
+        if self.git.has_branch(branch):
             raise ex.Conflict("'%s' branch already exists." % branch)
 
         self.git.create_branch(branch, param.get('target'))
@@ -85,22 +572,37 @@ class Branches(NounHandler):
         return {}
 
     def handle_get_file(self, branch, paths):
-        entry = self.git.find_entry('/'.join(paths), branch=branch)
+        try:
+            sha1 = self.git.branch_target(branch)
+        except InvalidParamException:
+            raise ex.NotFound('No branch found for the given name: ' + branch)
+        if self.wants_raw():
+            return self.raw_response(sha1, paths)
+        not_modified = self.check_etag(self.resource_etag(sha1, paths))
+        if not_modified:
+            return not_modified
+
+        entry = self.git.find_entry('/'.join(paths), commit=sha1)
         if entry:
             d = entry_to_dict(entry, self.git.repo)
             if d['type'] == 'tree':
-                entries = [
-                    entry_to_dict(x, self.git.repo)
-                    for x in self.git.repo[entry.oid]
-                ]
-                d['entries'] = entries
+                return self.list_tree(d, entry.hex)
             return d
         else:
             raise ex.NotFound('File does not exist in %s branch' % branch)
 
     def handle_post_file(self, branch, paths):
         param = json.loads(self.request.data)
-        commit_hex = self.git.create_entry(
+        result = self.queue_change(branch, {
+            'action': 'create',
+            'path': '/'.join(paths),
+            'sha1': param.get('sha1'),
+        }, param)
+        if result:
+            return result
+        return self.commit_change(
+            self.git.create_entry,
+            param,
             branch,
             '/'.join(paths),
             param.get('sha1'),
@@ -108,11 +610,19 @@ class Branches(NounHandler):
             author_name=param.get('author_name'),
             author_email=param.get('author_email'),
             comment=getattr(param, 'comment', ''))
-        return {}
 
     def handle_put_file(self, branch, paths):
         param = json.loads(self.request.data)
-        commit_hex = self.git.update_entry(
+        result = self.queue_change(branch, {
+            'action': 'update',
+            'path': '/'.join(paths),
+            'sha1': param.get('sha1'),
+        }, param)
+        if result:
+            return result
+        return self.commit_change(
+            self.git.update_entry,
+            param,
             branch,
             '/'.join(paths),
             param.get('sha1'),
@@ -120,49 +630,128 @@ class Branches(NounHandler):
             author_name=param.get('author_name'),
             author_email=param.get('author_email'),
             comment=getattr(param, 'comment', ''))
-        return {}
 
     def handle_delete_file(self, branch, paths):
         param = json.loads(self.request.data)
-        commit_hex = self.git.delete_entry(
+        result = self.queue_change(branch, {
+            'action': 'delete',
+            'path': '/'.join(paths),
+        }, param)
+        if result:
+            return result
+        return self.commit_change(
+            self.git.delete_entry,
+            param,
             branch,
             '/'.join(paths),
             author_name=param.get('author_name'),
             author_email=param.get('author_email'),
             comment=getattr(param, 'comment', ''))
-        return {}
+
+
+class Changes(NounHandler):
+    def handle_post(self, branch, paths):
+        if branch is None:
+            raise ex.NotFound('branch is not specified')
+
+        param = self.json_object()
+        return self.commit_change(
+            self.git.apply_changes,
+            param,
+            branch,
+            param.get('changes'),
+            author_name=param.get('author_name'),
+            author_email=param.get('author_email'),
+            comment=param.get('comment', ''))
+
+
+class Diff(NounHandler):
+    def handle_get(self, name, paths):
+        args = self.request.args
+        if name is not None:
+            raise ex.NotFound('Unsupported operation')
+        if not args.get('from') or not args.get('to'):
+            raise ex.BadRequest('from and to are required')
+        try:
+            old = self.git.resolve_commit(args['from'])
+            new = self.git.resolve_commit(args['to'])
+        except InvalidParamException, e:
+            raise ex.NotFound(str(e))
+
+        # the diff between two commit ids never changes
+        immutable = old == args['from'] and new == args['to']
+        not_modified = self.check_etag(
+            self.resource_etag('%s..%s' % (old, new), paths), immutable)
+        if not_modified:
+            return not_modified
+
+        changes, cursor = self.page(
+            self.git.diff(old, new, path=args.get('path'),
+                          after=args.get('cursor')),
+            key=lambda x: x['path'])
+        result = {'from': old, 'to': new, 'entries': changes}
+        if cursor is not None:
+            result['next_cursor'] = cursor
+        return result
+
+
+class Log(NounHandler):
+    def handle_get(self, name, paths):
+        if name is None:
+            raise ex.NotFound('branch, tag or commit is not specified')
+        try:
+            sha1 = self.git.resolve_commit(name)
+        except InvalidParamException, e:
+            raise ex.NotFound(str(e))
+
+        not_modified = self.check_etag(self.resource_etag(sha1, paths))
+        if not_modified:
+            return not_modified
+
+        try:
+            history = self.git.iter_history(
+                sha1, path=self.request.args.get('path'),
+                after=self.request.args.get('cursor'))
+        except InvalidParamException, e:
+            raise ex.BadRequest(str(e))
+        commits, cursor = self.page(history, key=lambda x: x[1])
+        result = {
+            'name': name,
+            'sha1': sha1,
+            'entries': (commit_to_dict(x) for x, _ in commits),
+        }
+        if cursor is not None:
+            result['next_cursor'] = cursor
+        return result
 
 
 class Tags(NounHandler):
     def handle_get_tags(self):
-        tags = self.git.tags()
-        return {'entries': tags}
+        return self.list_refs('tags')
 
     def handle_get(self, tag, paths):
         if tag is None:
             return self.handle_get_tags()
 
-        tags = self.git.tags()
         try:
-            sha1 = tags[tag]
-        except KeyError:
+            sha1 = self.git.tag_target(tag)
+        except InvalidParamException:
             raise ex.NotFound('No tag found for the given name: ' + tag)
 
-        tag_tree = self.git.tag_tree(tag)
-        return {
+        not_modified = self.check_etag(self.resource_etag(sha1, paths))
+        if not_modified:
+            return not_modified
+
+        return self.list_tree({
             'name': tag,
             'type': 'tag',
             'sha1': sha1,
-            'entries': [
-                entry_to_dict(x, self.git.repo) for x in tag_tree
-            ],
-        }
+        }, self.git.tree_hex(commit=sha1))
 
     def handle_post(self, tag, paths):
         param = json.loads(self.request.data)
 
-        tags = self.git.tags()
-        if tag in tags:
+        if self.git.has_tag(tag):
             raise ex.Conflict("'%s' tag already exists." % tag)
 
         self.git.create_tag(tag, param.get('target'))
@@ -173,15 +762,21 @@ class Tags(NounHandler):
         return {}
 
     def handle_get_file(self, tag, paths):
-        entry = self.git.find_entry('/'.join(paths), tag=tag)
+        try:
+            sha1 = self.git.tag_target(tag)
+        except InvalidParamException:
+            raise ex.NotFound('No tag found for the given name: ' + tag)
+        if self.wants_raw():
+            return self.raw_response(sha1, paths)
+        not_modified = self.check_etag(self.resource_etag(sha1, paths))
+        if not_modified:
+            return not_modified
+
+        entry = self.git.find_entry('/'.join(paths), commit=sha1)
         if entry:
             d = entry_to_dict(entry, self.git.repo)
             if d['type'] == 'tree':
-                entries = [
-                    entry_to_dict(x, self.git.repo)
-                    for x in self.git.repo[entry.oid]
-                ]
-                d['entries'] = entries
+                return self.list_tree(d, entry.hex)
             return d
         else:
             raise ex.NotFound('File does not exist in %s tag' % tag)
@@ -189,24 +784,30 @@ class Tags(NounHandler):
 
 class Commits(NounHandler):
     def handle_get(self, sha1, paths):
-        commit_tree = self.git.commit_tree(sha1)
-        return {
+        not_modified = self.check_etag(self.resource_etag(sha1, paths),
+                                       immutable=True)
+        if not_modified:
+            return not_modified
+
+        return self.list_tree({
             'name': sha1,
             'type': 'commit',
             'sha1': sha1,
-            'entries': [entry_to_dict(x, self.git.repo) for x in commit_tree],
-        }
+        }, self.git.tree_hex(commit=sha1))
 
     def handle_get_file(self, sha1, paths):
+        if self.wants_raw():
+            return self.raw_response(sha1, paths, immutable=True)
+        not_modified = self.check_etag(self.resource_etag(sha1, paths),
+                                       immutable=True)
+        if not_modified:
+            return not_modified
+
         entry = self.git.find_entry('/'.join(paths), commit=sha1)
         if entry:
             d = entry_to_dict(entry, self.git.repo)
             if d['type'] == 'tree':
-                entries = [
-                    entry_to_dict(x, self.git.repo)
-                    for x in self.git.repo[entry.oid]
-                ]
-                d['entries'] = entries
+                return self.list_tree(d, entry.hex)
             return d
         else:
             raise ex.NotFound('File does not exist in %s commit' % sha1)
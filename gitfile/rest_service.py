@@ -4,16 +4,43 @@ import os
 import json
 from gitfile.git import *
 from gitfile.rest_handler import *
+from gitfile.encoder import iter_json, iter_ndjson, is_lazy, \
+    buffer_chunks, compress, compress_chunks, content_encodings, \
+    COMPACT_SEPARATORS, DEFAULT_COMPRESS_MIN_SIZE
+from gitfile.pool import GitPool, DEFAULT_POOL_SIZE
+from gitfile.group_commit import DEFAULT_MAX_BATCH, DEFAULT_MAX_LATENCY
+from gitfile.archive import DEFAULT_ARCHIVE_CACHE_BYTES
 
 
 class RESTService(object):
 
-    def __init__(self, base_path):
+    def __init__(self, base_path, pool_size=DEFAULT_POOL_SIZE,
+                 max_blob_size=None, write_retries=0,
+                 write_retries_max=MAX_WRITE_RETRIES, group_commit=False,
+                 group_commit_max_batch=DEFAULT_MAX_BATCH,
+                 group_commit_max_latency=DEFAULT_MAX_LATENCY,
+                 archive_cache_bytes=DEFAULT_ARCHIVE_CACHE_BYTES,
+                 archive_cache_dir=None,
+                 compress_min_size=DEFAULT_COMPRESS_MIN_SIZE,
+                 deflate_blobs=True):
         if not base_path:
             raise Exception('base_path is required')
         if not os.path.isdir(base_path):
             raise Exception('base_path is not a directory')
         self.base_path = base_path
+        self.pool = GitPool(base_path, max_size=pool_size)
+        self.options = {
+            'max_blob_size': max_blob_size,
+            'write_retries': write_retries,
+            'write_retries_max': write_retries_max,
+            'group_commit': group_commit,
+            'group_commit_max_batch': group_commit_max_batch,
+            'group_commit_max_latency': group_commit_max_latency,
+            'archive_cache_bytes': archive_cache_bytes,
+            'archive_cache_dir': archive_cache_dir,
+            'compress_min_size': compress_min_size,
+            'deflate_blobs': deflate_blobs,
+        }
 
     def __call__(self, environ, start_response):
         return self.wsgi_app(environ, start_response)
@@ -33,13 +60,16 @@ class RESTService(object):
             if not noun:
                 raise ex.NotFound('noun is not specified')
 
-            gitdir = self.find_git_dir(repo)
-            if not gitdir:
+            git = self.pool.get(repo)
+            if not git:
                 raise ex.NotFound('No such repository')
 
-            git = Git(gitdir)
-            content = RESTHandler.get_noun_handler(git, request, noun).\
-                handle(path)
+            handler = RESTHandler.get_noun_handler(git, request, noun,
+                                                   self.options)
+            content = handler.handle(path)
+            if isinstance(content, Response):
+                handler.add_cache_headers(content)
+                return content
 
             status = {
                 'GET': [200, None],
@@ -48,20 +78,45 @@ class RESTService(object):
                 'PUT': [200, 'A resource updated successfully.'],
                 'DELETE': [200, 'A resource deleted successfully.'],
             }[request.method]
+            if handler.status is not None:
+                status = [handler.status, None]
 
             content_type = 'application/json'
+            encoding = None
             if noun.lower() == 'blobs' and (request.method in ['GET', 'HEAD']):
                 content_type = 'application/octet-stream'
 
             if type(content).__name__ == 'dict':
-                body = json.dumps({'error': False,
-                                   'message': status[1],
-                                   'result': content},
-                                  sort_keys=True,
-                                  indent=4)
+                if 'format' not in request.args:
+                    handler.vary.add('Accept')
+                if handler.wants_ndjson():
+                    content_type = 'application/x-ndjson'
+                    chunks = iter_ndjson(content)
+                else:
+                    chunks = iter_json({'error': False,
+                                        'message': status[1],
+                                        'result': content},
+                                       indent=self._indent(request))
+                # listings are streamed as they are read
+                if is_lazy(content):
+                    body = buffer_chunks(chunks)
+                    encoding = self._content_encoding(request)
+                    if encoding:
+                        body = compress_chunks(body, encoding)
+                else:
+                    body = ''.join(chunks)
+                    encoding = self._content_encoding(request, len(body))
+                    if encoding:
+                        body = compress(body, encoding)
             else:
                 body = content
             response = Response(body, status=status[0], mimetype=content_type)
+            if encoding:
+                response.headers['Content-Encoding'] = encoding
+            if type(content).__name__ == 'dict' and \
+                    self.options['compress_min_size'] is not None:
+                response.vary.add('Accept-Encoding')
+            handler.add_cache_headers(response)
         except ex.HTTPException, e:
             return self.error_response(e)
         except ValueError, e:
@@ -75,15 +130,31 @@ class RESTService(object):
         body = json.dumps({
             'error': True,
             'message': getattr(error, 'description', 'Unknown error'),
-        }, sort_keys=True, indent=4)
+        }, sort_keys=True, separators=COMPACT_SEPARATORS)
         return Response(body, status=error.code, mimetype='application/json')
 
+    def _indent(self, request):
+        r"""
+        Return the indent of pretty-printed JSON if the 'pretty'
+        parameter asks for it, or None for compact JSON.
+        """
+        if request.args.get('pretty') in ('1', 'true'):
+            return 4
+        return None
+
+    def _content_encoding(self, request, size=None):
+        r"""
+        Return the content coding a JSON body of the given size should be
+        compressed with, or None. A streamed body, whose size is unknown,
+        is compressed whenever the client accepts it.
+        """
+        min_size = self.options['compress_min_size']
+        if min_size is None or (size is not None and size < min_size):
+            return None
+        return request.accept_encodings.best_match(content_encodings())
+
     def find_git_dir(self, repo):
-        path = os.path.join(self.base_path, repo)
-        for dir in [path, path + '.git']:
-            if os.path.isdir(dir):
-                return dir
-        return
+        return self.pool.find_git_dir(repo)
 
     def _split_path(self, path):
         segments = path.rstrip('/').split('/')
@@ -101,6 +172,6 @@ class RESTService(object):
         return repo, noun, rest
 
 
-def create_app(base_path):
-    app = RESTService(base_path=base_path)
+def create_app(base_path, **options):
+    app = RESTService(base_path=base_path, **options)
     return app
@@ -1,5 +1,7 @@
 from pygit2 import GIT_OBJ_BLOB, GIT_OBJ_TREE, GIT_OBJ_COMMIT, GIT_OBJ_TAG
+from pygit2 import Oid
 import re
+from gitfile.odb import ObjectDatabase
 
 HEX_RE = re.compile(r'^[0-9a-f]{40}$')
 
@@ -47,23 +49,80 @@ def make_dir_paths(path):
     return dirs
 
 
-def entry_to_dict(entry, repo):
-    obj = repo[entry.oid]
+def entry_type(filemode):
+    r"""
+    Return the object type of a tree entry from its file mode.
+    """
+    return {
+        0o040000: 'tree',
+        0o160000: 'commit',
+    }.get(filemode & 0o170000, 'blob')
+
+
+def object_size(repo, hex):
+    r"""
+    Return the size of the object for the given sha1 from its header.
+    """
+    header = ObjectDatabase.for_repo(repo).read_header(hex)
+    if header is None:
+        # not in the local object database (e.g. in an alternate)
+        return len(repo[Oid(hex=hex)].read_raw())
+    return header[1]
+
 
-    type = {
-        GIT_OBJ_BLOB: 'blob',
-        GIT_OBJ_COMMIT: 'commit',
-        GIT_OBJ_TREE: 'tree',
-        GIT_OBJ_TAG: 'tag',
-    }[obj.type]
+def entry_key(entry):
+    r"""
+    Return the key trees are sorted by: the name of the entry, followed
+    by a slash for a directory.
+    """
+    if entry_type(entry.filemode) == 'tree':
+        return entry.name + '/'
+    return entry.name
+
+
+def entry_to_dict(entry, repo):
+    type = entry_type(entry.filemode)
 
     d = {
         'name': entry.name,
         'sha1': entry.hex,
         'mode': oct(entry.filemode),
         'type': type,
-        'size': len(obj.read_raw()),
     }
-    if type != 'blob':
-        del d['size']
+    if type == 'blob':
+        d['size'] = object_size(repo, entry.hex)
     return d
+
+
+def signature_to_dict(signature):
+    return {
+        'name': signature.name,
+        'email': signature.email,
+        'time': signature.time,
+        'offset': signature.offset,
+    }
+
+
+def commit_to_dict(commit):
+    return {
+        'sha1': commit.hex,
+        'message': commit.message,
+        'author': signature_to_dict(commit.author),
+        'committer': signature_to_dict(commit.committer),
+        'parents': [x.hex for x in commit.parent_ids],
+    }
+
+
+def diff_to_dict(path, status, old, new):
+    r"""
+    Return a change as a dict from the path, the status and the (sha1,
+    mode) of each side, None for the missing one.
+    """
+    return {
+        'path': path,
+        'status': status,
+        'old_sha1': old and old[0],
+        'old_mode': old and oct(int(old[1])),
+        'new_sha1': new and new[0],
+        'new_mode': new and oct(int(new[1])),
+    }
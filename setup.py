@@ -14,7 +14,7 @@ setup(
     license='BSD',
     dependency_links=[],
     install_requires=[
-        'pygit2',
+        'pygit2>=0.22.0',
         'Werkzeug',
     ],
     tests_require=['unittest2', 'nose', 'pep8'],
@@ -1,11 +1,13 @@
 import unittest
 import gitfile
+import itertools
 import os
+from StringIO import StringIO
 import testutil
 from gitfile.git import *
 from gitfile.exceptions import *
 from gitfile.utils import *
-from pygit2 import Oid
+from pygit2 import Oid, Signature
 
 
 class ApiTest(unittest.TestCase):
@@ -88,6 +90,23 @@ class ApiTest(unittest.TestCase):
         self.assertTrue(hex)
         self.assertEqual(self.git.create_content(content), hex)
 
+    def test_create_content_from_stream(self):
+        self.assertRaises(InvalidParamException,
+                          self.git.create_content_from_stream, None)
+
+        content = 'foo' * 100000
+        hex = self.git.create_content_from_stream(StringIO(content),
+                                                  chunk_size=1000)
+        self.assertEqual(hex, self.git.create_content(content))
+        self.assertEqual(self.git.get_content(hex), content)
+
+        self.assertRaises(ContentTooLargeException,
+                          self.git.create_content_from_stream,
+                          StringIO(content), limit=len(content) - 1)
+        self.assertEqual([x for x in os.listdir(self.git.repo.path)
+                          if x.startswith('tmp_blob_')], [],
+                         'temporary files are removed')
+
     def test_get_content(self):
         self.assertRaises(InvalidParamException,
                           self.git.get_content, None)
@@ -111,6 +130,51 @@ class ApiTest(unittest.TestCase):
         self.assertRaises(InvalidParamException,
                           self.git.find_entry, '/', branch='abc')
 
+        hex = self.git.create_content('blah')
+        self.git.create_entry('master', '/foo/bar/baz.txt', hex,
+                              author_name='foo',
+                              author_email='foo@example.com')
+        for path in ['foo/bar/baz.txt', '/foo//bar/baz.txt/']:
+            self.assertEqual(self.git.find_entry(path, branch='master').hex,
+                             hex)
+        self.assertEqual(self.git.find_entry('/foo/bar', branch='master').name,
+                         'bar')
+        self.assertFalse(self.git.find_entry('/foo/bar/baz.txt/qux',
+                                             branch='master'))
+        self.assertFalse(self.git.find_entry('/foo/qux', branch='master'))
+
+    def test_find_entry_wide_tree(self):
+        hexes = [self.git.create_content('even'),
+                 self.git.create_content('odd')]
+        tb = self.git.repo.TreeBuilder()
+        tb.insert('deep', Oid(hex=hexes[0]), DEFAULT_MODE_BLOB)
+        sub = tb.write()
+        tb = self.git.repo.TreeBuilder()
+        for i in range(20000):
+            tb.insert('file%05d' % i, Oid(hex=hexes[i % 2]),
+                      DEFAULT_MODE_BLOB)
+        tb.insert('sub', sub, DEFAULT_MODE_TREE)
+        wide = tb.write()
+        tb = self.git.repo.TreeBuilder(self.git.branch_tree('master'))
+        tb.insert('wide', wide, DEFAULT_MODE_TREE)
+        committer = Signature('foo', 'foo@example.com')
+        self.git.repo.create_commit('refs/heads/wide', committer, committer,
+                                    'wide', tb.write(), [])
+
+        for i in [0, 1, 9998, 19999]:
+            entry = self.git.find_entry('/wide/file%05d' % i, branch='wide')
+            self.assertEqual(entry.name, 'file%05d' % i)
+            self.assertEqual(entry.hex, hexes[i % 2])
+        self.assertEqual(self.git.find_entry('wide/sub/deep',
+                                             branch='wide').hex, hexes[0])
+        self.assertEqual(self.git.find_entry('/wide/sub', branch='wide').hex,
+                         sub.hex)
+        for path in ['/wide/file20000', '/wide/file00001/deep',
+                     '/wide/sub/nothing', '/nothing/file00001']:
+            self.assertEqual(self.git.find_entry(path, branch='wide'), None)
+        self.assertTrue(self.git.tree(wide.hex) is self.git.tree(wide.hex),
+                        'parsed trees are cached')
+
     def test_create_entry(self):
         paths = ['/foo.txt', '/foo/bar.txt', '/foo/bar/baz.txt']
         for path in paths:
@@ -210,6 +274,396 @@ class ApiTest(unittest.TestCase):
                                               author_email='foo@example.com'))
         self.assertFalse(self.git.find_entry(path, branch='master'))
 
+    def test_deep_entry(self):
+        author = {'author_name': 'foo', 'author_email': 'foo@example.com'}
+        hex = self.git.create_content('deep')
+        hex_new = self.git.create_content('deep (new)')
+        path = '/a/b/c/d/e/f/g.txt'
+
+        for missing in ['/a/b/x/g.txt', '/a/b/c/d/e/f/g.txt/h']:
+            self.assertRaises(InvalidParamException, self.git.update_entry,
+                              'master', missing, hex, **author)
+        self.git.create_entry('master', path, hex, **author)
+        self.git.create_entry('master', '/a/b/other.txt', hex, **author)
+        self.assertEqual(self.git.find_entry(path, branch='master').hex, hex)
+
+        for missing in ['/a/b/x/g.txt', '/a/b/c/d/e/f/g.txt/h']:
+            self.assertRaises(InvalidParamException, self.git.update_entry,
+                              'master', missing, hex_new, **author)
+            self.assertRaises(InvalidParamException, self.git.delete_entry,
+                              'master', missing, **author)
+
+        self.git.update_entry('master', path, hex_new, **author)
+        self.assertEqual(self.git.find_entry(path, branch='master').hex,
+                         hex_new)
+        self.assertEqual(self.git.find_entry('/a/b/other.txt',
+                                             branch='master').hex, hex)
+
+        self.git.delete_entry('master', path, **author)
+        self.assertFalse(self.git.find_entry(path, branch='master'))
+        self.assertTrue(self.git.find_entry('/a/b/other.txt',
+                                            branch='master'))
+
+    def test_wide_directory_write(self):
+        author = {'author_name': 'foo', 'author_email': 'foo@example.com'}
+        hex = self.git.create_content('blah')
+        hex_new = self.git.create_content('blah (new)')
+        tb = self.git.repo.TreeBuilder()
+        for i in range(20000):
+            tb.insert('file%05d' % i, Oid(hex=hex), DEFAULT_MODE_BLOB)
+        self.git.create_entry('master', '/wide', tb.write().hex,
+                              mode=DEFAULT_MODE_TREE, **author)
+
+        self.git.create_entry('master', '/wide/new.txt', hex_new, **author)
+        self.git.update_entry('master', '/wide/file00042', hex_new, **author)
+        self.git.delete_entry('master', '/wide/file00043', **author)
+
+        wide = self.git.find_entry('/wide', branch='master')
+        entries = dict((e.name, e.hex) for e in self.git.repo[wide.oid])
+        self.assertEqual(len(entries), 20000)
+        self.assertEqual(entries['new.txt'], hex_new)
+        self.assertEqual(entries['file00042'], hex_new)
+        self.assertFalse('file00043' in entries)
+        self.assertEqual(entries['file19999'], hex)
+
+    def test_iter_tree_entries(self):
+        hex = self.git.create_content('blah')
+        tb = self.git.repo.TreeBuilder()
+        for name in ['a', 'a.txt', 'ab', 'b']:
+            tb.insert(name, Oid(hex=hex), DEFAULT_MODE_BLOB)
+        sub = tb.write()
+        tb = self.git.repo.TreeBuilder(sub)
+        tb.insert('a', sub, DEFAULT_MODE_TREE)
+        tree_hex = tb.write().hex
+
+        def names(**kwargs):
+            return [entry_key(e) for e in
+                    self.git.iter_tree_entries(tree_hex, **kwargs)]
+
+        # a directory sorts as if its name ended with a slash
+        self.assertEqual(names(), ['a.txt', 'a/', 'ab', 'b'])
+        self.assertEqual(names(prefix='a'), ['a.txt', 'a/', 'ab'])
+        self.assertEqual(names(prefix='a.'), ['a.txt'])
+        self.assertEqual(names(prefix='c'), [])
+        self.assertEqual(names(after='a.txt'), ['a/', 'ab', 'b'])
+        self.assertEqual(names(after='a/'), ['ab', 'b'])
+        self.assertEqual(names(after='aa'), ['ab', 'b'])
+        self.assertEqual(names(prefix='a', after='a/'), ['ab'])
+        self.assertEqual(names(after='b'), [])
+
+    def test_walk_tree(self):
+        hex = self.git.create_content('blah')
+        self.git.apply_changes('master', [
+            {'action': 'create', 'path': path, 'sha1': hex}
+            for path in ['a.txt', 'a/x', 'a/b/y', 'a/b/z', 'a/c/w', 'ab',
+                         'b/x']
+        ], author_name='foo', author_email='foo@example.com')
+        tree_hex = self.git.tree_hex(branch='master')
+
+        def walk(**kwargs):
+            return [path for path, entry in
+                    self.git.walk_tree(tree_hex, **kwargs)]
+
+        paths = ['.git-placeholder', 'a.txt', 'a', 'a/b', 'a/b/y', 'a/b/z',
+                 'a/c', 'a/c/w', 'a/x', 'ab', 'b', 'b/x']
+        self.assertEqual(walk(), paths)
+        self.assertEqual(walk(depth=1),
+                         ['.git-placeholder', 'a.txt', 'a', 'ab', 'b'])
+        self.assertEqual(walk(depth=2),
+                         [x for x in paths if x.count('/') < 2])
+        self.assertEqual(walk(prefix='a'), paths[1:10])
+
+        # resuming after any path gives the rest of the walk
+        keys = [path + ('/' if entry_type(entry.filemode) == 'tree' else '')
+                for path, entry in self.git.walk_tree(tree_hex)]
+        self.assertEqual(keys, sorted(keys), 'walk in path_key order')
+        for i, key in enumerate(keys):
+            self.assertEqual(walk(after=key), paths[i + 1:])
+        self.assertEqual(walk(depth=2, after='a/'), ['a/b', 'a/c', 'a/x',
+                                                     'ab', 'b', 'b/x'])
+
+    def test_history(self):
+        author = {'author_name': 'foo', 'author_email': 'foo@example.com'}
+        root = self.git.branch_target('master')
+        commits = [root]
+        for path, content in [('/a/x', '1'), ('/b/y', '1'), ('/a/x', '2'),
+                              ('/a/z', '1'), ('/b/y', '2')]:
+            hex = self.git.create_content(content)
+            if self.git.find_entry(path, branch='master'):
+                commits.append(self.git.update_entry('master', path, hex,
+                                                     **author))
+            else:
+                commits.append(self.git.create_entry('master', path, hex,
+                                                     **author))
+        head = commits[-1]
+
+        def history(**kwargs):
+            return [c.hex for c in self.git.history(head, **kwargs)]
+
+        self.assertEqual(history(), commits[::-1])
+        self.assertEqual(history(path='a/x'), [commits[3], commits[1]])
+        self.assertEqual(history(path='/a/'), [commits[4], commits[3],
+                                               commits[1]])
+        self.assertEqual(history(path='b'), [commits[5], commits[2]])
+        self.assertEqual(history(path='.git-placeholder'), [root])
+        self.assertEqual(history(path='nothing'), [])
+        cursors = dict((c.hex, cursor) for c, cursor in
+                       self.git.iter_history(head, path='a'))
+        self.assertEqual(history(path='a', after=cursors[commits[4]]),
+                         [commits[3], commits[1]])
+        self.assertEqual(cursors[commits[1]], commits[0])
+        self.assertEqual(history(after=commits[0]), [root])
+        for after in ['foo', '1' * 40]:
+            self.assertRaises(InvalidParamException, self.git.iter_history,
+                              head, after=after)
+
+        self.git.create_tag('v1', commits[2])
+        self.assertEqual(self.git.resolve_commit('master'), head)
+        self.assertEqual(self.git.resolve_commit('v1'), commits[2])
+        self.assertEqual(self.git.resolve_commit(root), root)
+        tree_hex = self.git.tree_hex(commit=root)
+        for name in ['nothing', '1' * 40, tree_hex]:
+            self.assertRaises(InvalidParamException,
+                              self.git.resolve_commit, name)
+
+    def test_history_merges(self):
+        # every commit has the same time, so only the order in which
+        # they are found tells them apart
+        repo = self.git.repo
+        signature = Signature('foo', 'foo@example.com', 1000000000, 0)
+        tree = repo[Oid(hex=self.git.branch_target('master'))].tree_id
+
+        def commit(message, *parents):
+            return repo.create_commit(None, signature, signature, message,
+                                      tree, [Oid(hex=x) for x in parents]).hex
+        root = commit('root')
+        a1 = commit('a1', root)
+        b1 = commit('b1', root)
+        a2 = commit('a2', a1)
+        merge = commit('merge', a2, b1)
+        head = commit('head', merge, a1)
+
+        walked = [c.hex for c in self.git.history(head)]
+        self.assertEqual(sorted(walked), sorted([root, a1, b1, a2, merge,
+                                                 head]))
+        self.assertEqual(walked[:2], [head, merge])
+        self.assertEqual(walked[-1], root)
+
+        # one commit per page
+        paged = []
+        cursor = None
+        while True:
+            items = list(itertools.islice(
+                self.git.iter_history(head, after=cursor), 2))
+            paged.append(items[0][0].hex)
+            if len(items) < 2:
+                break
+            cursor = items[0][1]
+        self.assertEqual(paged, walked, 'no commit is returned twice')
+
+    def test_history_lazy(self):
+        author = {'author_name': 'foo', 'author_email': 'foo@example.com'}
+        for i in range(50):
+            head = self.git.create_entry('master', '/file%d' % i,
+                                         self.git.create_content(str(i)),
+                                         **author)
+
+        class CountingRepository(object):
+            def __init__(self, repo):
+                self.repo = repo
+                self.lookups = 0
+
+            def __getitem__(self, key):
+                self.lookups += 1
+                return self.repo[key]
+
+            def __getattr__(self, name):
+                return getattr(self.repo, name)
+
+        self.git.repo = CountingRepository(self.git.repo)
+        commit, cursor = next(self.git.iter_history(head))
+        self.assertEqual(commit.hex, head)
+        self.assertTrue(self.git.repo.lookups <= 2,
+                        'the first commit comes without a full walk')
+
+    def test_diff(self):
+        author = {'author_name': 'foo', 'author_email': 'foo@example.com'}
+        one = self.git.create_content('1')
+        two = self.git.create_content('2')
+        old = self.git.apply_changes('master', [
+            {'action': 'create', 'path': path, 'sha1': one}
+            for path in ['a/x', 'a/y', 'b/x', 'c', 'same/x']
+        ], **author)
+        new = self.git.apply_changes('master', [
+            {'action': 'update', 'path': 'a/x', 'sha1': two},
+            {'action': 'delete', 'path': 'a/y'},
+            {'action': 'create', 'path': 'a/z', 'sha1': one},
+            {'action': 'delete', 'path': 'b/x'},
+            {'action': 'delete', 'path': 'c'},
+        ], **author)
+        new = self.git.create_entry('master', 'c/x', one, **author)
+
+        def diff(*args, **kwargs):
+            return [(x['path'], x['status'], x['old_sha1'], x['new_sha1'])
+                    for x in self.git.diff(*args, **kwargs)]
+
+        changes = [('a/x', 'modified', one, two),
+                   ('a/y', 'deleted', one, None),
+                   ('a/z', 'added', None, one),
+                   ('b/x', 'deleted', one, None),
+                   ('c', 'deleted', one, None),
+                   ('c/x', 'added', None, one)]
+        self.assertEqual(diff(old, new), changes)
+        self.assertEqual(diff(old, new, path='/a/'), changes[:3])
+        self.assertEqual(diff(old, new, path='b'), changes[3:4])
+        self.assertEqual(diff(old, new, path='c'), changes[4:])
+        self.assertEqual(diff(old, new, path='a/x'), changes[:1])
+        self.assertEqual(diff(new, old, path='a/z'),
+                         [('a/z', 'deleted', one, None)])
+        self.assertEqual(diff(old, new, path='same'), [])
+        self.assertEqual(diff(old, new, path='nothing'), [])
+        self.assertEqual(diff(old, old), [])
+        self.assertEqual(diff(old, new, after='b/x'), changes[4:])
+
+        change = list(self.git.diff(old, new, path='a/z'))[0]
+        self.assertEqual(change['new_mode'], oct(DEFAULT_MODE_BLOB))
+        self.assertEqual(change['old_mode'], None)
+
+    def test_apply_changes(self):
+        hexes = [self.git.create_content('content %d' % i) for i in range(3)]
+        self.git.create_entry('master', '/dir1/old.txt', hexes[0],
+                              author_name='foo',
+                              author_email='foo@example.com')
+        untouched = self.git.find_entry('/dir1', branch='master')
+        self.git.create_entry('master', '/dir2/old.txt', hexes[0],
+                              author_name='foo',
+                              author_email='foo@example.com')
+        parent = self.git.branches()['master']
+
+        commit_hex = self.git.apply_changes('master', [
+            {'action': 'create', 'path': '/new.txt', 'sha1': hexes[1]},
+            {'action': 'create', 'path': '/dir3/a/b.txt', 'sha1': hexes[1]},
+            {'action': 'create', 'path': '/dir3/a/c.txt', 'sha1': hexes[2],
+             'mode': '0100755'},
+            {'action': 'update', 'path': '/dir2/old.txt', 'sha1': hexes[2]},
+            {'action': 'delete', 'path': '/.git-placeholder'},
+        ], author_name='foo', author_email='foo@example.com')
+
+        self.assertEqual(self.git.branches()['master'], commit_hex)
+        commit = self.git.repo[Oid(hex=commit_hex)]
+        self.assertEqual([x.hex for x in commit.parents], [parent],
+                         'a single commit')
+        for path, hex in [('/new.txt', hexes[1]),
+                          ('/dir3/a/b.txt', hexes[1]),
+                          ('/dir3/a/c.txt', hexes[2]),
+                          ('/dir2/old.txt', hexes[2])]:
+            self.assertEqual(self.git.find_entry(path, branch='master').hex,
+                             hex)
+        self.assertEqual(self.git.find_entry('/dir3/a/c.txt',
+                                             branch='master').filemode,
+                         0o0100755)
+        self.assertFalse(self.git.find_entry('/.git-placeholder',
+                                             branch='master'))
+        self.assertEqual(self.git.find_entry('/dir1', branch='master').hex,
+                         untouched.hex, 'untouched subtree is shared')
+
+        for changes in [
+            [],
+            [{'action': 'rename', 'path': '/new.txt'}],
+            [{'action': 'update', 'path': '/nothing.txt', 'sha1': hexes[0]}],
+            [{'action': 'delete', 'path': '/nothing.txt'}],
+            [{'action': 'create', 'path': '/x.txt', 'sha1': '1' * 40}],
+            [{'action': 'create', 'path': '/new.txt/x', 'sha1': hexes[0]}],
+            [{'action': 'create', 'path': '/y/z', 'sha1': hexes[0]},
+             {'action': 'create', 'path': '/y', 'sha1': hexes[0]}],
+            ['/new.txt'],
+            [None],
+            {'action': 'delete', 'path': '/new.txt'},
+            [{'action': 'delete', 'path': None}],
+            [{'action': 'delete', 'path': ['new.txt']}],
+            [{'action': 'create', 'path': '/x.txt', 'sha1': 1}],
+            [{'action': 'create', 'path': '/x.txt', 'sha1': hexes[0],
+              'mode': [0o100644]}],
+            [{'action': 'create', 'path': '/x.txt', 'sha1': hexes[0],
+              'mode': '100x'}],
+            [{'action': 'create', 'path': '/x.txt', 'sha1': hexes[0],
+              'mode': '0777'}],
+            [{'action': 'create', 'path': '/x.txt', 'sha1': hexes[0],
+              'mode': 0o777}],
+        ]:
+            self.assertRaises(InvalidParamException,
+                              self.git.apply_changes, 'master', changes)
+        self.assertEqual(self.git.branches()['master'], commit_hex,
+                         'no commit for failed changes')
+
+    def test_parent(self):
+        path = '/test_parent.txt'
+        hex = self.git.create_content('test for parent')
+        head = self.git.branches()['master']
+
+        commit_hex = self.git.create_entry('master', path, hex, parent=head,
+                                           author_name='foo',
+                                           author_email='foo@example.com')
+        self.assertEqual(self.git.branches()['master'], commit_hex)
+
+        hex_new = self.git.create_content('test for parent (new)')
+        for method, args in [
+            (self.git.create_entry, ('/other.txt', hex_new)),
+            (self.git.update_entry, (path, hex_new)),
+            (self.git.delete_entry, (path,)),
+            (self.git.apply_changes, ([{'action': 'delete',
+                                        'path': path}],)),
+        ]:
+            self.assertRaises(ConflictException, method, 'master', *args,
+                              parent=head)
+        self.assertEqual(self.git.branches()['master'], commit_hex,
+                         'stale writes are rejected')
+
+        # the branch moves while a commit is being made
+        other = Git(self.git.repo.path)
+        other.update_entry('master', path, hex_new,
+                           author_name='foo', author_email='foo@example.com')
+        tree = self.git.commit_tree(commit_hex)
+        self.assertRaises(ConflictException, self.git._commit, 'master',
+                          tree.oid, Signature('foo', 'foo@example.com'), '',
+                          commit_hex)
+
+    def test_retries(self):
+        hex = self.git.create_content('test for retries')
+        head = self.git.branches()['master']
+        self.git.create_entry('master', '/dir/other.txt', hex,
+                              author_name='foo',
+                              author_email='foo@example.com')
+
+        stats = {}
+        commit_hex = self.git.create_entry('master', '/dir/mine.txt', hex,
+                                           parent=head, retries=2,
+                                           stats=stats,
+                                           author_name='foo',
+                                           author_email='foo@example.com')
+        self.assertEqual(stats['retries'], 1)
+        self.assertEqual(self.git.branches()['master'], commit_hex)
+        self.assertTrue(self.git.find_entry('/dir/other.txt',
+                                            branch='master'))
+        self.assertTrue(self.git.find_entry('/dir/mine.txt',
+                                            branch='master'))
+
+        # the path itself has been modified
+        hex_new = self.git.create_content('test for retries (new)')
+        self.assertRaises(ConflictException, self.git.update_entry,
+                          'master', '/dir/other.txt', hex_new,
+                          parent=head, retries=2)
+        self.assertRaises(ConflictException, self.git.apply_changes,
+                          'master', [{'action': 'delete',
+                                      'path': '/dir/other.txt'}],
+                          parent=head, retries=2)
+
+        stats = {}
+        self.git.delete_entry('master', '/.git-placeholder', parent=head,
+                              retries=1, stats=stats, author_name='foo',
+                              author_email='foo@example.com')
+        self.assertEqual(stats['retries'], 1)
+
     def test_tags(self):
         path = '/text_create_tag.txt'
         content = 'test for create_tag'
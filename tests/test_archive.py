@@ -0,0 +1,219 @@
+import unittest
+import os
+import tarfile
+import threading
+import zipfile
+import testutil
+from StringIO import StringIO
+from gitfile.git import *
+from gitfile.archive import *
+
+PLACEHOLDER = '.git-placeholder'
+
+
+class ArchiveTest(unittest.TestCase):
+
+    def setUp(self):
+        testutil.cleanup()
+        testutil.init_repo('foo.git')
+        self.git = Git(os.path.join(testutil.GIT_DIR, 'foo.git'))
+        testutil.create_empty_branch(self.git.repo)
+
+        self.contents = {
+            'a.txt': 'a',
+            'bin/run.sh': '#!/bin/sh\n',
+            'dir/sub/big.txt': ''.join('line %d\n' % i for i in range(5000)),
+        }
+        modes = {'bin/run.sh': 0o100755}
+        for path, content in sorted(self.contents.items()):
+            self.git.create_entry('master', '/' + path,
+                                  self.git.create_content(content),
+                                  mode=modes.get(path),
+                                  author_name='foo',
+                                  author_email='foo@example.com')
+        self.git.create_entry('master', '/link',
+                              self.git.create_content('a.txt'),
+                              mode=0o120000, author_name='foo',
+                              author_email='foo@example.com')
+        self.tree_hex = self.git.find_entry('/', branch='master').hex
+
+    def archive(self, format):
+        return ''.join(iter_archive(self.git, self.tree_hex, format))
+
+    def assertTar(self, tar):
+        files = dict((x.name, x) for x in tar.getmembers()
+                     if x.name != PLACEHOLDER)
+        self.assertEqual(sorted(files), ['a.txt', 'bin', 'bin/run.sh', 'dir',
+                                         'dir/sub', 'dir/sub/big.txt',
+                                         'link'])
+        for path, content in self.contents.items():
+            self.assertEqual(tar.extractfile(path).read(), content)
+        self.assertTrue(files['dir/sub'].isdir())
+        self.assertEqual(files['bin/run.sh'].mode, 0o755)
+        self.assertEqual(files['a.txt'].mode, 0o644)
+        self.assertTrue(files['link'].issym())
+        self.assertEqual(files['link'].linkname, 'a.txt')
+
+    def test_tar(self):
+        data = self.archive('tar')
+        self.assertEqual(len(data) % 512, 0)
+        self.assertTar(tarfile.open(fileobj=StringIO(data)))
+        self.assertEqual(self.archive('tar'), data, 'reproducible')
+
+    def test_tar_gz(self):
+        data = self.archive('tar.gz')
+        self.assertTar(tarfile.open(fileobj=StringIO(data), mode='r:gz'))
+
+    def test_zip(self):
+        z = zipfile.ZipFile(StringIO(self.archive('zip')))
+        self.assertEqual(z.testzip(), None)
+        self.assertEqual(sorted(set(z.namelist()) - set([PLACEHOLDER])),
+                         ['a.txt', 'bin/', 'bin/run.sh', 'dir/', 'dir/sub/',
+                          'dir/sub/big.txt', 'link'])
+        for path, content in self.contents.items():
+            self.assertEqual(z.read(path), content)
+        info = z.getinfo('bin/run.sh')
+        self.assertEqual(info.external_attr >> 16, 0o100755)
+        self.assertEqual(z.getinfo('link').external_attr >> 16, 0o120777)
+        self.assertEqual(z.read('link'), 'a.txt')
+
+    def test_non_ascii_names(self):
+        names = ['caf\xc3\xa9.txt', 'not-utf8-\xff.txt']
+        for name in names:
+            self.git.create_entry('master', '/' + name,
+                                  self.git.create_content(name),
+                                  author_name='foo',
+                                  author_email='foo@example.com')
+        self.tree_hex = self.git.find_entry('/', branch='master').hex
+
+        tar = tarfile.open(fileobj=StringIO(self.archive('tar')))
+        for name in names:
+            self.assertEqual(tar.extractfile(name).read(), name,
+                             'names are kept as they are')
+
+        z = zipfile.ZipFile(StringIO(self.archive('zip')))
+        self.assertEqual(z.testzip(), None)
+        utf8 = z.getinfo(names[0].decode('utf-8'))
+        self.assertTrue(utf8.flag_bits & 0x800, 'marked as UTF-8')
+        self.assertEqual(z.read(utf8), names[0])
+        other = z.getinfo(names[1])
+        self.assertFalse(other.flag_bits & 0x800)
+        self.assertFalse(z.getinfo('a.txt').flag_bits & 0x800)
+
+    def test_zip64(self):
+        import gitfile.archive
+        limits = gitfile.archive.ZIP64_LIMIT, \
+            gitfile.archive.ZIP_FILECOUNT_LIMIT
+        # small limits make the archive use every ZIP64 record
+        gitfile.archive.ZIP64_LIMIT = 1000
+        gitfile.archive.ZIP_FILECOUNT_LIMIT = 3
+        try:
+            data = self.archive('zip')
+        finally:
+            gitfile.archive.ZIP64_LIMIT, \
+                gitfile.archive.ZIP_FILECOUNT_LIMIT = limits
+
+        z = zipfile.ZipFile(StringIO(data))
+        self.assertEqual(z.testzip(), None)
+        for path, content in self.contents.items():
+            self.assertEqual(z.read(path), content)
+        self.assertEqual(len(z.infolist()), 8)
+        self.assertEqual(z.read('link'), 'a.txt')
+        offset = z.getinfo('link').header_offset
+        self.assertTrue(offset > 1000)
+        self.assertEqual(data[offset:offset + 4], 'PK\x03\x04')
+        self.assertTrue('PK\x06\x06' in data, 'ZIP64 end record')
+
+    def test_cache(self):
+        cache_dir = os.path.join(testutil.GIT_DIR, 'archives')
+        cache = ArchiveCache.for_repo(self.git.repo, cache_dir=cache_dir)
+        self.assertTrue(ArchiveCache.for_repo(self.git.repo,
+                                              cache_dir=cache_dir) is cache)
+        self.assertEqual(os.path.dirname(cache.path), cache_dir,
+                         'kept outside of the repository')
+        cache = ArchiveCache(os.path.join(cache_dir, 'test'))
+        self.assertEqual(cache.open(self.tree_hex, 'tar'), None)
+
+        data = ''.join(cache.store(self.tree_hex, 'tar',
+                                   self.make_archive('tar')))
+        self.assertEqual(data, self.archive('tar'))
+        f = cache.open(self.tree_hex, 'tar')
+        self.assertEqual(f.read(), data)
+        f.close()
+        self.assertEqual(''.join(cache.store(self.tree_hex, 'tar', None)),
+                         data, 'read from the cache')
+        self.assertEqual(cache.stats(), {'hits': 1, 'misses': 1})
+        self.assertEqual(cache.size, len(data))
+
+        cache.max_bytes = len(data)
+        os.utime(cache.file_path(self.tree_hex, 'tar'), (0, 0))
+        for format in ['zip', 'tar.gz']:
+            list(cache.store(self.tree_hex, format,
+                             self.make_archive(format)))
+        self.assertEqual(sorted(os.listdir(cache.path)),
+                         ['%s.%s' % (self.tree_hex, x)
+                          for x in ['tar.gz', 'zip']],
+                         'the least recently used archive is evicted')
+        self.assertEqual(cache.size, sum(
+            os.path.getsize(os.path.join(cache.path, x))
+            for x in os.listdir(cache.path)))
+
+    def test_cache_default_dir(self):
+        import gitfile.archive
+        default_dir = gitfile.archive.DEFAULT_ARCHIVE_CACHE_DIR
+        try:
+            path = gitfile.archive.DEFAULT_ARCHIVE_CACHE_DIR = \
+                os.path.join(testutil.GIT_DIR, 'private')
+            cache = ArchiveCache.for_repo(self.git.repo)
+            self.assertEqual(os.path.dirname(cache.path), path)
+            self.assertEqual(os.stat(path).st_mode & 0o777, 0o700)
+
+            path = gitfile.archive.DEFAULT_ARCHIVE_CACHE_DIR = \
+                os.path.join(testutil.GIT_DIR, 'shared')
+            os.mkdir(path)
+            os.chmod(path, 0o777)
+            self.assertRaises(IOError, ArchiveCache.for_repo, self.git.repo)
+        finally:
+            gitfile.archive.DEFAULT_ARCHIVE_CACHE_DIR = default_dir
+
+    def test_cache_concurrent_build(self):
+        cache = ArchiveCache(os.path.join(testutil.GIT_DIR, 'archives'))
+        parts = ['x' * CACHE_CHUNK_SIZE, 'y' * 10]
+        gate = threading.Event()
+        made = []
+
+        def make():
+            made.append(True)
+            yield parts[0]
+            gate.wait()
+            yield parts[1]
+
+        slow = cache.store(self.tree_hex, 'tar', make)
+        self.assertEqual(next(slow), parts[0])
+        self.assertEqual(cache.open(self.tree_hex, 'tar'), None,
+                         'not visible until complete')
+        other = cache.store(self.tree_hex, 'tar', make)
+        self.assertEqual(next(other), parts[0],
+                         'read as it is written')
+        gate.set()
+        self.assertEqual(''.join(other), parts[1],
+                         'not held back by the slow reader')
+        self.assertEqual(made, [True], 'made once')
+        self.assertEqual(cache.open(self.tree_hex, 'tar').read(),
+                         ''.join(parts))
+        self.assertEqual(''.join(slow), parts[1])
+
+        def broken():
+            yield 'x'
+            raise IOError('broken')
+        self.assertRaises(IOError, list, cache.store(self.tree_hex, 'zip',
+                                                     broken))
+        self.assertEqual(cache.open(self.tree_hex, 'zip'), None)
+        self.assertEqual([x for x in os.listdir(cache.path)
+                          if x.startswith('tmp_')], [])
+
+    def make_archive(self, format):
+        return lambda: iter_archive(self.git, self.tree_hex, format)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+import unittest
+import testutil
+import os
+from gitfile.git import *
+from gitfile.cache import LRUCache
+
+
+class CacheTest(unittest.TestCase):
+
+    def setUp(self):
+        pass
+
+    def tearDown(self):
+        pass
+
+    def test_get_set(self):
+        cache = LRUCache(2)
+        self.assertEqual(cache.get('a'), None)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+        self.assertFalse('b' in cache, 'least recently used is evicted')
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+
+        stats = cache.stats()
+        self.assertEqual(stats['hits'], 3)
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['evictions'], 1)
+
+    def test_sizeof(self):
+        cache = LRUCache(10, sizeof=lambda key, value: len(value))
+        cache.set('a', 'x' * 6)
+        cache.set('b', 'x' * 4)
+        self.assertEqual(cache.size, 10)
+        cache.set('c', 'x')
+        self.assertFalse('a' in cache)
+        self.assertEqual(cache.size, 5)
+
+        cache.set('d', 'x' * 11)
+        self.assertFalse('d' in cache, 'too large to be cached')
+        self.assertEqual(cache.pop('b'), 'x' * 4)
+        self.assertEqual(cache.size, 1)
+
+    def test_on_evict(self):
+        evicted = []
+        cache = LRUCache(2, on_evict=lambda *args: evicted.append(args))
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.set('c', 3)
+        self.assertEqual(evicted, [('a', 1)])
+        cache.pop('b')
+        self.assertEqual(evicted, [('a', 1)], 'not called on pop')
+
+    def test_tree_cache(self):
+        testutil.cleanup()
+        testutil.init_repo('foo.git')
+        path = os.path.join(testutil.GIT_DIR, 'foo.git')
+        git = Git(path)
+        testutil.create_empty_branch(git.repo)
+        git.cache.clear()
+        before = git.cache.stats()
+
+        self.assertTrue(Git(path).cache is git.cache,
+                        'shared by Git objects for the same repository')
+
+        entry = git.find_entry('/.git-placeholder', branch='master')
+        self.assertTrue(entry)
+        self.assertTrue(git.find_entry('.git-placeholder', branch='master')
+                        is entry, 'entry is cached')
+        self.assertFalse(git.find_entry('/foo', branch='master'))
+        self.assertFalse(git.find_entry('/foo', branch='master'))
+
+        stats = git.cache.stats()
+        for key, hits, misses in [('entries', 2, 2), ('commits', 3, 1)]:
+            self.assertEqual(stats[key]['hits'] - before[key]['hits'], hits)
+            self.assertEqual(stats[key]['misses'] - before[key]['misses'],
+                             misses)
+
+        tree_hex = git.tree_hex(branch='master')
+        entries = git.tree_entries(tree_hex)
+        self.assertEqual([x.name for x in entries], ['.git-placeholder'])
+        self.assertTrue(git.tree_entries(tree_hex) is entries)
+
+        git.close()
+        self.assertEqual(git.cache.stats()['listings']['items'], 0,
+                         'cleared when the repository is released')
+        self.assertFalse(Git(path).cache is git.cache)
@@ -0,0 +1,76 @@
+import unittest
+import json
+import zlib
+from gitfile.encoder import *
+
+
+class EncoderTest(unittest.TestCase):
+
+    def test_iter_json(self):
+        obj = {'b': [1, 'two', None, {'x': True}], 'a': {}, 'c': [],
+               'd': 'quote " and unicode \xc3\xa9'}
+        compact = ''.join(iter_json(obj))
+        self.assertEqual(compact, json.dumps(obj, sort_keys=True,
+                                             separators=(',', ':')))
+
+        pretty = ''.join(iter_json(obj, indent=4))
+        self.assertEqual(json.loads(pretty), json.loads(compact))
+        self.assertTrue('\n        1,\n' in pretty)
+        self.assertEqual(pretty.splitlines()[0], '{')
+        self.assertEqual(pretty.splitlines()[-1], '}')
+
+    def test_lazy(self):
+        consumed = []
+
+        def entries():
+            for i in range(3):
+                consumed.append(i)
+                yield {'name': 'file%d' % i}
+
+        obj = {'entries': entries(),
+               'refs': LazyObject(iter([('z', 1), ('a', 2)]))}
+        self.assertTrue(is_lazy(obj))
+        self.assertFalse(is_lazy({'entries': [{'a': 1}]}))
+
+        chunks = iter_json(obj)
+        self.assertEqual(consumed, [], 'nothing is read before encoding')
+        self.assertEqual(''.join(chunks),
+                         '{"entries":[{"name":"file0"},{"name":"file1"},'
+                         '{"name":"file2"}],"refs":{"z":1,"a":2}}')
+        self.assertEqual(consumed, [0, 1, 2])
+
+    def test_iter_ndjson(self):
+        lines = ''.join(iter_ndjson({
+            'name': 'master',
+            'entries': ({'name': 'file%d' % i} for i in range(2)),
+        })).splitlines()
+        self.assertEqual(lines, ['{"name":"master"}', '{"name":"file0"}',
+                                 '{"name":"file1"}'])
+
+        lines = ''.join(iter_ndjson({
+            'entries': LazyObject(iter([('master', 'a' * 40)])),
+        })).splitlines()
+        self.assertEqual(lines, ['{"master":"%s"}' % ('a' * 40)])
+
+    def test_buffer_chunks(self):
+        chunks = list(buffer_chunks(('x' * 10 for i in range(25)), 100))
+        self.assertEqual([len(x) for x in chunks], [100, 100, 50])
+        self.assertEqual(list(buffer_chunks([])), [])
+
+    def test_compress(self):
+        data = 'x' * 100000
+        self.assertEqual(zlib.decompress(compress(data), 16 + zlib.MAX_WBITS),
+                         data)
+        chunks = compress_chunks(iter([data[:10], '', data[10:]]))
+        self.assertEqual(zlib.decompress(''.join(chunks),
+                                         16 + zlib.MAX_WBITS), data)
+        self.assertEqual(content_encodings()[-1], 'gzip')
+
+    @unittest.skipUnless(brotli, 'brotli is required')
+    def test_compress_brotli(self):
+        data = 'x' * 100000
+        self.assertEqual(content_encodings()[0], 'br')
+        self.assertEqual(brotli.decompress(compress(data, 'br')), data)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+import unittest
+import testutil
+import os
+import threading
+from gitfile.git import *
+from gitfile.exceptions import *
+from gitfile.group_commit import GroupCommitQueue
+from pygit2 import Oid
+
+
+class GroupCommitQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        testutil.cleanup()
+        testutil.init_repo('foo.git')
+        git = Git(os.path.join(testutil.GIT_DIR, 'foo.git'))
+        testutil.create_empty_branch(git.repo)
+        self.git = git
+
+    def tearDown(self):
+        pass
+
+    def submit_all(self, queue, changes, authors=None):
+        results = [None] * len(changes)
+
+        def submit(i):
+            author = authors[i] if authors else 'foo'
+            try:
+                results[i] = queue.submit(changes[i],
+                                          author_name=author,
+                                          author_email=author +
+                                          '@example.com')
+            except Exception, e:
+                results[i] = e
+
+        threads = [threading.Thread(target=submit, args=(i,))
+                   for i in range(len(changes))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_submit(self):
+        queue = GroupCommitQueue(self.git, 'master', max_batch=8,
+                                 max_latency=0.2)
+        hex = self.git.create_content('test_submit')
+        changes = [{'action': 'create', 'path': '/dir/file%d' % i,
+                    'sha1': hex} for i in range(20)]
+        results = self.submit_all(queue, changes)
+
+        for result in results:
+            self.assertTrue(is_valid_hex(result), result)
+        self.assertTrue(len(set(results)) < len(changes),
+                        'writes are grouped')
+        self.assertEqual(queue.stats()['writes'], 20)
+        self.assertEqual(queue.stats()['batches'], len(set(results)))
+        for change in changes:
+            self.assertTrue(self.git.find_entry(change['path'],
+                                                branch='master'))
+        self.assertTrue(self.git.branches()['master'] in results)
+
+    def test_authors(self):
+        queue = GroupCommitQueue(self.git, 'master', max_latency=0.2)
+        hex = self.git.create_content('test_authors')
+        changes = [{'action': 'create', 'path': '/file%d' % i, 'sha1': hex}
+                   for i in range(6)]
+        authors = ['foo', 'bar'] * 3
+        results = self.submit_all(queue, changes, authors)
+        for commit, author in zip(results, authors):
+            self.assertEqual(self.git.repo[Oid(hex=commit)].author.name,
+                             author)
+        self.assertEqual(len(set(results)), queue.stats()['batches'])
+        self.assertTrue(queue.stats()['batches'] < 6, 'writes are grouped')
+
+    def test_invalid_change(self):
+        queue = GroupCommitQueue(self.git, 'master', max_latency=0.2)
+        hex = self.git.create_content('test_invalid_change')
+        changes = [
+            {'action': 'create', 'path': '/file1', 'sha1': hex},
+            {'action': 'update', 'path': '/nothing', 'sha1': hex},
+            {'action': 'create', 'path': '/file2', 'sha1': hex},
+        ]
+        results = self.submit_all(queue, changes)
+        self.assertTrue(is_valid_hex(results[0]))
+        self.assertTrue(isinstance(results[1], InvalidParamException))
+        self.assertTrue(is_valid_hex(results[2]))
+        self.assertTrue(self.git.find_entry('/file1', branch='master'))
+        self.assertTrue(self.git.find_entry('/file2', branch='master'))
+
+    def test_for_branch(self):
+        queue = GroupCommitQueue.for_branch(self.git, 'master')
+        self.assertTrue(GroupCommitQueue.for_branch(self.git, 'master')
+                        is queue)
+        self.assertTrue(GroupCommitQueue.for_branch(self.git, 'other')
+                        is not queue)
+
+        hex = self.git.create_content('test_for_branch')
+        queue.submit({'action': 'create', 'path': '/file', 'sha1': hex},
+                     author_name='foo', author_email='foo@example.com')
+        self.assertTrue(GroupCommitQueue.for_branch(self.git, 'master')
+                        is not queue, 'idle queues are dropped')
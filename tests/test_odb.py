@@ -0,0 +1,220 @@
+import unittest
+import testutil
+import os
+import subprocess
+import zlib
+from gitfile.git import *
+from gitfile.odb import ObjectDatabase, PackWriter
+from StringIO import StringIO
+from pygit2 import Oid
+
+
+def has_git_command():
+    try:
+        subprocess.check_output(['git', '--version'])
+    except (OSError, subprocess.CalledProcessError):
+        return False
+    return True
+
+
+class ObjectDatabaseTest(unittest.TestCase):
+
+    def setUp(self):
+        testutil.cleanup()
+        testutil.init_repo('foo.git')
+        self.path = os.path.join(testutil.GIT_DIR, 'foo.git')
+        self.git = Git(self.path)
+        # drop the packs of the repository removed by cleanup()
+        self.git.close()
+        self.odb = self.git.odb = ObjectDatabase.for_repo(self.git.repo)
+        testutil.create_empty_branch(self.git.repo)
+
+    def tearDown(self):
+        pass
+
+    def create_objects(self):
+        content = ''.join('line %d\n' % i for i in range(2000))
+        hexes = []
+        self.contents = {}
+        for i in range(5):
+            content += 'more %d\n' % i
+            hex = self.git.create_content(content)
+            hexes.append(hex)
+            self.contents[hex] = content
+            self.git.create_entry('master', '/file.txt', hex,
+                                  author_name='foo',
+                                  author_email='foo@example.com')
+        return hexes
+
+    def assertHeaders(self, hexes):
+        for hex in hexes:
+            obj = self.git.repo[Oid(hex=hex)]
+            self.assertEqual(self.odb.read_header(hex),
+                             (obj.type, len(obj.read_raw())))
+
+    def assertContents(self):
+        for hex, content in self.contents.items():
+            for start, end in [(0, None), (0, 10), (5000, 7000),
+                               (len(content) - 3, len(content))]:
+                chunks = self.git.iter_content(hex, start, end,
+                                               chunk_size=1000)
+                self.assertEqual(''.join(chunks), content[start:end])
+
+    def test_loose(self):
+        hexes = self.create_objects()
+        hexes.append(self.git.find_entry('/', branch='master').hex)
+        hexes.append(self.git.branches()['master'])
+        self.assertHeaders(hexes)
+        self.assertEqual(self.odb.read_header('1' * 40), None)
+        self.assertTrue(ObjectDatabase.for_repo(self.git.repo) is self.odb)
+        self.assertContents()
+
+        # the loose file is opened once the content is read
+        path = self.odb.loose_path(hexes[0])
+        chunks = self.odb.iter_content(hexes[0])
+        os.rename(path, path + '.moved')
+        self.assertRaises(IOError, list, chunks)
+        os.rename(path + '.moved', path)
+
+    @unittest.skipUnless(has_git_command(), 'git command is required')
+    def test_packed(self):
+        hexes = self.create_objects()
+        hexes.append(self.git.find_entry('/', branch='master').hex)
+        hexes.append(self.git.branches()['master'])
+        subprocess.check_call(['git', 'repack', '-a', '-d', '-q', '-f'],
+                              cwd=self.path)
+        self.assertFalse(os.path.exists(self.odb.loose_path(hexes[0])))
+        self.assertHeaders(hexes)
+        self.assertTrue(self.odb.packs(), 'pack found')
+        self.assertContents()
+        self.assertTrue(
+            [x for x in self.contents if self.odb.iter_content(x) is None],
+            'some of the objects are deltified')
+        for hex, content in self.contents.items():
+            deflated = self.odb.deflated_content(hex)
+            if self.odb.iter_content(hex) is None:
+                self.assertEqual(deflated, None)
+            else:
+                self.assertEqual(zlib.decompress(''.join(deflated[1])),
+                                 content)
+        self.assertEqual(self.odb.read_header('1' * 40), None)
+
+        loose = self.git.create_content('loose')
+        self.assertEqual(self.odb.location(loose), None)
+        self.assertEqual(self.odb.location('1' * 40), None)
+        locations = [self.odb.location(x) for x in hexes]
+        self.assertTrue(None not in locations)
+        ordered = self.git.storage_order([loose] + hexes + hexes[:2])
+        self.assertEqual(ordered[-1], loose)
+        self.assertEqual([self.odb.location(x) for x in ordered[:-1]],
+                         sorted(locations))
+
+    def write_pack(self, contents):
+        writer = PackWriter(os.path.join(self.odb.path, 'pack'),
+                            exists=lambda hex: hex in self.git.repo)
+        hexes = [writer.add(GIT_OBJ_BLOB, len(x), StringIO(x).read, 7)
+                 for x in contents]
+        return hexes, writer.finish()
+
+    def test_pack_writer(self):
+        existing = self.git.create_content('existing')
+        contents = ['', 'foo', 'foo', 'existing',
+                    ''.join('line %d\n' % i for i in range(20000))]
+        hexes, path = self.write_pack(contents)
+
+        self.assertEqual(hexes[1], hexes[2])
+        self.assertEqual(hexes[3], existing)
+        self.assertTrue(path.endswith('.pack'))
+        self.assertTrue(os.path.exists(path[:-5] + '.idx'))
+        self.assertEqual(
+            [x for x in os.listdir(os.path.dirname(path))
+             if x.startswith('tmp_')], [], 'temporary files are gone')
+
+        # a new repository object sees the pack written behind libgit2
+        repo = Git(self.path).repo
+        for hex, content in zip(hexes, contents):
+            self.assertEqual(repo[Oid(hex=hex)].read_raw(), content)
+            self.assertEqual(self.odb.read_header(hex),
+                             (GIT_OBJ_BLOB, len(content)))
+        self.assertEqual(self.odb.location(existing), None, 'not repacked')
+        self.assertEqual(len(self.odb.packs()[0].index), 2)
+        self.assertEqual(''.join(self.odb.iter_content(hexes[4])),
+                         contents[4])
+
+        for hex, content in zip(hexes, contents)[4:0:-3]:
+            size, chunks = self.odb.deflated_content(hex, chunk_size=100)
+            data = ''.join(chunks)
+            self.assertEqual(len(data), size)
+            self.assertEqual(zlib.decompress(data), content)
+        self.assertEqual(self.odb.deflated_content(existing), None,
+                         'loose objects are not served deflated')
+
+        self.assertEqual(self.write_pack(['foo']), ([hexes[1]], None))
+        writer = PackWriter(os.path.join(self.odb.path, 'pack'))
+        self.assertRaises(EOFError, writer.add,
+                          GIT_OBJ_BLOB, 10, StringIO('short').read)
+        writer.abort()
+
+    @unittest.skipUnless(has_git_command(), 'git command is required')
+    def test_pack_writer_verify(self):
+        hexes, path = self.write_pack(['x' * i for i in range(1, 101)])
+        output = subprocess.check_output(['git', 'verify-pack', '-v', path],
+                                         cwd=self.path)
+        self.assertEqual(output.count(' blob '), 100)
+
+    def test_merge_small_packs(self):
+        contents = [['foo %d' % i, 'bar %d' % i] for i in range(3)]
+        hexes = sum((self.write_pack(x)[0] for x in contents), [])
+        self.assertEqual(self.odb.merge_small_packs(max_packs=4), None)
+        self.assertEqual(len(self.odb.packs()), 3)
+
+        path = self.odb.merge_small_packs(max_packs=3)
+        self.assertEqual([x.index.pack_path for x in self.odb.packs()],
+                         [path])
+        name = os.path.basename(path[:-5])
+        self.assertEqual(sorted(os.listdir(os.path.dirname(path))),
+                         [name + '.idx', name + '.pack'])
+        repo = Git(self.path).repo
+        for hex, content in zip(hexes, sum(contents, [])):
+            self.assertFalse(os.path.exists(self.odb.loose_path(hex)))
+            self.assertEqual(repo[Oid(hex=hex)].read_raw(), content)
+            self.assertEqual(self.odb.read_header(hex),
+                             (GIT_OBJ_BLOB, len(content)))
+        if has_git_command():
+            subprocess.check_call(['git', 'verify-pack', path],
+                                  cwd=self.path)
+
+    @unittest.skipUnless(has_git_command(), 'git command is required')
+    def test_merge_small_packs_deltas(self):
+        self.create_objects()
+        subprocess.check_call(['git', 'repack', '-a', '-d', '-q', '-f'],
+                              cwd=self.path)
+        self.write_pack(['foo'])
+        self.assertEqual(self.odb.merge_small_packs(max_packs=2), None,
+                         'packs with deltas are not merged')
+
+    def test_pack_reuse(self):
+        self.write_pack(['foo'])
+        pack = self.odb.packs()[0]
+        hexes, path = self.write_pack(['bar'])
+        self.assertEqual(self.odb.read_header(hexes[0]), (GIT_OBJ_BLOB, 3))
+        packs = self.odb.packs()
+        self.assertEqual(len(packs), 2)
+        self.assertTrue(pack in packs, 'unchanged pack is kept open')
+
+        size, chunks = self.odb.deflated_content(hexes[0])
+        self.odb.merge_small_packs(max_packs=2)
+        self.assertFalse(set(packs) & set(self.odb.packs()))
+        self.assertTrue(pack._closed, 'removed pack is closed')
+        reading = [x for x in packs if x.index.pack_path == path][0]
+        self.assertFalse(reading._closed, 'pack being read is kept open')
+        self.assertEqual(zlib.decompress(''.join(chunks)), 'bar')
+        self.assertTrue(reading._closed, 'closed once read')
+
+        merged = self.odb.packs()
+        self.odb.iter_content(hexes[0]).close()
+        ObjectDatabase.release(self.git.repo)
+        self.assertTrue(merged[0]._closed)
+        self.assertFalse(ObjectDatabase.for_repo(self.git.repo) is self.odb)
+        self.assertEqual(self.odb.read_header(hexes[0]), (GIT_OBJ_BLOB, 3),
+                         'released database reopens its packs')
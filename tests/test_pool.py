@@ -0,0 +1,101 @@
+import unittest
+import testutil
+import os
+import shutil
+import gc
+from StringIO import StringIO
+from gitfile.git import *
+from gitfile.cache import TreeCache
+from gitfile.odb import ObjectDatabase
+from gitfile.pool import GitPool
+
+
+class GitPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        testutil.cleanup()
+        testutil.init_repo('foo.git')
+        testutil.init_repo('bar')
+        testutil.init_repo('baz')
+
+    def tearDown(self):
+        pass
+
+    def test_get(self):
+        pool = GitPool(testutil.GIT_DIR)
+        git = pool.get('foo')
+        self.assertTrue(isinstance(git, Git))
+        self.assertTrue(pool.get('foo') is git, 'reused from the pool')
+        self.assertTrue(pool.get('bar') is not git)
+        self.assertEqual(pool.get('qux'), None, 'no such repository')
+
+        stats = pool.stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 3)
+
+    def test_eviction(self):
+        pool = GitPool(testutil.GIT_DIR, max_size=2)
+        foo = pool.get('foo')
+        pool.get('bar')
+        pool.get('foo')
+        pool.get('baz')
+        self.assertEqual(pool.stats()['evictions'], 1)
+        self.assertTrue(pool.get('foo') is foo, 'foo was recently used')
+        self.assertEqual(pool.stats()['items'], 2)
+
+        baz = Git(os.path.join(testutil.GIT_DIR, 'baz'))
+        odb = baz.odb
+        cache = baz.cache
+        pool.get('bar')
+        self.assertFalse(ObjectDatabase.for_repo(baz.repo) is odb,
+                         'evicted repository is released')
+        self.assertFalse(TreeCache.for_repo(baz.repo.path) is cache)
+
+    @unittest.skipUnless(os.path.isdir('/proc/self/fd'),
+                         '/proc/self/fd is required')
+    def test_eviction_closes_packs(self):
+        names = ['repo%d' % i for i in range(6)]
+        for name in names:
+            testutil.init_repo(name)
+            git = Git(os.path.join(testutil.GIT_DIR, name))
+            testutil.create_empty_branch(git.repo)
+            sha1, = git.create_contents_from_stream(StringIO('3\nabc'))
+            git.create_entry('master', '/dir/file', sha1,
+                             author_name='foo',
+                             author_email='foo@example.com')
+            git.close()
+
+        pool = GitPool(testutil.GIT_DIR, max_size=2)
+        for name in names:
+            git = pool.get(name)
+            entry = git.find_entry('/dir/file', branch='master')
+            self.assertEqual(git.get_content(entry.hex), 'abc')
+        del git
+        gc.collect()
+
+        open_packs = set()
+        for fd in os.listdir('/proc/self/fd'):
+            try:
+                path = os.readlink('/proc/self/fd/' + fd)
+            except OSError:
+                continue
+            if path.endswith('.pack'):
+                open_packs.add(path[len(testutil.GIT_DIR) + 1:].split('/')[0])
+        self.assertTrue(open_packs <= set(names[-2:]),
+                        'packs of evicted repositories are closed')
+
+    def test_invalidation(self):
+        pool = GitPool(testutil.GIT_DIR)
+        git = pool.get('bar')
+
+        shutil.rmtree(os.path.join(testutil.GIT_DIR, 'bar'))
+        self.assertEqual(pool.get('bar'), None, 'repository removed')
+        self.assertEqual(pool.stats()['invalidations'], 1)
+
+        testutil.init_repo('bar')
+        new_git = pool.get('bar')
+        self.assertTrue(new_git is not None and new_git is not git,
+                        'replaced repository is reopened')
+
+        pool.invalidate('bar')
+        self.assertTrue(pool.get('bar') is not new_git)
@@ -0,0 +1,109 @@
+import unittest
+import testutil
+import os
+from gitfile.git import *
+from gitfile.refs import RefIndex
+
+
+class RefIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        testutil.cleanup()
+        testutil.init_repo('foo.git')
+        self.path = os.path.join(testutil.GIT_DIR, 'foo.git')
+        self.git = Git(self.path)
+        self.head = testutil.create_empty_branch(self.git.repo).hex
+        self.index = RefIndex.for_repo(self.git.repo)
+
+    def tearDown(self):
+        pass
+
+    def test_for_repo(self):
+        self.assertTrue(self.index is self.git.ref_index)
+        self.assertTrue(RefIndex.for_repo(Git(self.path).repo) is self.index)
+
+    def test_iter_refs(self):
+        for name in ['release/1.0', 'release/1.1', 'release/2.0', 'v1']:
+            self.git.create_tag(name, self.head)
+        self.git.create_branch('release', self.head)
+
+        self.assertEqual(list(self.index.iter_refs('refs/heads/')),
+                         [('refs/heads/master', self.head),
+                          ('refs/heads/release', self.head)])
+        self.assertEqual([x[0] for x in self.git.iter_refs('tags')],
+                         ['release/1.0', 'release/1.1', 'release/2.0', 'v1'])
+        self.assertEqual([x[0] for x in self.git.iter_refs('tags',
+                                                           'release/1')],
+                         ['release/1.0', 'release/1.1'])
+        self.assertEqual([x[0] for x in self.git.iter_refs(
+            'tags', 'release/', after='release/1.1')],
+            ['release/2.0'])
+        self.assertEqual(list(self.git.iter_refs('tags', 'x')), [])
+
+    def age_refs(self):
+        for dir_path, _, _ in os.walk(os.path.join(self.path, 'refs')):
+            os.utime(dir_path, (0, 0))
+
+    def test_reload(self):
+        self.age_refs()
+        self.assertEqual(self.git.branches(), {'master': self.head})
+        reloads = self.index.reloads
+        for i in range(3):
+            self.git.branches()
+            self.git.tags()
+        self.assertEqual(self.index.reloads, reloads, 'snapshot reused')
+
+        self.git.create_branch('foo/bar', self.head)
+        self.assertEqual(sorted(self.git.branches()), ['foo/bar', 'master'])
+        self.git.delete_branch('foo/bar')
+        self.assertEqual(sorted(self.git.branches()), ['master'])
+
+        commit = self.git.create_entry('master', '/foo.txt',
+                                       self.git.create_content('foo'),
+                                       author_name='foo',
+                                       author_email='foo@example.com')
+        self.assertEqual(self.git.branches(), {'master': commit})
+
+    def test_racy_snapshot(self):
+        commit = self.git.create_entry('master', '/foo.txt',
+                                       self.git.create_content('foo'),
+                                       author_name='foo',
+                                       author_email='foo@example.com')
+        self.assertEqual(self.git.branches(), {'master': commit})
+
+        # a ref moved in the same tick as the load, leaving the mtime and
+        # the size of its directory as they were
+        with open(os.path.join(self.path, 'refs', 'heads', 'master'),
+                  'r+b') as f:
+            f.write(self.head + '\n')
+        self.assertEqual(self.git.branches(), {'master': self.head})
+
+    def test_packed_refs(self):
+        with open(os.path.join(self.path, 'packed-refs'), 'wb') as f:
+            f.write('# pack-refs with: peeled fully-peeled \n')
+            f.write('%s refs/heads/packed\n' % self.head)
+            f.write('%s refs/tags/packed\n' % self.head)
+            f.write('^%s\n' % self.head)
+        os.symlink('master', os.path.join(self.path, 'refs', 'heads',
+                                          'link'))
+        with open(os.path.join(self.path, 'refs', 'heads', 'sym'),
+                  'wb') as f:
+            f.write('ref: refs/heads/packed\n')
+
+        self.assertEqual(self.git.branches(), {'link': self.head,
+                                               'master': self.head,
+                                               'packed': self.head,
+                                               'sym': self.head})
+        self.assertEqual(self.git.tags(), {'packed': self.head})
+        self.assertTrue(self.git.has_branch('packed'))
+        self.assertTrue(self.git.has_tag('packed'))
+
+    def test_has_ref(self):
+        self.assertTrue(self.git.has_branch('master'))
+        self.assertFalse(self.git.has_branch('foo'))
+        self.assertFalse(self.git.has_branch('..'))
+        self.assertFalse(self.git.has_tag('master'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,6 +2,10 @@ import unittest
 import testutil
 import os
 import json
+import tarfile
+import zipfile
+import zlib
+from StringIO import StringIO
 from werkzeug.test import Client
 from werkzeug.wrappers import BaseResponse
 from gitfile.git import *
@@ -68,6 +72,144 @@ class RESTServiceTest(unittest.TestCase):
         res = self.client.get('/foo/blobs/' + '1' * 40)
         self.assertEqual(res.status_code, 404, 'object not found')
 
+    def test_blob_range(self):
+        content = ''.join('%08d' % i for i in range(50000))
+        res = self.client.post('/foo/blobs', data=content)
+        sha1 = json.loads(res.data)['result']['sha1']
+
+        res = self.client.get('/foo/blobs/%s' % sha1)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers['Content-Length'], str(len(content)))
+        self.assertEqual(res.headers['Accept-Ranges'], 'bytes')
+        self.assertEqual(res.data, content)
+
+        res = self.client.head('/foo/blobs/%s' % sha1)
+        self.assertEqual(res.headers['Content-Length'], str(len(content)))
+
+        for header, start, end in [('bytes=10-19', 10, 20),
+                                   ('bytes=-5', len(content) - 5, None),
+                                   ('bytes=100000-', 100000, None)]:
+            res = self.client.get('/foo/blobs/%s' % sha1,
+                                  headers={'Range': header})
+            self.assertEqual(res.status_code, 206, header)
+            self.assertEqual(res.data, content[start:end], header)
+            self.assertEqual(res.headers['Content-Range'], 'bytes %d-%d/%d' %
+                             (start, (end or len(content)) - 1,
+                              len(content)))
+
+        res = self.client.get('/foo/blobs/%s' % sha1,
+                              headers={'Range': 'bytes=1000000-'})
+        self.assertEqual(res.status_code, 416)
+        self.assertEqual(res.headers['Content-Range'],
+                         'bytes */%d' % len(content))
+
+        res = self.client.get('/foo/blobs/%s' % sha1,
+                              headers={'Range': 'bytes=10-19',
+                                       'If-Range': '"%s"' % sha1})
+        self.assertEqual(res.status_code, 206)
+        res = self.client.get('/foo/blobs/%s' % sha1,
+                              headers={'Range': 'bytes=10-19',
+                                       'If-Range': '"%s"' % ('1' * 40)})
+        self.assertEqual(res.status_code, 200, 'If-Range does not match')
+        self.assertEqual(res.data, content)
+
+    def test_blob_batch(self):
+        contents = dict((self.git.create_content(x), x)
+                        for x in ['', 'foo', 'bar' * 30000])
+        missing = '1' * 40
+        res = self.client.post('/foo/blobs/batch', data=json.dumps({
+            'sha1s': contents.keys() + [missing, 'xyz'] + contents.keys()[:1],
+        }))
+        self.assertEqual(res.status_code, 200)
+
+        items = []
+        data = res.data
+        while data:
+            line, data = data.split('\n', 1)
+            header = json.loads(line)
+            size = header.get('size', 0)
+            items.append((header, data[:size]))
+            data = data[size:]
+
+        self.assertEqual(items[0], ({'sha1': 'xyz', 'status': 400}, ''))
+        found = dict((x['sha1'], content) for x, content in items
+                     if x['status'] == 200)
+        self.assertEqual(found, contents)
+        self.assertEqual(len(items), 5, 'each id once')
+        self.assertTrue(({'sha1': missing, 'status': 404}, '') in items)
+
+        for data in ['{}', '[]', '"foo"']:
+            res = self.client.post('/foo/blobs/batch', data=data)
+            self.assertEqual(res.status_code, 400)
+
+    def test_blob_exists(self):
+        blob = self.git.create_content('blah')
+        commit = self.git.branch_target('master')
+        missing = '1' * 40
+        res = self.client.post('/foo/blobs/exists', data=json.dumps({
+            'sha1s': [blob, missing, commit, 'xyz', blob],
+        }))
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(json.loads(res.data)['message'], None)
+        result = json.loads(res.data)['result']
+        self.assertEqual(result['entries'], {
+            blob: {'type': 'blob', 'size': 4},
+            commit: {'type': 'commit',
+                     'size': len(self.git.repo[Oid(hex=commit)].read_raw())},
+        })
+        self.assertEqual(sorted(result['missing']), [missing, 'xyz'])
+
+        for data in ['{}', '[]', '"foo"']:
+            res = self.client.post('/foo/blobs/exists', data=data)
+            self.assertEqual(res.status_code, 400)
+
+    def test_blob_limit(self):
+        client = Client(create_app(testutil.GIT_DIR, max_blob_size=10),
+                        BaseResponse)
+        res = client.post('/foo/blobs', data='x' * 10)
+        self.assertEqual(res.status_code, 201)
+        res = client.post('/foo/blobs', data='x' * 11)
+        self.assertEqual(res.status_code, 413, 'too large')
+
+    def test_caching(self):
+        res = self.client.post('/foo/blobs', data='test_caching')
+        sha1 = json.loads(res.data)['result']['sha1']
+
+        res = self.client.get('/foo/blobs/%s' % sha1)
+        self.assertEqual(res.headers['ETag'], '"%s"' % sha1)
+        self.assertTrue('immutable' in res.headers['Cache-Control'])
+        res = self.client.get('/foo/blobs/%s' % sha1,
+                              headers={'If-None-Match': '"%s"' % sha1})
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.data, '')
+
+        res = self.client.get('/foo/branches/master/.git-placeholder')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers['Cache-Control'], 'no-cache')
+        etag = res.headers['ETag']
+        res = self.client.get('/foo/branches/master/.git-placeholder',
+                              headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 304)
+        res = self.client.get('/foo/branches/master',
+                              headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 200, 'different resource')
+
+        commit = json.loads(res.data)['result']['sha1']
+        res = self.client.get('/foo/commits/%s/.git-placeholder' % commit)
+        self.assertEqual(res.headers['ETag'], etag)
+        self.assertTrue('immutable' in res.headers['Cache-Control'])
+
+        res = self.client.post('/foo/branches/master/file1',
+                               data=json.dumps({
+                                   'sha1': sha1,
+                                   'author_name': 'foo',
+                                   'author_email': 'foo@example.com',
+                               }))
+        res = self.client.get('/foo/branches/master/.git-placeholder',
+                              headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 200, 'branch has moved')
+        self.assertNotEqual(res.headers['ETag'], etag)
+
     def test_branch(self):
         res = self.client.get('/foo/branches')
         self.assertEqual(res.status_code, 200)
@@ -181,6 +323,484 @@ class RESTServiceTest(unittest.TestCase):
         self.assertEqual(res.status_code, 200, 'branch deleted')
         res = self.client.get('/foo/branches/branch1')
         self.assertEqual(res.status_code, 404)
+        for url in ['/foo/branches/branch1/dir2/file3',
+                    '/foo/branches/branch1/dir2/file3?raw=1',
+                    '/foo/tags/notag/dir2/file3']:
+            res = self.client.get(url)
+            self.assertEqual(res.status_code, 404, url)
+            self.assertTrue(json.loads(res.data)['error'])
+
+    def test_pagination(self):
+        for i in range(5):
+            self.git.create_tag('v%d' % i, self.git.branch_target('master'))
+            self.git.create_branch('b%d' % i, self.git.branch_target('master'))
+        sha1 = self.git.create_content('blah')
+        self.git.apply_changes('master', [
+            {'action': 'create', 'path': '/dir/file%d' % i, 'sha1': sha1}
+            for i in range(5)
+        ] + [{'action': 'create', 'path': '/dir/file1.d/x', 'sha1': sha1}],
+            author_name='foo', author_email='foo@example.com')
+
+        def pages(url):
+            names = []
+            cursor = None
+            while True:
+                page_url = url + ('&cursor=' + cursor if cursor else '')
+                res = self.client.get(page_url)
+                self.assertEqual(res.status_code, 200)
+                result = json.loads(res.data)['result']
+                entries = result['entries']
+                if isinstance(entries, dict):
+                    names.append(sorted(entries))
+                else:
+                    names.append([x['name'] for x in entries])
+                cursor = result.get('next_cursor')
+                if cursor is None:
+                    return names
+
+        self.assertEqual(pages('/foo/tags?limit=2'),
+                         [['v0', 'v1'], ['v2', 'v3'], ['v4']])
+        self.assertEqual(pages('/foo/branches?limit=3&prefix=b'),
+                         [['b0', 'b1', 'b2'], ['b3', 'b4']])
+        self.assertEqual(pages('/foo/branches?prefix=m'), [['master']])
+        self.assertEqual(pages('/foo/branches/master/dir?limit=2'),
+                         [['file0', 'file1'], ['file1.d', 'file2'],
+                          ['file3', 'file4']])
+        self.assertEqual(pages('/foo/commits/%s/dir?limit=4&prefix=file' %
+                               self.git.branch_target('master')),
+                         [['file0', 'file1', 'file1.d', 'file2'],
+                          ['file3', 'file4']])
+        self.assertEqual(pages('/foo/branches/master?prefix=d'), [['dir']])
+
+        res = self.client.get('/foo/tags?limit=0')
+        self.assertEqual(res.status_code, 400)
+        res = self.client.get('/foo/tags?limit=x')
+        self.assertEqual(res.status_code, 400)
+
+    def test_listing_formats(self):
+        sha1 = self.git.create_content('blah')
+        self.git.apply_changes('master', [
+            {'action': 'create', 'path': '/file%d' % i, 'sha1': sha1}
+            for i in range(3)
+        ], author_name='foo', author_email='foo@example.com')
+
+        res = self.client.get('/foo/branches/master')
+        self.assertEqual(res.status_code, 200)
+        self.assertFalse('\n' in res.data, 'compact by default')
+        self.assertFalse('Content-Length' in res.headers, 'streamed')
+        result = json.loads(res.data)['result']
+        self.assertEqual([x['name'] for x in result['entries']],
+                         ['.git-placeholder', 'file0', 'file1', 'file2'])
+
+        res = self.client.get('/foo/branches/master?pretty=1')
+        self.assertTrue('\n    "result": {' in res.data)
+        self.assertEqual(json.loads(res.data)['result'], result)
+
+        res = self.client.get('/foo/branches/master?limit=2&format=ndjson')
+        self.assertEqual(res.headers['Content-Type'], 'application/x-ndjson')
+        lines = [json.loads(x) for x in res.data.splitlines()]
+        self.assertEqual(lines[0], {'name': 'master', 'type': 'branch',
+                                    'sha1': result['sha1'],
+                                    'next_cursor': 'file0'})
+        self.assertEqual(lines[1:], result['entries'][:2])
+
+        res = self.client.get('/foo/branches',
+                              headers={'Accept': 'application/x-ndjson'})
+        self.assertEqual([json.loads(x) for x in res.data.splitlines()],
+                         [{'master': result['sha1']}])
+        self.assertTrue('Accept' in res.headers['Vary'])
+
+        res = self.client.get('/foo/commits/' + result['sha1'])
+        etag = res.headers['ETag']
+        self.assertTrue('Accept' in res.headers['Vary'])
+        ndjson = {'Accept': 'application/x-ndjson'}
+        res = self.client.get('/foo/commits/' + result['sha1'],
+                              headers=ndjson)
+        self.assertEqual(res.headers['Content-Type'], 'application/x-ndjson')
+        self.assertNotEqual(res.headers['ETag'], etag)
+        ndjson['If-None-Match'] = etag
+        res = self.client.get('/foo/commits/' + result['sha1'],
+                              headers=ndjson)
+        self.assertEqual(res.status_code, 200, 'not the JSON version')
+        ndjson['If-None-Match'] = res.headers['ETag']
+        res = self.client.get('/foo/commits/' + result['sha1'],
+                              headers=ndjson)
+        self.assertEqual(res.status_code, 304)
+        self.assertTrue('Accept' in res.headers['Vary'])
+
+    def test_recursive_listing(self):
+        sha1 = self.git.create_content('blah')
+        self.git.apply_changes('master', [
+            {'action': 'create', 'path': path, 'sha1': sha1}
+            for path in ['dir/a', 'dir/sub/b', 'dir/sub/deep/c', 'other']
+        ], author_name='foo', author_email='foo@example.com')
+
+        res = self.client.get('/foo/branches/master/dir?recursive=1')
+        self.assertEqual(res.status_code, 200)
+        entries = json.loads(res.data)['result']['entries']
+        self.assertEqual([(x['path'], x['type']) for x in entries],
+                         [('a', 'blob'), ('sub', 'tree'), ('sub/b', 'blob'),
+                          ('sub/deep', 'tree'), ('sub/deep/c', 'blob')])
+        self.assertEqual(entries[0]['size'], 4)
+        self.assertEqual(entries[0]['sha1'], sha1)
+
+        res = self.client.get('/foo/branches/master/dir?recursive=1&depth=2')
+        entries = json.loads(res.data)['result']['entries']
+        self.assertEqual([x['path'] for x in entries],
+                         ['a', 'sub', 'sub/b', 'sub/deep'])
+
+        paths = []
+        url = '/foo/branches/master?recursive=1&limit=2'
+        while url:
+            result = json.loads(self.client.get(url).data)['result']
+            paths.extend(x['path'] for x in result['entries'])
+            url = result.get('next_cursor') and \
+                '/foo/branches/master?recursive=1&limit=2&cursor=' + \
+                result['next_cursor']
+        self.assertEqual(paths, ['.git-placeholder', 'dir', 'dir/a',
+                                 'dir/sub', 'dir/sub/b', 'dir/sub/deep',
+                                 'dir/sub/deep/c', 'other'])
+
+        res = self.client.get('/foo/branches/master?recursive=1&depth=0')
+        self.assertEqual(res.status_code, 400)
+
+    def test_diff(self):
+        old = self.git.branch_target('master')
+        sha1 = self.git.create_content('blah')
+        new = self.git.create_entry('master', '/dir/a.txt', sha1,
+                                    author_name='foo',
+                                    author_email='foo@example.com')
+        self.git.create_tag('v1', old)
+
+        res = self.client.get('/foo/diff?from=v1&to=master')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers['Cache-Control'], 'no-cache')
+        result = json.loads(res.data)['result']
+        self.assertEqual((result['from'], result['to']), (old, new))
+        self.assertEqual(result['entries'], [{
+            'path': 'dir/a.txt', 'status': 'added',
+            'old_sha1': None, 'old_mode': None,
+            'new_sha1': sha1, 'new_mode': oct(DEFAULT_MODE_BLOB),
+        }])
+
+        res = self.client.get('/foo/diff?from=%s&to=%s&path=other' %
+                              (old, new))
+        self.assertEqual(json.loads(res.data)['result']['entries'], [])
+        self.assertTrue('immutable' in res.headers['Cache-Control'])
+
+        res = self.client.get('/foo/diff?from=v1')
+        self.assertEqual(res.status_code, 400)
+        res = self.client.get('/foo/diff?from=v1&to=nothing')
+        self.assertEqual(res.status_code, 404)
+
+    def test_log(self):
+        sha1 = self.git.create_content('blah')
+        commits = [self.git.branch_target('master')]
+        for path in ['/a.txt', '/b.txt', '/dir/a.txt']:
+            commits.append(self.git.create_entry(
+                'master', path, sha1, author_name='foo',
+                author_email='foo@example.com', comment='add ' + path))
+
+        res = self.client.get('/foo/log/master')
+        self.assertEqual(res.status_code, 200)
+        entries = json.loads(res.data)['result']['entries']
+        self.assertEqual([x['sha1'] for x in entries], commits[::-1])
+        self.assertEqual(entries[0]['message'], 'add /dir/a.txt')
+        self.assertEqual(entries[0]['author']['email'], 'foo@example.com')
+        self.assertEqual(entries[0]['parents'], [commits[2]])
+
+        res = self.client.get('/foo/log/master?path=dir')
+        entries = json.loads(res.data)['result']['entries']
+        self.assertEqual([x['sha1'] for x in entries], [commits[3]])
+
+        res = self.client.get('/foo/log/%s?limit=2' % commits[2])
+        result = json.loads(res.data)['result']
+        self.assertEqual([x['sha1'] for x in result['entries']],
+                         [commits[2], commits[1]])
+        res = self.client.get('/foo/log/%s?limit=2&cursor=%s' %
+                              (commits[2], result['next_cursor']))
+        result = json.loads(res.data)['result']
+        self.assertEqual([x['sha1'] for x in result['entries']],
+                         [commits[0]])
+        self.assertFalse('next_cursor' in result)
+        res = self.client.get('/foo/log/master?limit=2&cursor=foo')
+        self.assertEqual(res.status_code, 400)
+
+        res = self.client.get('/foo/log/nothing')
+        self.assertEqual(res.status_code, 404)
+
+    def test_raw(self):
+        sha1 = self.git.create_content('blah blah')
+        commit = self.git.create_entry('master', '/dir/a.txt', sha1,
+                                       author_name='foo',
+                                       author_email='foo@example.com')
+        self.git.create_tag('v1', commit)
+
+        for url in ['/foo/branches/master/dir/a.txt?raw=1',
+                    '/foo/tags/v1/dir/a.txt?raw=1',
+                    '/foo/commits/%s/dir/a.txt?raw=1' % commit]:
+            res = self.client.get(url)
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(res.data, 'blah blah')
+            self.assertEqual(res.headers['ETag'], '"%s"' % sha1)
+
+            res = self.client.get(url, headers={'If-None-Match': sha1})
+            self.assertEqual(res.status_code, 304)
+
+        self.assertEqual(res.headers['Cache-Control'],
+                         'public, max-age=31536000, immutable')
+        res = self.client.get('/foo/branches/master/dir/a.txt?raw=1',
+                              headers={'Range': 'bytes=5-'})
+        self.assertEqual(res.status_code, 206)
+        self.assertEqual(res.data, 'blah')
+        self.assertEqual(res.headers['Cache-Control'], 'no-cache')
+
+        res = self.client.get('/foo/branches/master/dir?raw=1')
+        self.assertEqual(res.status_code, 400)
+        res = self.client.get('/foo/branches/master/nothing?raw=1')
+        self.assertEqual(res.status_code, 404)
+
+    def test_compression(self):
+        sha1 = self.git.create_content('blah')
+        self.git.apply_changes('master', [
+            {'action': 'create', 'path': '/file%03d' % i, 'sha1': sha1}
+            for i in range(100)
+        ], author_name='foo', author_email='foo@example.com')
+
+        gzip = {'Accept-Encoding': 'gzip'}
+        res = self.client.get('/foo/branches/master', headers=gzip)
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertTrue('Accept-Encoding' in res.headers['Vary'])
+        data = zlib.decompress(res.data, 16 + zlib.MAX_WBITS)
+        self.assertEqual(len(json.loads(data)['result']['entries']), 101)
+        etag = res.headers['ETag']
+        self.assertTrue(etag.startswith('W/'), 'weak for a compressed body')
+        res = self.client.get('/foo/branches/master',
+                              headers={'Accept-Encoding': 'gzip',
+                                       'If-None-Match': etag})
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.headers['ETag'], etag)
+
+        res = self.client.get('/foo/branches/master/file000', headers=gzip)
+        self.assertFalse('Content-Encoding' in res.headers, 'too small')
+        res = self.client.get('/foo/branches/master')
+        self.assertFalse('Content-Encoding' in res.headers)
+        self.assertEqual(res.headers['ETag'], etag[2:], 'strong otherwise')
+        app = create_app(testutil.GIT_DIR, compress_min_size=None)
+        res = Client(app, BaseResponse).get('/foo/branches/master',
+                                            headers=gzip)
+        self.assertFalse('Content-Encoding' in res.headers)
+
+        content = ''.join('line %d\n' % i for i in range(1000))
+        packed, = self.git.create_contents_from_stream(
+            StringIO('%d\n%s' % (len(content), content)))
+        loose = self.git.create_content(content + 'loose')
+        deflate = {'Accept-Encoding': 'deflate'}
+        res = self.client.get('/foo/blobs/' + packed, headers=deflate)
+        self.assertEqual(res.headers['Content-Encoding'], 'deflate')
+        self.assertEqual(res.headers['Content-Length'], str(len(res.data)))
+        self.assertEqual(res.headers['Vary'], 'Accept-Encoding')
+        self.assertEqual(res.headers['ETag'], 'W/"%s"' % packed)
+        self.assertEqual(zlib.decompress(res.data), content)
+        res = self.client.get('/foo/blobs/' + packed,
+                              headers={'Range': 'bytes=0-3',
+                                       'If-Range': 'W/"%s"' % packed})
+        self.assertEqual(res.status_code, 200,
+                         'a weak ETag does not validate a range')
+
+        res = self.client.get('/foo/blobs/' + loose, headers=deflate)
+        self.assertFalse('Content-Encoding' in res.headers)
+        self.assertEqual(res.data, content + 'loose')
+        res = self.client.get('/foo/blobs/' + packed,
+                              headers={'Accept-Encoding': 'deflate',
+                                       'Range': 'bytes=0-3'})
+        self.assertFalse('Content-Encoding' in res.headers)
+        self.assertEqual(res.data, 'line')
+        res = self.client.get('/foo/blobs/' + packed)
+        self.assertFalse('Content-Encoding' in res.headers)
+        self.assertEqual(res.headers['ETag'], '"%s"' % packed)
+
+    def test_archive(self):
+        sha1 = self.git.create_content('blah')
+        self.git.create_entry('master', '/dir/a.txt', sha1,
+                              author_name='foo',
+                              author_email='foo@example.com')
+        self.client = Client(
+            create_app(testutil.GIT_DIR, archive_cache_dir=os.path.join(
+                testutil.GIT_DIR, 'archives')), BaseResponse)
+
+        res = self.client.get('/foo/branches/master/dir?format=tar')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers['Content-Type'], 'application/x-tar')
+        self.assertEqual(res.headers['Content-Disposition'],
+                         'attachment; filename="dir.tar"')
+        tar = tarfile.open(fileobj=StringIO(res.data))
+        self.assertEqual(tar.getnames(), ['a.txt'])
+        self.assertEqual(tar.extractfile('a.txt').read(), 'blah')
+
+        res2 = self.client.get('/foo/branches/master/dir?format=tar')
+        self.assertEqual(res2.data, res.data)
+        self.assertEqual(res2.headers['Content-Length'], str(len(res.data)),
+                         'served from the cache')
+        self.assertTrue(os.listdir(os.path.join(testutil.GIT_DIR,
+                                                'archives')))
+
+        res = self.client.get('/foo/branches/master?format=zip')
+        self.assertEqual(res.headers['Content-Type'], 'application/zip')
+        self.assertEqual(zipfile.ZipFile(StringIO(res.data)).read(
+            'dir/a.txt'), 'blah')
+
+    def test_changes(self):
+        res = self.client.post('/foo/blobs', data='test_changes')
+        sha1 = json.loads(res.data)['result']['sha1']
+
+        res = self.client.post('/foo/changes/master', data=json.dumps({
+            'changes': [
+                {'action': 'create', 'path': 'dir1/file%d' % i, 'sha1': sha1}
+                for i in range(10)
+            ] + [{'action': 'delete', 'path': '.git-placeholder'}],
+            'author_name': 'foo',
+            'author_email': 'foo@example.com',
+            'comment': 'batch',
+        }))
+        self.assertEqual(res.status_code, 201)
+        commit = json.loads(res.data)['result']['sha1']
+
+        res = self.client.get('/foo/branches/master')
+        self.assertEqual(json.loads(res.data)['result']['sha1'], commit)
+        self.assertEqual([x['name'] for x in
+                          json.loads(res.data)['result']['entries']],
+                         ['dir1'])
+        res = self.client.get('/foo/branches/master/dir1')
+        self.assertEqual(len(json.loads(res.data)['result']['entries']), 10)
+
+        for changes in [None, 'dir1', ['dir1/file0'],
+                        [{'action': 'delete', 'path': None}],
+                        [{'action': 'rename', 'path': 'dir1/file0'}]]:
+            res = self.client.post('/foo/changes/master', data=json.dumps({
+                'changes': changes,
+                'author_name': 'foo',
+                'author_email': 'foo@example.com',
+            }))
+            self.assertEqual(res.status_code, 400)
+            self.assertTrue(json.loads(res.data)['error'])
+
+        for data in [[], 'foo', None]:
+            res = self.client.post('/foo/changes/master',
+                                   data=json.dumps(data))
+            self.assertEqual(res.status_code, 400)
+
+        res = self.client.post('/foo/changes/master', data=json.dumps({
+            'changes': [{'action': 'create', 'path': 'x.txt',
+                         'sha1': sha1, 'mode': '0777'}],
+            'author_name': 'foo',
+            'author_email': 'foo@example.com',
+        }))
+        self.assertEqual(res.status_code, 400)
+
+    def test_conflict(self):
+        res = self.client.post('/foo/blobs', data='test_conflict')
+        sha1 = json.loads(res.data)['result']['sha1']
+        param = {
+            'sha1': sha1,
+            'author_name': 'foo',
+            'author_email': 'foo@example.com',
+        }
+
+        res = self.client.get('/foo/branches/master/.git-placeholder')
+        etag = res.headers['ETag']
+        head = json.loads(self.client.get('/foo/branches/master').data)[
+            'result']['sha1']
+
+        res = self.client.put('/foo/branches/master/.git-placeholder',
+                              data=json.dumps(param),
+                              headers={'If-Match': etag})
+        self.assertEqual(res.status_code, 200, 'ETag is up to date')
+        commit = json.loads(res.data)['result']['sha1']
+
+        res = self.client.put('/foo/branches/master/.git-placeholder',
+                              data=json.dumps(param),
+                              headers={'If-Match': etag})
+        self.assertEqual(res.status_code, 412, 'ETag is stale')
+
+        res = self.client.put('/foo/branches/master/.git-placeholder',
+                              data=json.dumps(param),
+                              headers={'If-Match': '"%s", %s, "%s"' % (
+                                  'f' * 40, etag, '0' * 40)})
+        self.assertEqual(res.status_code, 412, 'no ETag is up to date')
+        etag = self.client.get(
+            '/foo/branches/master/.git-placeholder').headers['ETag']
+        res = self.client.put('/foo/branches/master/.git-placeholder',
+                              data=json.dumps(param),
+                              headers={'If-Match': '"%s", %s, "%s"' % (
+                                  'f' * 40, etag, '0' * 40)})
+        self.assertEqual(res.status_code, 200, 'one of the ETags matches')
+        commit = json.loads(res.data)['result']['sha1']
+
+        param['parent'] = head
+        res = self.client.post('/foo/branches/master/file1',
+                               data=json.dumps(param))
+        self.assertEqual(res.status_code, 409, 'parent is stale')
+
+        param['parent'] = commit
+        res = self.client.post('/foo/branches/master/file1',
+                               data=json.dumps(param))
+        self.assertEqual(res.status_code, 201)
+
+    def test_retries(self):
+        res = self.client.post('/foo/blobs', data='test_retries')
+        sha1 = json.loads(res.data)['result']['sha1']
+        param = {
+            'sha1': sha1,
+            'author_name': 'foo',
+            'author_email': 'foo@example.com',
+        }
+        head = json.loads(self.client.get('/foo/branches/master').data)[
+            'result']['sha1']
+        res = self.client.post('/foo/branches/master/file1',
+                               data=json.dumps(param))
+        self.assertEqual(json.loads(res.data)['result']['retries'], 0)
+
+        for retries in [-1, 'x', 1.5, None]:
+            param['retries'] = retries
+            res = self.client.post('/foo/branches/master/file2',
+                                   data=json.dumps(param))
+            self.assertEqual(res.status_code, 400)
+
+        param['retries'] = 1000
+        res = self.client.post('/foo/branches/master/file2',
+                               data=json.dumps(param))
+        self.assertEqual(res.status_code, 201)
+
+        param['parent'] = head
+        param['retries'] = 3
+        res = self.client.post('/foo/branches/master/file3',
+                               data=json.dumps(param))
+        self.assertEqual(res.status_code, 409, 'no retries with a parent')
+
+        client = Client(create_app(testutil.GIT_DIR, write_retries=3),
+                        BaseResponse)
+        res = client.put('/foo/branches/master/file1',
+                         data=json.dumps(param))
+        self.assertEqual(res.status_code, 409, 'file1 has been modified')
+
+    def test_group_commit(self):
+        client = Client(create_app(testutil.GIT_DIR, group_commit=True),
+                        BaseResponse)
+        res = client.post('/foo/blobs', data='test_group_commit')
+        sha1 = json.loads(res.data)['result']['sha1']
+        res = client.post('/foo/branches/master/dir1/file1',
+                          data=json.dumps({
+                              'sha1': sha1,
+                              'author_name': 'foo',
+                              'author_email': 'foo@example.com',
+                          }))
+        self.assertEqual(res.status_code, 201)
+        commit = json.loads(res.data)['result']['sha1']
+        res = client.get('/foo/branches/master')
+        self.assertEqual(json.loads(res.data)['result']['sha1'], commit)
+        res = client.get('/foo/branches/master/dir1/file1')
+        self.assertEqual(json.loads(res.data)['result']['sha1'], sha1)
 
     def test_tag(self):
         res = self.client.get('/foo/tags')